@@ -4,7 +4,11 @@ setup(
     name='ureport-data',
     version='0.1',
     packages=['ureport_data'],
-    install_requires=['ipython[notebook]', 'celery[redis]', 'Humongolus', 'rapidpro-python', 'retrying'],
+    install_requires=['ipython[notebook]', 'celery[redis]', 'Humongolus', 'rapidpro-python'],
+    extras_require={
+        'export': ['pyarrow'],
+        'frames': ['pandas'],
+    },
     dependency_links=[
         'git+https://github.com/xkmato/Humongolus.git@patch#egg=Humongolus-1.0.6'
     ],
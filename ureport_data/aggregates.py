@@ -0,0 +1,23 @@
+import argparse
+import logging
+
+from ureport_data.models import Org, ResponseCount
+import settings
+
+logging.basicConfig(format=settings.FORMAT)
+
+__author__ = 'kenneth'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rebuild the response counts of orgs from their synced runs")
+    parser.add_argument('api_key', nargs='*', help="API keys of the orgs to rebuild, all active orgs by default")
+    parser.add_argument('--flow', help="Only rebuild this flow's counts")
+    args = parser.parse_args()
+
+    if args.api_key:
+        orgs = [Org.find_one({'api_token': api_key}) for api_key in args.api_key]
+    else:
+        orgs = list(Org.find({"is_active": True}))
+    for org in orgs:
+        ResponseCount.rebuild(org, flow=args.flow)
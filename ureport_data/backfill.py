@@ -0,0 +1,48 @@
+import argparse
+import json
+from datetime import timedelta
+
+from ureport_data import tasks
+from ureport_data.models import Org, Backfill
+
+__author__ = 'kenneth'
+
+
+def progress(orgs=None):
+    """
+    Backfill.progress of the orgs, every org by default, with org names instead of ids
+    """
+    if orgs:
+        orgs = [Org.find_one({'api_token': api_key}) for api_key in orgs]
+        reports = [report for org in orgs for report in Backfill.progress(org)]
+    else:
+        reports = Backfill.progress()
+    names = dict((org._id, org.name) for org in Org.find({}))
+    for report in reports:
+        report['org'] = names.get(report['org'], str(report['org']))
+    return reports
+
+
+def describe(report):
+    eta = report['eta_seconds']
+    return '%s %s%s until %s: %d/%d windows done, %d running, %d failed, %d fetched, %d created, %.1f%%, ETA %s' % (
+        report['org'], report['coll'], ' (%s)' % report['flow'] if report['flow'] else '', report['until'].isoformat(),
+        report['done'], report['windows'], report['running'], report['failed'], report['fetched'], report['created'],
+        report['percent'], timedelta(seconds=eta) if eta is not None else 'unknown')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Report the progress of backfills")
+    parser.add_argument('orgs', nargs='*', help="API keys of the orgs to report on, all orgs by default")
+    parser.add_argument('--json', action='store_true', help="Print the reports as JSON")
+    parser.add_argument('--retry', action='store_true', help="Dispatch failed and stalled windows again")
+    args = parser.parse_args()
+
+    if args.retry:
+        tasks.retry_backfill.delay(orgs=args.orgs or None)
+    reports = progress(args.orgs)
+    if args.json:
+        print json.dumps(reports, indent=2, sort_keys=True, default=str)
+    else:
+        for report in reports:
+            print describe(report)
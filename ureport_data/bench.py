@@ -0,0 +1,284 @@
+import argparse
+import json
+import logging
+import platform
+import subprocess
+import sys
+import time
+from datetime import datetime
+from functools import partial
+from uuid import uuid4
+
+from bson import ObjectId
+import humongolus as orm
+import humongolus.field as field
+from temba_client.v2 import types
+
+from ureport_data import clients, routing
+from ureport_data.models import Org, Message, Run, Contact, Flow, Broadcast, Group, Label, BaseDocument, \
+    indexed_classes, ref_cache, ref_key
+from ureport_data.runner import run as run_streams
+from ureport_data.standin import StandIn, SyntheticData, DEFAULT_VOLUMES, ENDPOINTS
+import settings
+
+logging.basicConfig(format=settings.FORMAT)
+logger = logging.getLogger("bench")
+
+__author__ = 'kenneth'
+
+ENTITIES = [Contact, Message, Run]
+METRICS = ['docs_per_sec', 'api_calls_per_doc', 'mongo_ops_per_doc']
+# (document class, temba type, stand-in endpoint) converted by the conversion benchmark
+CONVERSIONS = [(Group, types.Group, 'groups'), (Label, types.Label, 'labels'), (Contact, types.Contact, 'contacts'),
+               (Broadcast, types.Broadcast, 'broadcasts'), (Message, types.Message, 'messages')]
+
+
+def version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty']).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def mongo_ops():
+    """
+    The server's opcounters. They are server wide, so benchmark against a database nothing else is using.
+    """
+    return dict((op, int(count)) for op, count in settings.CONNECTION.admin.command('serverStatus')['opcounters']
+                .items())
+
+
+def count_docs(org):
+    with routing.using(org):
+        return dict((cls._collection, cls._connection().find({'org.id': org._id}).count())
+                    for cls in ENTITIES + [Flow])
+
+
+def sync_sequential(org, af=None):
+    for cls in ENTITIES:
+        if cls is Run:
+            for flow in Flow.due_for_run_sync(org, af=af):
+                Run.fetch_objects(org, af=af, flows=flow)
+        else:
+            cls.fetch_objects(org, af=af)
+
+
+def sync_runner(org, af=None, concurrency=None):
+    run_streams(entities=[{'name': cls.__name__} for cls in ENTITIES], orgs=[org.api_token], af=af,
+                concurrency=concurrency)
+
+
+def measure(name, standin, org, sync):
+    """
+    Runs one sync and reports its throughput. Documents are the items the stand-in served.
+    """
+    docs_before = count_docs(org)
+    standin.reset_stats()
+    ops_before = mongo_ops()
+    started = time.time()
+    sync()
+    seconds = time.time() - started
+    ops_after = mongo_ops()
+    api = standin.stats()
+    docs_after = count_docs(org)
+
+    fetched = sum(api['items'].values())
+    ops = dict((op, ops_after[op] - ops_before.get(op, 0)) for op in ops_after)
+    per_doc = float(fetched) if fetched else None
+    result = {
+        'scenario': name,
+        'seconds': round(seconds, 3),
+        'fetched': fetched,
+        'written': dict((coll, docs_after[coll] - docs_before[coll]) for coll in docs_after),
+        'api_calls': api['total_requests'],
+        'throttled': api['throttled'],
+        'mongo_ops': ops,
+        'docs_per_sec': round(fetched / seconds, 1) if seconds else None,
+        'api_calls_per_doc': round(api['total_requests'] / per_doc, 4) if per_doc else None,
+        'mongo_ops_per_doc': round(sum(ops.values()) / per_doc, 3) if per_doc else None,
+    }
+    logger.info("%s: %s", name, result)
+    return result
+
+
+def remove_org(org):
+    with routing.using(org):
+        for cls in indexed_classes():
+            if cls is not Org:
+                cls._connection().remove({'org.id': org._id})
+    Org._connection().remove({'_id': org._id})
+
+
+def benchmark(volumes=None, page_size=250, latency=0.0, rate_limit=0, grow=0.1, runner=False, concurrency=None):
+    """
+    Syncs a fresh org from a local API stand-in three times: a full sync, an incremental one with nothing new and an
+    incremental one after every endpoint grew by `grow`. The runner flag syncs through the threaded runner, the
+    in-process equivalent of fetch_all, instead of one stream at a time.
+    """
+    standin = StandIn(volumes=volumes, page_size=page_size, latency=latency, rate_limit=rate_limit).start()
+    endpoint = settings.API_ENDPOINT
+    settings.API_ENDPOINT = standin.url
+    clients.registry.close()
+    org = Org.create(name='Benchmark %s' % uuid4().hex[:8], api_token=uuid4().hex)
+    if runner:
+        sync = lambda af: sync_runner(org, af=af, concurrency=concurrency)
+    else:
+        sync = lambda af: sync_sequential(org, af=af)
+    try:
+        results = [measure('full', standin, org, lambda: sync(True)),
+                   measure('incremental_unchanged', standin, org, lambda: sync(None))]
+        for name in ENDPOINTS:
+            standin.data.grow(name, int(standin.data.volumes[name] * grow))
+        results.append(measure('incremental', standin, org, lambda: sync(None)))
+    finally:
+        remove_org(org)
+        standin.stop()
+        settings.API_ENDPOINT = endpoint
+        clients.registry.close()
+
+    return {
+        'version': version(),
+        'started': datetime.utcnow().isoformat(),
+        'python': platform.python_version(),
+        'config': {'volumes': standin.data.volumes, 'page_size': page_size, 'latency': latency,
+                   'rate_limit': rate_limit, 'grow': grow, 'runner': runner, 'concurrency': concurrency,
+                   'bulk_writes': settings.BULK_WRITES, 'pipeline_sync': settings.PIPELINE_SYNC,
+                   'compact_runs': settings.COMPACT_RUNS},
+        'reference_cache': ref_cache.stats(),
+        'results': results,
+    }
+
+
+def reflective_build(cls, org, temba, refs):
+    """
+    build_from_temba as it was before conversion plans, looking every attribute up again for each record
+    """
+    module = sys.modules[BaseDocument.__module__]
+    obj = cls()
+    obj.org = org
+    for key, value in temba.__dict__.items():
+        class_attr = getattr(cls, key, None)
+        temba_attr = getattr(temba, key)
+        if class_attr is None:
+            continue
+        if isinstance(class_attr, orm.List):
+            item_class = getattr(module, key.rstrip('s').capitalize())
+            if issubclass(item_class, BaseDocument):
+                item_keys = [ref_key(v) for v in temba_attr or [] if v is not None]
+                getattr(obj, key).extend([refs[item_class][k] for k in item_keys if k in refs[item_class]])
+            if issubclass(item_class, orm.EmbeddedDocument):
+                getattr(obj, key).extend(item_class.create_from_temba_list(temba_attr))
+        elif class_attr == field.DynamicDocument:
+            item_class = getattr(module, key.capitalize())
+            if issubclass(item_class, BaseDocument):
+                setattr(obj, key, refs[item_class].get(ref_key(temba_attr)) if temba_attr is not None else None)
+            if issubclass(item_class, orm.EmbeddedDocument):
+                setattr(obj, key, item_class.create_from_temba(temba_attr))
+        else:
+            setattr(obj, key, value)
+    return obj
+
+
+def fake_refs(cls, temba_list):
+    """
+    Unsaved documents for every reference of a page, in the shape resolve_page_references returns
+    """
+    refs = {}
+    for key, item_class, many in cls.reference_fields():
+        resolved = refs.setdefault(item_class, {})
+        for temba in temba_list:
+            value = getattr(temba, key, None)
+            for item_key in (ref_key(v) for v in (value or [] if many else [value]) if v is not None):
+                if item_key not in resolved:
+                    doc = item_class()
+                    doc._id = ObjectId()
+                    resolved[item_key] = doc
+    return refs
+
+
+def conversion_benchmark(records=2000, repeat=3):
+    """
+    Per record cost of converting synthetic temba objects to documents with the compiled conversion plans and with
+    the reflective conversion they replaced, best of `repeat` runs. References come from a fake page lookup, so
+    neither Mongo nor the API is involved.
+    """
+    data = SyntheticData(dict((name, records) for name in ENDPOINTS))
+    org = Org()
+    org._id = ObjectId()
+    results = []
+    for cls, temba_type, endpoint in CONVERSIONS:
+        temba_list = [temba_type.deserialize(getattr(data, endpoint)(i)) for i in xrange(records)]
+        refs = fake_refs(cls, temba_list)
+        timings = {}
+        for name, build in (('reflective', partial(reflective_build, cls)), ('plan', cls.build_from_temba)):
+            best = None
+            for _ in xrange(repeat):
+                started = time.time()
+                for temba in temba_list:
+                    build(org, temba, refs)
+                elapsed = time.time() - started
+                best = elapsed if best is None else min(best, elapsed)
+            timings[name] = best * 1e6 / records
+        result = {'class': cls.__name__, 'records': records, 'reflective_us': round(timings['reflective'], 2),
+                  'plan_us': round(timings['plan'], 2),
+                  'speedup': round(timings['reflective'] / timings['plan'], 2) if timings['plan'] else None}
+        logger.info("conversion: %s", result)
+        results.append(result)
+    return {'version': version(), 'started': datetime.utcnow().isoformat(), 'python': platform.python_version(),
+            'conversion': results}
+
+
+def compare(report, previous):
+    """
+    Lines comparing the metrics of two reports scenario by scenario, as new/old ratios
+    """
+    old = dict((result['scenario'], result) for result in previous['results'])
+    lines = []
+    for result in report['results']:
+        base = old.get(result['scenario'])
+        if not base:
+            continue
+        ratios = ['%s %.2fx' % (metric, float(result[metric]) / base[metric]) for metric in METRICS
+                  if result.get(metric) and base.get(metric)]
+        lines.append('%s (%s vs %s): %s' % (result['scenario'], report['version'], previous['version'],
+                                            ', '.join(ratios)))
+    return lines
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Benchmark syncing against a local RapidPro API stand-in")
+    parser.add_argument('--output', default='bench.json', help="File the JSON report is written to")
+    parser.add_argument('--compare', help="Previous report to compare with")
+    parser.add_argument('--page-size', type=int, default=250)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every API request")
+    parser.add_argument('--rate-limit', type=int, default=0, help="API requests per second, 0 for no limit")
+    parser.add_argument('--grow', type=float, default=0.1, help="Share of new items for the incremental sync")
+    parser.add_argument('--runner', action='store_true', help="Sync through the threaded runner")
+    parser.add_argument('--concurrency', type=int, default=settings.RUNNER_CONCURRENCY)
+    parser.add_argument('--conversion', type=int, metavar='RECORDS',
+                        help="Only measure the per record conversion cost, with RECORDS records per class")
+    for name in sorted(ENDPOINTS):
+        parser.add_argument('--%s' % name, type=int, default=DEFAULT_VOLUMES[name], help="Number of %s" % name)
+    args = parser.parse_args()
+
+    if args.conversion:
+        report = conversion_benchmark(records=args.conversion)
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+        for result in report['conversion']:
+            print '%(class)s: %(reflective_us)s us/record reflective, %(plan_us)s us/record with the plan, ' \
+                  '%(speedup)sx' % result
+        sys.exit()
+
+    report = benchmark(volumes=dict((name, getattr(args, name)) for name in ENDPOINTS), page_size=args.page_size,
+                       latency=args.latency, rate_limit=args.rate_limit, grow=args.grow, runner=args.runner,
+                       concurrency=args.concurrency)
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    for result in report['results']:
+        print '%(scenario)s: %(docs_per_sec)s docs/s, %(api_calls_per_doc)s API calls/doc, ' \
+              '%(mongo_ops_per_doc)s mongo ops/doc' % result
+    if args.compare:
+        with open(args.compare) as f:
+            for line in compare(report, json.load(f)):
+                print line
@@ -0,0 +1,85 @@
+import threading
+import time
+from collections import OrderedDict
+
+__author__ = 'kenneth'
+
+MISSING = object()
+
+
+class RefCache(object):
+    """
+    LRU cache of resolved references with a TTL, bounded both by number of entries and by the estimated size of the
+    cached values. References confirmed missing upstream are stored as MISSING with their own TTL.
+    """
+    def __init__(self, max_entries, max_bytes, ttl, negative_ttl, sizeof=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.sizeof = sizeof or (lambda value: 0)
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()
+        self.size = 0
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _pop(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.size -= entry[2]
+        return entry
+
+    def get(self, key):
+        """
+        Returns the cached value, MISSING for a known missing reference or None when the key has to be resolved
+        """
+        with self.lock:
+            entry = self._pop(key)
+            if entry is None or entry[1] < time.time():
+                self.misses += 1
+                return None
+            self.entries[key] = entry
+            self.size += entry[2]
+            if entry[0] is MISSING:
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return entry[0]
+
+    def set(self, key, value, ttl=None):
+        size = 0 if value is MISSING else self.sizeof(value)
+        with self.lock:
+            self._pop(key)
+            self.entries[key] = (value, time.time() + (ttl or self.ttl), size)
+            self.size += size
+            while self.entries and (len(self.entries) > self.max_entries or self.size > self.max_bytes):
+                self.size -= self.entries.popitem(last=False)[1][2]
+                self.evictions += 1
+
+    def set_missing(self, key):
+        self.set(key, MISSING, ttl=self.negative_ttl)
+
+    def invalidate(self, key):
+        with self.lock:
+            self._pop(key)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.negative_hits + self.misses
+            return {
+                'entries': len(self.entries),
+                'bytes': self.size,
+                'hits': self.hits,
+                'negative_hits': self.negative_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': float(self.hits + self.negative_hits) / lookups if lookups else 0.0,
+            }
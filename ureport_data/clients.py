@@ -0,0 +1,167 @@
+import json
+import logging
+import os
+import threading
+import time
+from urlparse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+from temba_client.clients import MAX_RETRIES
+from temba_client.exceptions import TembaBadRequestError, TembaTokenError, TembaNoSuchObjectError, \
+    TembaRateExceededError, TembaHttpError, TembaConnectionError
+from temba_client.v2 import TembaClient
+
+import metrics
+import profiling
+import settings
+
+logging.basicConfig(format=settings.FORMAT)
+logger = logging.getLogger("clients")
+
+__author__ = 'kenneth'
+
+
+class PooledTembaClient(TembaClient):
+    """
+    TembaClient that sends every request through a shared keep-alive session
+    """
+    def __init__(self, host, token, session, user_agent=None, timeout=None, slots=None):
+        super(PooledTembaClient, self).__init__(host, token, user_agent=user_agent)
+        self.session = session
+        self.timeout = timeout
+        self.slots = slots
+
+    def _request(self, method, url, params=None, body=None, retry_on_rate_exceed=False):
+        retries = 0
+        while True:
+            try:
+                return self._pooled_request(method, url, params=params, body=body)
+            except TembaRateExceededError as e:
+                retries += 1
+                if not retry_on_rate_exceed or not e.retry_after or retries >= MAX_RETRIES:
+                    raise
+                metrics.inc('retries', kind='rate_limit')
+                time.sleep(e.retry_after)
+
+    def _pooled_request(self, method, url, params=None, body=None):
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug("%s %s %s" % (method.upper(), url, json.dumps(params if params else body)))
+        kwargs = {'headers': self.headers, 'timeout': self.timeout}
+        if body:
+            kwargs['data'] = json.dumps(body)
+        if params:
+            kwargs['params'] = params
+        endpoint = urlparse(url).path.rstrip('/').split('/')[-1].replace('.json', '')
+        try:
+            if self.slots is not None:
+                with self.slots:
+                    response = self._timed_request(endpoint, method, url, **kwargs)
+            else:
+                response = self._timed_request(endpoint, method, url, **kwargs)
+
+            if response.status_code == 400:
+                try:
+                    errors = response.json()
+                except ValueError:
+                    errors = {'details': [response.content]}
+                raise TembaBadRequestError(errors)
+            elif response.status_code == 403:
+                raise TembaTokenError()
+            elif response.status_code == 404:
+                raise TembaNoSuchObjectError()
+            elif response.status_code == 429:
+                retry_after = response.headers.get('retry-after')
+                raise TembaRateExceededError(int(retry_after) if retry_after else 0)
+
+            response.raise_for_status()
+            return response.json() if response.content else None
+        except requests.HTTPError as e:
+            raise TembaHttpError(e)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            raise TembaConnectionError()
+
+    def _timed_request(self, endpoint, method, url, **kwargs):
+        started = time.time()
+        status = 'error'
+        try:
+            response = self.session.request(method, url, **kwargs)
+            status = response.status_code
+            return response
+        finally:
+            seconds = time.time() - started
+            metrics.inc('api_requests', endpoint=endpoint, status=status)
+            metrics.observe('api_request_seconds', seconds, endpoint=endpoint)
+            profiling.add_span('http.%s' % endpoint, seconds)
+
+
+def make_session():
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=settings.API_POOL_CONNECTIONS, pool_maxsize=settings.API_POOL_MAXSIZE)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+class ClientRegistry(object):
+    """
+    Process wide TembaClients keyed by api token. All clients share one pooled session, which is rebuilt after a fork
+    so Celery's prefork children never share sockets with their parent.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.pid = None
+        self.session = None
+        self.clients = {}
+        self.slots = None
+        self.hits = 0
+        self.misses = 0
+
+    def _check_pid(self):
+        if self.pid != os.getpid():
+            self.pid = os.getpid()
+            self.session = make_session()
+            self.clients = {}
+
+    def get(self, api_token):
+        with self.lock:
+            self._check_pid()
+            client = self.clients.get(api_token)
+            if client is not None:
+                self.hits += 1
+                return client
+            self.misses += 1
+            client = PooledTembaClient(settings.API_ENDPOINT, api_token, self.session,
+                                       user_agent=getattr(settings, 'SITE_API_USER_AGENT', None),
+                                       timeout=(settings.API_CONNECT_TIMEOUT, settings.API_READ_TIMEOUT),
+                                       slots=self.slots)
+            self.clients[api_token] = client
+            return client
+
+    def limit_requests(self, limit):
+        """
+        Caps the number of API requests in flight across all clients of this process, 0 removes the cap
+        """
+        with self.lock:
+            self.slots = threading.BoundedSemaphore(limit) if limit else None
+            for client in self.clients.values():
+                client.slots = self.slots
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'clients': len(self.clients)}
+
+    def close(self):
+        with self.lock:
+            if self.session is not None:
+                self.session.close()
+            self.pid = None
+            self.session = None
+            self.clients = {}
+
+
+registry = ClientRegistry()
+
+
+def get_client(api_token):
+    return registry.get(api_token)
@@ -0,0 +1,24 @@
+import argparse
+import logging
+
+from ureport_data.models import Org, Run
+import settings
+
+logging.basicConfig(format=settings.FORMAT)
+
+__author__ = 'kenneth'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert stored runs to the compact encoding, or back")
+    parser.add_argument('api_key', nargs='*', help="API keys of the orgs to convert, all active orgs by default")
+    parser.add_argument('--expand', action='store_true', help="Convert compact runs back to the plain encoding")
+    parser.add_argument('--batch-size', type=int, default=settings.RAW_BATCH_SIZE, help="Runs rewritten per batch")
+    args = parser.parse_args()
+
+    if args.api_key:
+        orgs = [Org.find_one({'api_token': api_key}) for api_key in args.api_key]
+    else:
+        orgs = list(Org.find({"is_active": True}))
+    for org in orgs:
+        Run.migrate_encoding(org, compact=not args.expand, batch_size=args.batch_size)
@@ -17,4 +17,4 @@ if __name__ == '__main__':
         c, name, key = tuple(arguments)
 
         o = Org.create(name=name, api_token=key)
-        tasks.fetch_all.delay(orgs=[o.api_token])
+        tasks.fetch_all.delay(orgs=[o.api_token], af=True)
@@ -0,0 +1,148 @@
+import argparse
+import logging
+import os
+import time
+from datetime import datetime
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+from ureport_data import routing
+from ureport_data.frames import flatten
+from ureport_data.models import Org, LastSaved, Message, Run, Contact, Flow, Group, Label, Broadcast, Campaign, Event
+import settings
+
+logging.basicConfig(format=settings.FORMAT)
+logger = logging.getLogger("export")
+
+__author__ = 'kenneth'
+
+COLLECTIONS = dict((cls._collection, cls) for cls in [Message, Run, Contact, Flow, Group, Label, Broadcast, Campaign,
+                                                      Event])
+
+# nested lists that get a table of their own, one row per item keyed by the parent's fetch key
+CHILD_TABLES = {
+    'runs': ['values', 'steps'],
+}
+
+
+def partition(doc):
+    created_on = doc.get('created_on')
+    return created_on.strftime('%Y-%m') if isinstance(created_on, datetime) else 'unknown'
+
+
+def _array(values):
+    try:
+        return pa.array(values)
+    except (pa.ArrowInvalid, TypeError, ValueError):
+        return pa.array([None if v is None else unicode(v) for v in values])
+
+
+def write_rows(rows, path):
+    names = sorted(set(name for row in rows for name in row))
+    table = pa.Table.from_arrays([_array([row.get(name) for row in rows]) for name in names], names)
+    directory = os.path.dirname(path)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    pq.write_table(table, path)
+    return path
+
+
+class PartitionedWriter(object):
+    """
+    Buffers rows per (table, month) partition and writes them as parquet files laid out as
+    <root>/<table>/org=<org id>/month=<YYYY-MM>/part-<run>-<n>.parquet
+    """
+    def __init__(self, root, org, rows_per_file):
+        self.root = root
+        self.org = org
+        self.rows_per_file = rows_per_file
+        self.run = time.strftime('%Y%m%d%H%M%S')
+        self.buffers = {}
+        self.buffered = 0
+        self.files = []
+        self.rows = {}
+
+    def add(self, table, month, row):
+        self.buffers.setdefault((table, month), []).append(row)
+        self.buffered += 1
+        self.rows[table] = self.rows.get(table, 0) + 1
+        if len(self.buffers[(table, month)]) >= self.rows_per_file:
+            self.flush(table, month)
+        elif self.buffered >= self.rows_per_file * 4:
+            self.flush(*max(self.buffers, key=lambda k: len(self.buffers[k])))
+
+    def flush(self, table, month):
+        rows = self.buffers.pop((table, month), [])
+        if not rows:
+            return
+        self.buffered -= len(rows)
+        path = os.path.join(self.root, table, 'org=%s' % self.org._id, 'month=%s' % month,
+                            'part-%s-%05d.parquet' % (self.run, len(self.files)))
+        self.files.append(write_rows(rows, path))
+
+    def close(self):
+        for key in list(self.buffers):
+            self.flush(*key)
+
+
+def export_collection(org, cls, root=None, incremental=True, batch_size=None):
+    """
+    Streams one collection of an org into partitioned parquet files. Incremental exports only write documents
+    modified since the last export, so an updated record appears again in a later part and readers keep the row
+    with the newest __modified__ per key.
+    """
+    if pa is None:
+        raise ImportError("Exporting needs pyarrow, install ureport-data[export]")
+    root = root or settings.EXPORT_ROOT
+    started = datetime.utcnow()
+    watermark = LastSaved.get_for(org, 'export.%s' % cls._collection)
+    query = {'org.id': org._id, '__modified__': {'$lte': started}}
+    if incremental and watermark.modified_on:
+        query['__modified__']['$gt'] = watermark.modified_on
+
+    writer = PartitionedWriter(root, org, settings.EXPORT_ROWS_PER_FILE)
+    children = CHILD_TABLES.get(cls._collection, [])
+    with routing.using(org):
+        cursor = cls.iter_raw(query, sort=[('__modified__', 1)], batch_size=batch_size or settings.EXPORT_BATCH_SIZE)
+    newest = None
+    for doc in cursor:
+        month = partition(doc)
+        parent = {cls.fetch_key: doc.get(cls.fetch_key), 'org_id': str(org._id), 'created_on': doc.get('created_on')}
+        for child in children:
+            for item in doc.pop(child, None) or []:
+                row = dict(parent)
+                row.update(flatten(item))
+                writer.add('%s_%s' % (cls._collection, child), month, row)
+        writer.add(cls._collection, month, flatten(doc))
+        newest = doc.get('__modified__') or newest
+    writer.close()
+
+    if newest:
+        watermark.modified_on = newest
+        watermark.last_saved = datetime.utcnow()
+        watermark.save()
+    logger.info("Exported %s for Org: %s - %s rows in %d files", cls._collection, org.name, writer.rows,
+                len(writer.files))
+    return {'rows': writer.rows, 'files': writer.files}
+
+
+def export_org(org, collections=None, root=None, incremental=True):
+    return dict((collection, export_collection(org, COLLECTIONS[collection], root=root, incremental=incremental))
+                for collection in collections or ['runs', 'messages', 'contacts', 'flows'])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export synced collections to partitioned parquet files")
+    parser.add_argument('api_key', help="API key of the org to export")
+    parser.add_argument('--collection', action='append', choices=sorted(COLLECTIONS.keys()))
+    parser.add_argument('--root', default=settings.EXPORT_ROOT, help="Directory the dataset is written to")
+    parser.add_argument('--full', action='store_true', help="Export everything instead of appending changes")
+    args = parser.parse_args()
+
+    export_org(Org.find_one({'api_token': args.api_key}), collections=args.collection, root=args.root,
+               incremental=not args.full)
@@ -0,0 +1,126 @@
+import json
+
+from bson import ObjectId
+
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
+
+import settings
+
+__author__ = 'kenneth'
+
+# nested lists exploded into long format by default, one row per item
+DEFAULT_EXPLODE = {
+    'runs': 'values',
+    'contacts': 'urns',
+}
+
+CATEGORICAL = ['status', 'type', 'direction', 'exit_type', 'flow', 'values_category', 'values_node', 'steps_node',
+               'urns_type', 'language', 'org_cls']
+
+SKIP_FIELDS = ['_id', '_hash', '__active__', '__created__']
+
+
+class FrameTooLarge(MemoryError):
+    pass
+
+
+def _scalar(value):
+    if isinstance(value, ObjectId):
+        return str(value)
+    if isinstance(value, (list, dict)):
+        return json.dumps(value, default=str)
+    return value
+
+
+def flatten(doc, prefix=''):
+    """
+    Flattens a raw mongo document into a single level row, nested keys are joined with '_' so org.id becomes org_id
+    """
+    row = {}
+    for key, value in doc.items():
+        if not prefix and key in SKIP_FIELDS:
+            continue
+        name = '%s_%s' % (prefix, key) if prefix else key
+        if isinstance(value, dict):
+            row.update(flatten(value, name))
+        elif isinstance(value, list) and not any(isinstance(item, (dict, list)) for item in value):
+            row[name] = [_scalar(item) for item in value]
+        else:
+            row[name] = _scalar(value)
+    return row
+
+
+def rows(doc, explode=None):
+    items = doc.pop(explode, None) if explode else None
+    row = flatten(doc)
+    if not items:
+        return [row]
+    exploded = []
+    for item in items:
+        item_row = dict(row)
+        item_row.update(flatten(item, explode) if isinstance(item, dict) else {explode: _scalar(item)})
+        exploded.append(item_row)
+    return exploded
+
+
+def convert(frame, categorize=True):
+    """
+    Vectorized dtype conversion of a freshly built chunk
+    """
+    for column in frame.columns:
+        if column.endswith('_on') or column.endswith('time') or column in ('__modified__',):
+            frame[column] = pd.to_datetime(frame[column], errors='coerce')
+        elif categorize and column in CATEGORICAL and frame[column].dtype == object:
+            frame[column] = frame[column].astype('category')
+    return frame
+
+
+def iter_frames(cursor, explode=None, chunksize=None, categorize=True):
+    """
+    Builds DataFrames of at most `chunksize` rows from a cursor of raw documents
+    """
+    if pd is None:
+        raise ImportError("Loading frames needs pandas, install ureport-data[frames]")
+    chunksize = chunksize or settings.FRAME_CHUNKSIZE
+    buffered = []
+    for doc in cursor:
+        buffered.extend(rows(doc, explode))
+        if len(buffered) >= chunksize:
+            yield convert(pd.DataFrame.from_records(buffered), categorize=categorize)
+            buffered = []
+    if buffered:
+        yield convert(pd.DataFrame.from_records(buffered), categorize=categorize)
+
+
+def load_frame(cls, query, fields=None, explode=None, chunksize=None, max_bytes=None, iterator=False):
+    """
+    Loads documents of `cls` into a DataFrame without building humongolus documents. `fields` is a mongo projection
+    (dotted paths allowed), `explode` names the nested list turned into long format, False disables the collection's
+    default. With iterator=True the chunks are returned one by one for data that doesn't fit in memory, otherwise
+    FrameTooLarge is raised once the loaded chunks go over `max_bytes`.
+    """
+    if pd is None:
+        raise ImportError("Loading frames needs pandas, install ureport-data[frames]")
+    if explode is None:
+        explode = DEFAULT_EXPLODE.get(cls._collection)
+    chunksize = chunksize or settings.FRAME_CHUNKSIZE
+    if fields and explode and explode not in fields:
+        fields = list(fields) + [explode]
+    cursor = cls.iter_raw(query, fields=fields, batch_size=chunksize)
+    if iterator:
+        return iter_frames(cursor, explode=explode or None, chunksize=chunksize)
+
+    max_bytes = max_bytes or settings.FRAME_MAX_BYTES
+    loaded = []
+    size = 0
+    for frame in iter_frames(cursor, explode=explode or None, chunksize=chunksize, categorize=False):
+        size += frame.memory_usage(deep=True).sum()
+        if size > max_bytes:
+            raise FrameTooLarge("%s frame is over %d bytes, load it with iterator=True" % (cls._collection, max_bytes))
+        loaded.append(frame)
+    if not loaded:
+        return pd.DataFrame()
+    return convert(pd.concat(loaded, ignore_index=True))
@@ -0,0 +1,76 @@
+__author__ = 'kenneth'
+
+SHAPE_TYPES = ('Polygon', 'MultiPolygon')
+
+
+def _distance(point, start, end):
+    """
+    Distance from point to the segment start-end, in coordinate units
+    """
+    (x, y), (x1, y1), (x2, y2) = point[:2], start[:2], end[:2]
+    dx, dy = x2 - x1, y2 - y1
+    if dx == 0 and dy == 0:
+        return ((x - x1) ** 2 + (y - y1) ** 2) ** 0.5
+    t = max(0.0, min(1.0, ((x - x1) * dx + (y - y1) * dy) / float(dx * dx + dy * dy)))
+    return ((x - x1 - t * dx) ** 2 + (y - y1 - t * dy) ** 2) ** 0.5
+
+
+def douglas_peucker(points, tolerance):
+    """
+    Simplifies a line keeping its end points and every point further than tolerance from the simplified line
+    """
+    if len(points) < 3:
+        return list(points)
+    keep = [False] * len(points)
+    keep[0] = keep[-1] = True
+    stack = [(0, len(points) - 1)]
+    while stack:
+        first, last = stack.pop()
+        furthest, index = 0, None
+        for i in xrange(first + 1, last):
+            distance = _distance(points[i], points[first], points[last])
+            if distance > furthest:
+                furthest, index = distance, i
+        if index is not None and furthest > tolerance:
+            keep[index] = True
+            stack.append((first, index))
+            stack.append((index, last))
+    return [point for point, kept in zip(points, keep) if kept]
+
+
+def simplify_ring(ring, tolerance):
+    # a linear ring has to stay closed with at least 4 positions, small rings are kept as they are
+    simplified = douglas_peucker(ring, tolerance)
+    return simplified if len(simplified) >= 4 else list(ring)
+
+
+def simplify(shape, tolerance):
+    """
+    Simplifies a GeoJSON Polygon or MultiPolygon ring by ring
+    """
+    if shape['type'] == 'Polygon':
+        coordinates = [simplify_ring(ring, tolerance) for ring in shape['coordinates']]
+    else:
+        coordinates = [[simplify_ring(ring, tolerance) for ring in polygon] for polygon in shape['coordinates']]
+    return {'type': shape['type'], 'coordinates': coordinates}
+
+
+def to_shape(geometries):
+    """
+    Builds one GeoJSON shape out of RapidPro geometries, several polygons are merged into a MultiPolygon. Returns
+    None when there is no usable geometry.
+    """
+    polygons = []
+    for geometry in geometries:
+        coordinates = getattr(geometry, 'coordinates', None)
+        if getattr(geometry, 'type', None) not in SHAPE_TYPES or not isinstance(coordinates, list) or not coordinates:
+            continue
+        if geometry.type == 'Polygon':
+            polygons.append(coordinates)
+        else:
+            polygons.extend(coordinates)
+    if not polygons:
+        return None
+    if len(polygons) == 1:
+        return {'type': 'Polygon', 'coordinates': polygons[0]}
+    return {'type': 'MultiPolygon', 'coordinates': polygons}
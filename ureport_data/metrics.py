@@ -0,0 +1,281 @@
+import BaseHTTPServer
+import SocketServer
+import json
+import logging
+import os
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+import settings
+
+logging.basicConfig(format=settings.FORMAT)
+logger = logging.getLogger("metrics")
+
+__author__ = 'kenneth'
+
+PREFIX = 'ureport_'
+
+# name: (type, help, label whose value splits the per task summary)
+METRICS = {
+    'api_requests': ('counter', "RapidPro API requests by endpoint and status", 'status'),
+    'api_request_seconds': ('histogram', "RapidPro API request latency", None),
+    'retries': ('counter', "Rate limited requests retried by the client and tasks sent back to the broker", 'kind'),
+    'pages_fetched': ('counter', "Pages of records fetched", None),
+    'records_converted': ('counter', "Records converted to documents", None),
+    'documents_written': ('counter', "Documents created by page writes", None),
+    'documents_updated': ('counter', "Stored documents updated because their content changed", None),
+    'documents_skipped': ('counter', "Documents of a page stored with the same content, not written", None),
+    'reference_lookups': ('counter', "References resolved by where they were found: cache_hit, db_hit, api_fetch or "
+                                     "miss", 'result'),
+    'tasks': ('counter', "Sync tasks by status", None),
+    'task_seconds': ('histogram', "Sync task duration", None),
+}
+
+_local = threading.local()
+
+
+class Registry(object):
+    """
+    Counters and histograms of this process keyed by (name, sorted label items)
+    """
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+
+    def inc(self, name, labels, value=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, labels, value):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            histogram[0][bisect_left(self.buckets, value)] += 1
+            histogram[1] += value
+            histogram[2] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                'buckets': self.buckets,
+                'counters': [[name, dict(labels), value] for (name, labels), value in self.counters.items()],
+                'histograms': [[name, dict(labels), list(h[0]), h[1], h[2]]
+                               for (name, labels), h in self.histograms.items()],
+            }
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.histograms = {}
+
+
+registry = Registry(settings.METRICS_BUCKETS)
+
+
+class Scope(object):
+    """
+    Labels of the task a thread is working for and that task's totals, shared by every thread working for it
+    """
+    def __init__(self, labels, extra=None):
+        self.labels = labels
+        self.extra = extra or {}
+        self.totals = {}
+        self.status = 'ok'
+        self.profile = None
+        self.lock = threading.Lock()
+
+    def label(self, **labels):
+        self.labels.update(labels)
+
+    def add(self, name, labels, value):
+        split = METRICS[name][2]
+        key = '%s_%s' % (name, labels.get(split)) if split else name
+        with self.lock:
+            self.totals[key] = self.totals.get(key, 0) + value
+
+
+def current():
+    return getattr(_local, 'scope', None)
+
+
+def activate(scope):
+    """
+    Makes a thread count for `scope`, used by threads doing a task's work on its behalf
+    """
+    _local.scope = scope
+
+
+def _labels(labels):
+    scope = current()
+    merged = dict(scope.labels) if scope else {'org': '', 'entity': ''}
+    merged.update((key, '' if value is None else unicode(value)) for key, value in labels.items())
+    return scope, merged
+
+
+def inc(name, value=1, **labels):
+    if not value:
+        return
+    scope, labels = _labels(labels)
+    registry.inc(name, labels, value)
+    if scope:
+        scope.add(name, labels, value)
+
+
+def observe(name, value, **labels):
+    scope, labels = _labels(labels)
+    registry.observe(name, labels, value)
+    if scope:
+        scope.add(name, labels, value)
+
+
+@contextmanager
+def timer(name, **labels):
+    started = time.time()
+    try:
+        yield
+    finally:
+        observe(name, time.time() - started, **labels)
+
+
+@contextmanager
+def task(entity, org=None, **extra):
+    """
+    Labels everything recorded by the calling thread with the task's org and entity. On exit the task is counted,
+    its totals are logged as one JSON record and, with METRICS_DIR set, the process's metrics are dumped for the
+    exposition server.
+    """
+    previous = current()
+    scope = Scope({'org': org or '', 'entity': entity}, extra)
+    activate(scope)
+    started = time.time()
+    try:
+        yield scope
+    except Exception:
+        scope.status = 'failed'
+        raise
+    finally:
+        seconds = time.time() - started
+        inc('tasks', status=scope.status)
+        observe('task_seconds', seconds)
+        activate(previous)
+        record = dict(scope.extra, event='sync_task', status=scope.status, seconds=round(seconds, 3), **scope.labels)
+        record.update(scope.totals)
+        logger.info(json.dumps(record, sort_keys=True, default=str))
+        if settings.METRICS_DIR:
+            dump()
+
+
+def dump(directory=None):
+    """
+    Writes this process's metrics to <directory>/metrics-<pid>.json, replacing its previous dump
+    """
+    directory = directory or settings.METRICS_DIR
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, 'metrics-%d.json' % os.getpid())
+    with open(path + '.tmp', 'w') as f:
+        json.dump(registry.snapshot(), f)
+    os.rename(path + '.tmp', path)
+    return path
+
+
+def collect(directory=None):
+    """
+    Merges the dumps of every process in `directory`, or returns this process's metrics without one
+    """
+    if not directory:
+        return registry.snapshot()
+    merged = Registry(settings.METRICS_BUCKETS)
+    for name in os.listdir(directory) if os.path.isdir(directory) else []:
+        if not name.startswith('metrics-') or not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(directory, name)) as f:
+                snapshot = json.load(f)
+        except (IOError, ValueError):
+            continue
+        for metric, labels, value in snapshot['counters']:
+            merged.inc(metric, labels, value)
+        if snapshot['buckets'] != merged.buckets:
+            logger.warning("Skipping histograms of %s, they use other buckets", name)
+            continue
+        for metric, labels, counts, total, count in snapshot['histograms']:
+            key = (metric, tuple(sorted(labels.items())))
+            histogram = merged.histograms.setdefault(key, [[0] * len(counts), 0.0, 0])
+            histogram[0] = [a + b for a, b in zip(histogram[0], counts)]
+            histogram[1] += total
+            histogram[2] += count
+    return merged.snapshot()
+
+
+def _format_labels(labels, **more):
+    items = sorted(labels.items()) + sorted(more.items())
+    return '{%s}' % ','.join('%s="%s"' % (key, unicode(value).replace('\\', '\\\\').replace('"', '\\"')
+                                          .replace('\n', '\\n')) for key, value in items)
+
+
+def exposition(snapshot):
+    """
+    Renders a snapshot in the Prometheus text format
+    """
+    samples = {}
+    order = lambda sample: (sample[0], sorted(sample[1].items()))
+    for name, labels, value in sorted(snapshot['counters'], key=order):
+        samples.setdefault(name, []).append('%s%s_total%s %s' % (PREFIX, name, _format_labels(labels), value))
+    bounds = [repr(float(bucket)) for bucket in snapshot['buckets']] + ['+Inf']
+    for name, labels, counts, total, count in sorted(snapshot['histograms'], key=order):
+        lines = samples.setdefault(name, [])
+        cumulative = 0
+        for bound, bucket_count in zip(bounds, counts):
+            cumulative += bucket_count
+            lines.append('%s%s_bucket%s %d' % (PREFIX, name, _format_labels(labels, le=bound), cumulative))
+        lines.append('%s%s_sum%s %r' % (PREFIX, name, _format_labels(labels), total))
+        lines.append('%s%s_count%s %d' % (PREFIX, name, _format_labels(labels), count))
+    output = []
+    for name in sorted(samples):
+        kind, help_text = METRICS.get(name, ('counter', '', None))[:2]
+        full_name = PREFIX + name + ('_total' if kind == 'counter' else '')
+        output.append('# HELP %s %s' % (full_name, help_text))
+        output.append('# TYPE %s %s' % (full_name, kind))
+        output.extend(samples[name])
+    return ('\n'.join(output) + '\n').encode('utf-8')
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        content = exposition(collect(self.server.directory))
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain; version=0.0.4')
+        self.send_header('Content-Length', str(len(content)))
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+def start_server(port, directory=None, host=''):
+    """
+    Serves /metrics from a daemon thread, merging the dumps in `directory` or this process's live metrics
+    """
+    server = Server((host, port), Handler)
+    server.directory = directory
+    thread = threading.Thread(target=server.serve_forever, name='metrics')
+    thread.daemon = True
+    thread.start()
+    logger.info("Serving metrics on port %d", server.server_address[1])
+    return server
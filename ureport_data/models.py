@@ -1,15 +1,30 @@
+import ast
+import calendar
+import hashlib
+import json
 import logging
-from datetime import datetime
+from datetime import datetime, timedelta
+from itertools import islice
 import sys
 
+from bson import ObjectId
 import humongolus as orm
 import humongolus.field as field
 import pymongo
+from pymongo.errors import OperationFailure, DuplicateKeyError, BulkWriteError
 import pytz
-from temba_client.v2 import TembaClient
 from temba_client.exceptions import TembaNoSuchObjectError, TembaException
 from temba_client.v2.types import ObjectRef
 
+from cache import RefCache, MISSING
+import clients
+import frames
+import geo
+import metrics
+from pipeline import Pipeline
+import profiling
+from records import record_class
+import routing
 import settings
 
 logging.basicConfig(format=settings.FORMAT)
@@ -18,27 +33,408 @@ logger = logging.getLogger("models")
 orm.settings(logger=logger, db_connection=settings.CONNECTION)
 
 
+def index(*key, **kwargs):
+    key = [k if isinstance(k, tuple) else (k, pymongo.ASCENDING) for k in key]
+    kwargs.setdefault('background', True)
+    return orm.Index('_'.join('%s_%s' % k for k in key), key=key, **kwargs)
+
+
+def _as_utc(value):
+    if value is not None and value.tzinfo is not None:
+        value = value.astimezone(pytz.utc).replace(tzinfo=None)
+    return value
+
+
+def chunks(l, n):
+    for i in xrange(0, len(l), n):
+        yield l[i:i+n]
+
+
+def iter_chunks(iterable, n):
+    iterator = iter(iterable)
+    chunk = list(islice(iterator, n))
+    while chunk:
+        yield chunk
+        chunk = list(islice(iterator, n))
+
+
+def ref_key(value):
+    return value.uuid if isinstance(value, ObjectRef) else value
+
+
+# bookkeeping fields that are not part of a document's content
+WRITE_FIELDS = ('_id', '_hash', '__created__', '__modified__', '__active__')
+# write error codes of a unique index violation
+DUPLICATE_KEY_CODES = (11000, 11001, 12582)
+
+
+def _hash_default(value):
+    return value.isoformat() if isinstance(value, datetime) else str(value)
+
+
+def content_hash(doc):
+    content = dict((key, value) for key, value in doc.items() if key not in WRITE_FIELDS)
+    return hashlib.md5(json.dumps(content, sort_keys=True, default=_hash_default)).hexdigest()
+
+
+def _comparable(value):
+    # mongo keeps naive UTC datetimes with millisecond precision
+    if isinstance(value, datetime):
+        if value.tzinfo is not None:
+            value = value.astimezone(pytz.utc).replace(tzinfo=None)
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    if isinstance(value, dict):
+        return dict((key, _comparable(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return [_comparable(item) for item in value]
+    return value
+
+
+# converters of the conversion plans, called as converter(obj, key, item class, org, temba value, page refs)
+def _set_value(obj, key, item_class, org, value, refs):
+    setattr(obj, key, value)
+
+
+def _set_references(obj, key, item_class, org, value, refs):
+    item_keys = [ref_key(v) for v in value or [] if v is not None]
+    if refs is not None and item_class in refs:
+        resolved = refs[item_class]
+    else:
+        resolved = item_class.resolve_references(org, item_keys)
+    getattr(obj, key).extend([resolved[k] for k in item_keys if k in resolved])
+
+
+def _set_embedded_list(obj, key, item_class, org, value, refs):
+    getattr(obj, key).extend(item_class.create_from_temba_list(value))
+
+
+def _set_reference(obj, key, item_class, org, value, refs):
+    if refs is not None and item_class in refs:
+        setattr(obj, key, refs[item_class].get(ref_key(value)) if value is not None else None)
+    else:
+        setattr(obj, key, item_class.get_or_fetch(org, value))
+
+
+def _set_embedded(obj, key, item_class, org, value, refs):
+    setattr(obj, key, item_class.create_from_temba(value))
+
+
+def _missing_class(obj, key, item_class, org, value, refs):
+    raise AttributeError("No document class for %s" % key)
+
+
+_conversion_plans = {}
+
+
+def _document_size(obj):
+    return len(repr(obj._json()))
+
+
+ref_cache = RefCache(settings.REF_CACHE_MAX_ENTRIES, settings.REF_CACHE_MAX_BYTES, settings.REF_CACHE_TTL,
+                     settings.REF_CACHE_NEGATIVE_TTL, sizeof=_document_size)
+
+
 class LastSaved(orm.Document):
+    """
+    Sync checkpoint for one (org, collection, flow) stream. modified_on is the committed high-water mark, while a
+    pass is running cursor/pass_after describe where to resume it and pending_modified_on the newest record seen.
+    """
     _db = settings.DATABASE
     _collection = 'last_saveds'
+    _indexes = [index('org.id', 'coll', 'flow', unique=True)]
 
     coll = field.Char()
+    flow = field.Char()
     last_saved = field.TimeStamp()
     org = field.DynamicDocument()
+    modified_on = field.Date()
+    pending_modified_on = field.Date()
+    pass_after = field.Date()
+    pass_started = field.TimeStamp()
+    running = field.Boolean()
+    cursor = field.Char()
 
     @classmethod
-    def update_or_create(cls, collection):
-        obj = cls.find_one({'coll': collection})
+    def get_for(cls, org, collection, flow=None):
+        if isinstance(flow, (list, tuple)):
+            flow = ','.join(sorted(flow))
+        obj = cls.find_one({'org.id': org._id, 'coll': collection, 'flow': flow})
         if not obj:
             obj = cls()
-            obj.collection = collection
-        obj.last_saved = datetime.now()
-        obj.save()
+            obj.org = org
+            obj.coll = collection
+            obj.flow = flow
+        return obj
+
+    @classmethod
+    def last_synced(cls, org, collection):
+        """
+        Returns {flow: when its last pass started} for every stream of an org's collection, the last save for streams
+        synced before passes recorded their start
+        """
+        docs = cls._connection().find({'org.id': org._id, 'coll': collection}, as_dict=True,
+                                      fields={'flow': 1, 'last_saved': 1, 'pass_started': 1, '_id': 0})
+        return dict((doc.get('flow'), doc.get('pass_started') or doc.get('last_saved')) for doc in docs)
+
+    @classmethod
+    def running_passes(cls, org, collection, stale=None):
+        """
+        The flows of an org's collection with a pass that isn't complete and was saved in the last `stale` seconds
+        (SYNC_PASS_STALE_SECONDS), passes that are still being synced or retried
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=settings.SYNC_PASS_STALE_SECONDS if stale is None else stale)
+        docs = cls._connection().find({'org.id': org._id, 'coll': collection, 'running': True,
+                                       'last_saved': {'$gte': cutoff}}, as_dict=True, fields={'flow': 1, '_id': 0})
+        return set(doc.get('flow') for doc in docs)
+
+    @property
+    def after(self):
+        return pytz.utc.localize(self.modified_on) if self.modified_on else None
+
+    def can_resume(self, af=None):
+        return bool(self.cursor) and (not af or self.pass_after is None)
+
+    def start(self, after):
+        self.pass_after = _as_utc(after)
+        self.cursor = None
+        self.pending_modified_on = None
+        self.pass_started = self.last_saved = datetime.utcnow()
+        self.running = True
+        self.save()
+
+    def commit_page(self, cursor, temba_list):
+        for temba in temba_list:
+            seen = _as_utc(getattr(temba, 'modified_on', None) or getattr(temba, 'created_on', None))
+            if seen and (not self.pending_modified_on or seen > self.pending_modified_on):
+                self.pending_modified_on = seen
+        self.cursor = cursor
+        self.last_saved = datetime.utcnow()
+        self.save()
+
+    def complete(self):
+        if self.pending_modified_on and (not self.modified_on or self.pending_modified_on > self.modified_on):
+            self.modified_on = self.pending_modified_on
+        self.pending_modified_on = None
+        self.pass_after = None
+        self.cursor = None
+        self.running = False
+        self.last_saved = datetime.utcnow()
+        self.save()
+
+
+class Backfill(orm.Document):
+    """
+    One date window of a time sliced backfill of an (org, collection, flow) stream. Windows are synced as separate
+    tasks through the API's after/before filters, each resuming from its own cursor like LastSaved does, and writes
+    are merged like any page's. Once every window of a backfill is done the stream's LastSaved moves to the backfill's
+    end, `until`, and incremental syncs carry on from there.
+    """
+    _db = settings.DATABASE
+    _collection = 'backfills'
+    _indexes = [index('org.id', 'coll', 'flow', 'until', 'after', unique=True), index('status')]
+
+    PENDING, RUNNING, DONE, FAILED = STATUSES = ('pending', 'running', 'done', 'failed')
+
+    org = field.DynamicDocument()
+    entity = field.Char()
+    coll = field.Char()
+    flow = field.Char()
+    after = field.Date()
+    before = field.Date()
+    until = field.Date()
+    status = field.Char()
+    cursor = field.Char()
+    attempts = field.Integer()
+    fetched = field.Integer()
+    created = field.Integer()
+    error = field.Char()
+    started_on = field.Date()
+    finished_on = field.Date()
+    last_saved = field.Date()
+
+    @classmethod
+    def history_start(cls, org, flow=None):
+        """
+        Where the windows of a stream start: the flow's creation for its runs, BACKFILL_START otherwise
+        """
+        if flow:
+            flows = Flow.find_raw({'org.id': org._id, 'uuid': flow}, fields=['created_on'], limit=1)
+            if flows and flows[0].get('created_on'):
+                return _as_utc(flows[0]['created_on'])
+        return datetime.strptime(settings.BACKFILL_START, '%Y-%m-%d')
+
+    @classmethod
+    @routing.routed
+    def plan(cls, org, entity, flow=None, start=None, until=None, days=None):
+        """
+        Splits a stream's history up to `until`, now by default, into windows of `days` days from `start` on, the
+        oldest window being open ended so nothing older is missed. Returns the windows to dispatch: the new ones, or
+        the failed and stalled ones of the stream's backfill still in progress instead of planning another.
+        """
+        coll = getattr(sys.modules[__name__], entity)._collection
+        if cls.windows_left(org, coll, flow=flow):
+            return cls.unfinished(org, coll=coll, flow=flow)
+        now = datetime.utcnow()
+        until = _as_utc(until) or now
+        start = _as_utc(start) or cls.history_start(org, flow=flow)
+        step = timedelta(days=days or settings.BACKFILL_WINDOW_DAYS)
+        windows = []
+        before = until
+        while before is not None:
+            after = before - step if before - step > start else None
+            window = cls()
+            window.org = org
+            window.entity = entity
+            window.coll = coll
+            window.flow = flow
+            window.after = after
+            window.before = before
+            window.until = until
+            window.status = cls.PENDING
+            window.attempts = window.fetched = window.created = 0
+            window.last_saved = now
+            window.save()
+            windows.append(window)
+            before = after
+        logger.info("Planned a backfill of %s for Org: %s in %d windows", coll, org.name, len(windows))
+        return windows
+
+    @classmethod
+    def windows_left(cls, org, coll, flow=None):
+        """
+        Whether a backfill of the stream has windows that are not done
+        """
+        query = {'org.id': org._id, 'coll': coll, 'flow': flow, 'status': {'$ne': cls.DONE}}
+        return bool(cls._connection().find(query).count())
+
+    @classmethod
+    def in_progress(cls, org, coll, flow=None, stale=None):
+        """
+        Whether a backfill of the stream has windows pending or running that were saved in the last `stale` seconds
+        (BACKFILL_STALE_SECONDS). Failed and stalled windows wait for retry_backfill and don't hold up incremental
+        syncs.
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=settings.BACKFILL_STALE_SECONDS if stale is None else stale)
+        query = {'org.id': org._id, 'coll': coll, 'flow': flow, 'status': {'$in': [cls.PENDING, cls.RUNNING]},
+                 'last_saved': {'$gte': cutoff}}
+        return bool(cls._connection().find(query).count())
+
+    @classmethod
+    def unfinished(cls, org, coll=None, flow=None, stale=None):
+        """
+        The org's windows that failed or have not been saved in `stale` seconds (BACKFILL_STALE_SECONDS) while
+        pending or running, the ones to dispatch again
+        """
+        cutoff = datetime.utcnow() - timedelta(seconds=settings.BACKFILL_STALE_SECONDS if stale is None else stale)
+        query = {'org.id': org._id, '$or': [{'status': cls.FAILED},
+                                            {'status': {'$in': [cls.PENDING, cls.RUNNING]},
+                                             'last_saved': {'$lt': cutoff}}]}
+        if coll:
+            query.update({'coll': coll, 'flow': flow})
+        return list(cls.find(query))
+
+    @property
+    def label(self):
+        return '%s..%s' % (self.after.isoformat() if self.after else '', self.before.isoformat())
+
+    @routing.routed
+    def sync(self, org):
+        """
+        Syncs the window from its cursor, returns the number of documents created
+        """
+        entity = getattr(sys.modules[__name__], self.entity)
+        self.status = self.RUNNING
+        self.attempts = (self.attempts or 0) + 1
+        self.started_on = self.started_on or datetime.utcnow()
+        self.last_saved = datetime.utcnow()
+        self.error = None
+        self.save()
+        kwargs = {'flows': self.flow} if self.flow else {}
+        after = pytz.utc.localize(self.after) if self.after else None
+        try:
+            temba_lists = entity.fetch_temba_lists(org, after=after, before=pytz.utc.localize(self.before), **kwargs)
+            created = entity.create_from_temba_list(org, temba_lists, checkpoint=self,
+                                                    pipelined=settings.PIPELINE_SYNC)
+        except Exception as e:
+            self.status = self.FAILED
+            self.error = str(e)
+            self.last_saved = datetime.utcnow()
+            self.save()
+            raise
+        self.created = (self.created or 0) + created
+        self.save()
+        self.finish_backfill(org)
+        return created
+
+    def commit_page(self, cursor, temba_list):
+        self.fetched = (self.fetched or 0) + len(temba_list)
+        self.cursor = cursor
+        self.last_saved = datetime.utcnow()
+        self.save()
+
+    def complete(self):
+        self.status = self.DONE
+        self.cursor = None
+        self.finished_on = self.last_saved = datetime.utcnow()
+        self.save()
+
+    def finish_backfill(self, org):
+        """
+        Moves the stream's checkpoint to the backfill's end once none of its windows is left, returns whether it did
+        """
+        query = {'org.id': org._id, 'coll': self.coll, 'flow': self.flow, 'until': self.until,
+                 'status': {'$ne': self.DONE}}
+        if self._connection().find(query).count():
+            return False
+        checkpoint = LastSaved.get_for(org, self.coll, flow=self.flow)
+        if not checkpoint.modified_on or checkpoint.modified_on < self.until:
+            checkpoint.modified_on = self.until
+        checkpoint.last_saved = datetime.utcnow()
+        checkpoint.save()
+        logger.info("Backfill of %s for Org: %s is done", self.coll, org.name)
+        return True
+
+    @classmethod
+    def progress(cls, org=None, now=None):
+        """
+        Progress of every backfill, or of one org's: windows by status, records fetched and documents created, and the
+        seconds left at the rate windows have been finishing since the backfill started
+        """
+        now = now or datetime.utcnow()
+        reports = {}
+        query = {'org.id': org._id} if org else {}
+        for doc in cls._connection().find(query, as_dict=True, fields={'_id': 0, 'cursor': 0, 'error': 0}):
+            key = (doc['org']['id'], doc['coll'], doc.get('flow'), doc['until'])
+            report = reports.get(key)
+            if report is None:
+                report = reports[key] = {'org': doc['org']['id'], 'coll': doc['coll'], 'flow': doc.get('flow'),
+                                         'until': doc['until'], 'windows': 0, 'fetched': 0, 'created': 0,
+                                         'started_on': None}
+                report.update((status, 0) for status in cls.STATUSES)
+            report['windows'] += 1
+            report[doc['status']] += 1
+            report['fetched'] += doc.get('fetched') or 0
+            report['created'] += doc.get('created') or 0
+            if doc.get('started_on') and (not report['started_on'] or doc['started_on'] < report['started_on']):
+                report['started_on'] = doc['started_on']
+        for report in reports.values():
+            remaining = report['windows'] - report[cls.DONE]
+            elapsed = (now - report['started_on']).total_seconds() if report['started_on'] else None
+            report['percent'] = round(100.0 * report[cls.DONE] / report['windows'], 1)
+            if not remaining:
+                report['eta_seconds'] = 0
+            elif elapsed and report[cls.DONE]:
+                report['eta_seconds'] = int(elapsed * remaining / report[cls.DONE])
+            else:
+                report['eta_seconds'] = None
+        return sorted(reports.values(), key=lambda report: (report['org'], report['coll'], report['flow'],
+                                                            report['until']))
 
 
 class Org(orm.Document):
     _db = settings.DATABASE
     _collection = "orgs"
+    _indexes = [index('api_token'), index('is_active')]
 
     name = field.Char(required=True)
     language = field.Char()
@@ -46,22 +442,100 @@ class Org(orm.Document):
     api_token = field.Char(required=True)
     is_active = field.Boolean(default=True)
     config = field.Char()
+    # layout of the org's synced documents, see routing; orgs without one use the shared collections
+    storage = field.Char()
+    namespace = field.Char()
 
     def get_temba_client(self):
-        agent = getattr(settings, 'SITE_API_USER_AGENT', None)
-        return TembaClient('https://app.rapidpro.io', self.api_token, user_agent=agent)
+        return clients.get_client(self.api_token)
+
+    def relocate(self, storage, namespace=None, batch_size=None):
+        """
+        Moves the org's synced documents to another storage layout (see routing), copying them one _id ordered batch at
+        a time before switching the org over and removing the old copies: collections and databases of the org's own
+        are dropped, shared ones are cleared batch by batch. Copies are upserts, so an interrupted move can be run
+        again. Pause the org's syncs meanwhile, anything written to the old place after its copy is left behind.
+        Returns {collection: documents moved}.
+        """
+        if storage not in routing.LAYOUTS:
+            raise ValueError("Unknown storage %s, use one of %s" % (storage, ', '.join(routing.LAYOUTS)))
+        batch_size = batch_size or settings.RELOCATE_BATCH_SIZE
+        source = {'storage': self.storage or routing.SHARED, 'namespace': self.namespace}
+        target = {'storage': storage, 'namespace': namespace or self.namespace}
+        moves = []
+        for cls in BaseDocument.__subclasses__():
+            old = routing.collection(cls, self._id, **source)
+            new = routing.collection(cls, self._id, **target)
+            if old.full_name != new.full_name:
+                moves.append((cls, old, new))
+
+        moved = {}
+        for cls, old, new in moves:
+            ensure_collection_indexes(cls, new)
+            query = {'org.id': self._id}
+            copied = 0
+            while True:
+                docs = list(old.find(query, as_dict=True).sort('_id', pymongo.ASCENDING).limit(batch_size))
+                if not docs:
+                    break
+                bulk = new.initialize_unordered_bulk_op()
+                for doc in docs:
+                    bulk.find({'_id': doc['_id']}).upsert().replace_one(doc)
+                bulk.execute()
+                copied += len(docs)
+                query['_id'] = {'$gt': docs[-1]['_id']}
+                logger.info("Copied %d %s of Org: %s to %s", copied, cls._collection, self.name, new.full_name)
+            moved[cls._collection] = copied
+
+        self.storage = target['storage']
+        self.namespace = target['namespace']
+        self.save()
+        routing.register(self)
+
+        for cls, old, new in moves:
+            if source['storage'] == routing.COLLECTION:
+                old.drop()
+                continue
+            while True:
+                ids = [doc['_id'] for doc in old.find({'org.id': self._id}, as_dict=True, fields={'_id': 1})
+                       .limit(batch_size)]
+                if not ids:
+                    break
+                old.remove({'_id': {'$in': ids}})
+        if moves and source['storage'] == routing.DATABASE:
+            settings.CONNECTION.drop_database(moves[0][1].database.name)
+        logger.info("Relocated Org: %s to %s storage - %s", self.name, self.storage, moved)
+        return moved
+
+    def load_frame(self, collection, fields=None, since=None, flow=None, **kwargs):
+        """
+        Loads one of the org's collections into a pandas DataFrame straight from mongo, see frames.load_frame for
+        explode, chunksize, max_bytes and iterator.
+        """
+        classes = dict((cls._collection, cls) for cls in BaseDocument.__subclasses__())
+        query = {'org.id': self._id}
+        if since:
+            query['created_on'] = {'$gte': since}
+        if flow:
+            query['flow'] = getattr(flow, 'uuid', flow)
+        with routing.using(self):
+            return frames.load_frame(classes[collection], query, fields=fields, **kwargs)
 
     @classmethod
     def create(cls, **kwargs):
+        kwargs.setdefault('storage', settings.ORG_STORAGE)
         org = cls()
         for k,v in kwargs.items():
             setattr(org, k, v)
         org.save()
+        if org.storage in (routing.COLLECTION, routing.DATABASE):
+            ensure_indexes(BaseDocument.__subclasses__(), orgs=[org])
         return org
 
 
 class BaseDocument(orm.Document):
     _db = settings.DATABASE
+    _indexes = [index('org.id', ('created_on', pymongo.DESCENDING)), index('org.id', '__modified__')]
     fetch_key = 'uuid'
 
     org = field.DynamicDocument()
@@ -69,122 +543,555 @@ class BaseDocument(orm.Document):
     org_oid = field.ObjectId()
 
     @classmethod
-    def create_from_temba(cls, org, temba):
+    def _connection(cls):
+        return routing.collection(cls)
+
+    def _route(self):
+        # documents are written to their own org's storage, wherever they were read or built
+        org = self._get('org')._value
+        if org:
+            self._coll = routing.collection(type(self), org['id'])
+
+    def _get_doc(self, id):
+        return self._coll.find_one({'_id': ObjectId(id)}, as_dict=True)
+
+    def save(self):
+        self._route()
+        return super(BaseDocument, self).save()
+
+    @classmethod
+    def conversion_plan(cls):
+        """
+        Returns {temba attribute: (converter, item class)}, the steps build_from_temba takes for a record. It is
+        compiled from the class attributes on first use, once the classes it refers to all exist.
+        """
+        plan = _conversion_plans.get(cls)
+        if plan is None:
+            plan = {}
+            module = sys.modules[__name__]
+            for key in dir(cls):
+                class_attr = getattr(cls, key, None)
+                if class_attr is None:
+                    continue
+                if isinstance(class_attr, orm.List):
+                    item_class = getattr(module, key.rstrip('s').capitalize(), None)
+                    converters = _set_references, _set_embedded_list
+                elif class_attr == field.DynamicDocument:
+                    item_class = getattr(module, key.capitalize(), None)
+                    converters = _set_reference, _set_embedded
+                else:
+                    plan[key] = (_set_value, None)
+                    continue
+                if not isinstance(item_class, type):
+                    plan[key] = (_missing_class, None)
+                elif issubclass(item_class, BaseDocument):
+                    plan[key] = (converters[0], item_class)
+                elif issubclass(item_class, orm.EmbeddedDocument):
+                    plan[key] = (converters[1], item_class)
+            _conversion_plans[cls] = plan
+        return plan
+
+    @classmethod
+    def reference_fields(cls):
+        """
+        Returns [(attribute, referenced class, is list)] for every attribute that points at another BaseDocument
+        """
+        return [(key, item_class, converter is _set_references)
+                for key, (converter, item_class) in sorted(cls.conversion_plan().items())
+                if converter in (_set_references, _set_reference) and key != 'org']
+
+    @classmethod
+    def resolve_page_references(cls, org, temba_list):
+        """
+        Collects every reference made by a page of temba objects and resolves them with one lookup per referenced
+        class. Returns {referenced class: {key: document}} for build_from_temba.
+        """
+        keys = {}
+        for key, item_class, many in cls.reference_fields():
+            page_keys = keys.setdefault(item_class, set())
+            for temba in temba_list:
+                value = getattr(temba, key, None)
+                page_keys.update(ref_key(v) for v in (value or [] if many else [value]) if v is not None)
+        return dict((item_class, item_class.resolve_references(org, list(page_keys)))
+                    for item_class, page_keys in keys.items())
+
+    @classmethod
+    def build_from_temba(cls, org, temba, refs=None):
         obj = cls()
         obj.org = org
-        for key, value in temba.__dict__.items():
-            class_attr = getattr(cls, key, None)
-            temba_attr = getattr(temba, key)
-            if class_attr is None:
-                continue
-            if isinstance(class_attr, orm.List):
-                item_class = getattr(sys.modules[__name__], key.rstrip('s').capitalize())
-                if issubclass(item_class, BaseDocument):
-                    getattr(obj, key).extend(item_class.get_objects_from_uuids(org, temba_attr))
-                if issubclass(item_class, orm.EmbeddedDocument):
-                    getattr(obj, key).extend(item_class.create_from_temba_list(temba_attr))
-            elif class_attr == field.DynamicDocument:
-                item_class = getattr(sys.modules[__name__], key.capitalize())
-                if issubclass(item_class, BaseDocument):
-                    setattr(obj, key, item_class.get_or_fetch(org, temba_attr))
-                if issubclass(item_class, orm.EmbeddedDocument):
-                    setattr(obj, key, item_class.create_from_temba(temba_attr))
+        plan = cls.conversion_plan()
+        for key, value in temba.__dict__.iteritems():
+            step = plan.get(key)
+            if step is not None:
+                step[0](obj, key, step[1], org, value, refs)
+        return obj
 
-            else:
-                setattr(obj, key, value)
+    @classmethod
+    @routing.routed
+    def create_from_temba(cls, org, temba):
+        obj = cls.build_from_temba(org, temba)
         obj.save()
         return obj
 
+    def to_insert(self):
+        """
+        Validates the document and returns the dict that save() would insert for it
+        """
+        return self.to_write()[0]
+
+    def to_write(self):
+        """
+        Returns the dict to insert, carrying the hash of the synced content, and the fields save() filled with
+        defaults (empty TimeStamps), which updates leave alone
+        """
+        errors = self._errors()
+        if len(errors.keys()):
+            self.logger.error(errors)
+            raise orm.DocumentException(errors)
+        content = self._json()
+        self._save()
+        now = datetime.utcnow()
+        doc = self._json()
+        defaults = [key for key, value in doc.items() if value is not None and content.get(key) is None]
+        doc['_hash'] = content_hash(content)
+        doc['__created__'] = now
+        doc['__modified__'] = now
+        doc['__active__'] = True
+        return doc, defaults
+
     @classmethod
+    def changes_from(cls, doc, old, defaults=()):
+        """
+        The update turning the stored document `old` into `doc`: a $set of the fields that differ and an $unset of the
+        ones doc doesn't have anymore
+        """
+        changes = {}
+        for key, value in doc.items():
+            if key in ('_id', '__created__') or (key in defaults and key in old):
+                continue
+            if _comparable(value) != _comparable(old.get(key)):
+                changes[key] = value
+        update = {'$set': changes}
+        removed = dict((key, '') for key in old if key not in doc and key not in WRITE_FIELDS)
+        if removed:
+            update['$unset'] = removed
+        return update
+
+    @classmethod
+    def stored_versions(cls, org, writes):
+        """
+        Looks up the stored documents of a page of (doc, defaults) writes by fetch key. Returns {key: _id} of every
+        stored one and {key: stored document} of those whose content hash differs.
+        """
+        key = cls.fetch_key
+        values = list(set(doc[key] for doc, _ in writes if key and doc.get(key) is not None))
+        if not values:
+            return {}, {}
+        hashes = dict((doc[key], doc['_hash']) for doc, _ in writes if doc.get(key) is not None)
+        ids, changed = {}, []
+        for doc in cls.find_raw({'org.id': org._id, key: {'$in': values}}, fields=['_id', key, '_hash']):
+            ids[doc[key]] = doc['_id']
+            if doc.get('_hash') != hashes[doc[key]]:
+                changed.append(doc[key])
+        previous = {}
+        if changed:
+            with profiling.span('mongo.find.%s' % cls._collection):
+                for doc in cls._connection().find({'org.id': org._id, key: {'$in': changed}}, as_dict=True):
+                    previous[doc[key]] = doc
+        return ids, previous
+
+    @classmethod
+    @routing.routed
+    def bulk_upsert(cls, org, objs, ordered=False, created=None, updated=None):
+        """
+        Writes a page of unsaved documents in a single bulk operation keyed on (org, fetch_key). New documents are
+        inserted, stored ones whose content hash changed get a $set of the fields that differ and unchanged ones are
+        skipped without a write. Every document gets its _id set. New documents are appended to `created` and
+        (document, previous stored version) pairs to `updated` when given. Returns the page summary. A document another
+        writer stored first trips the unique fetch key index and is counted as skipped, like one that was stored
+        already.
+        """
+        summary = {'inserted': 0, 'updated': 0, 'skipped': 0, 'matched': 0, 'modified': 0}
+        if not objs:
+            return summary
+        key = cls.fetch_key
+        writes = [obj.to_write() for obj in objs]
+        ids, previous = cls.stored_versions(org, writes)
+        coll = cls._connection()
+        bulk = coll.initialize_ordered_bulk_op() if ordered else coll.initialize_unordered_bulk_op()
+        operations = []
+        inserts = {}
+        changed = {}
+        for position, (obj, (doc, defaults)) in enumerate(zip(objs, writes)):
+            value = doc.get(key) if key else None
+            if value is None:
+                bulk.insert(doc)
+                inserts[position] = doc
+            elif value in previous:
+                old = previous.pop(value)
+                obj._id = old['_id']
+                bulk.find({'_id': old['_id']}).update_one(cls.changes_from(doc, old, defaults))
+                changed[position] = old
+            elif value in ids:
+                obj._id = ids[value]
+                summary['skipped'] += 1
+                continue
+            else:
+                bulk.find({'org.id': org._id, key: value}).upsert().update_one({'$setOnInsert': doc})
+            operations.append(position)
+        if not operations:
+            return summary
+        with profiling.span('mongo.bulk_upsert.%s' % cls._collection):
+            try:
+                result = bulk.execute()
+            except BulkWriteError as e:
+                result = e.details
+                if any(error.get('code') not in DUPLICATE_KEY_CODES for error in result.get('writeErrors', [])):
+                    raise
+        duplicates = [operations[error['index']] for error in result.get('writeErrors', [])]
+        # an ordered bulk stops at its first error, the writes after it go again below
+        rest = [position for position in operations if position > duplicates[0]] if ordered and duplicates else []
+        written = set(operations) - set(duplicates) - set(rest)
+        new = [objs[operations[upserted['index']]] for upserted in result.get('upserted', [])]
+        for upserted, obj in zip(result.get('upserted', []), new):
+            obj._id = upserted['_id']
+        for position, doc in sorted(inserts.items()):
+            if position in written:
+                objs[position]._id = doc['_id']
+                new.append(objs[position])
+        if created is not None:
+            created.extend(new)
+        for position, old in sorted(changed.items()):
+            if position in written:
+                summary['updated'] += 1
+                if updated is not None:
+                    updated.append((objs[position], cls.decode_raw(old)))
+        summary['inserted'] = result.get('nInserted', 0) + result.get('nUpserted', 0)
+        summary['matched'] = result.get('nMatched', 0)
+        summary['modified'] = result.get('nModified') or 0
+        if duplicates:
+            summary['skipped'] += len(duplicates)
+            cls.stored_ids(org, [objs[position] for position in duplicates])
+        if rest:
+            for name, count in cls.bulk_upsert(org, [objs[position] for position in rest], ordered=True,
+                                               created=created, updated=updated).items():
+                summary[name] += count
+        return summary
+
+    @classmethod
+    def stored_ids(cls, org, objs):
+        """
+        Sets the _id of documents another writer stored first to the stored one's
+        """
+        key = cls.fetch_key
+        values = dict((getattr(obj, key, None), obj) for obj in objs) if key else {}
+        values.pop(None, None)
+        if values:
+            for doc in cls.find_raw({'org.id': org._id, key: {'$in': list(values)}}, fields=['_id', key]):
+                values[doc[key]]._id = doc['_id']
+
+    @classmethod
+    @routing.routed
     def get_or_fetch(cls, org, uuid):
         if uuid == None: return None
-        if hasattr(cls, 'uuid'):
-            obj = cls.find_one({'uuid': uuid.uuid}) if isinstance(uuid, ObjectRef) else cls.find_one({'uuid': uuid})
-            if cls == Label:
-                obj = cls.find_one({'name': uuid})
-        else:
-            obj = cls.find_one({'id': uuid})
+        cache_key = (org._id, cls.__name__, uuid.uuid if isinstance(uuid, ObjectRef) else uuid)
+        obj = ref_cache.get(cache_key)
+        if obj is MISSING:
+            metrics.inc('reference_lookups', reference=cls.__name__, result='miss')
+            return None
+        if obj is not None:
+            metrics.inc('reference_lookups', reference=cls.__name__, result='cache_hit')
+            return obj
+        result = 'db_hit'
+        with profiling.span('mongo.find_one.%s' % cls._collection):
+            if hasattr(cls, 'uuid'):
+                obj = cls.find_one({'uuid': uuid.uuid}) if isinstance(uuid, ObjectRef) else cls.find_one({'uuid': uuid})
+                if cls == Label:
+                    obj = cls.find_one({'name': uuid})
+            else:
+                obj = cls.find_one({'id': uuid})
         if not obj:
+            result = 'api_fetch'
             try:
                 obj = cls.fetch(org, uuid.uuid) if isinstance(uuid, ObjectRef) else cls.fetch(org, uuid)
             except AttributeError:
                 obj = uuid.uuid if isinstance(uuid, ObjectRef) else uuid
-            except (TembaNoSuchObjectError, TembaException):
+            except TembaNoSuchObjectError:
+                ref_cache.set_missing(cache_key)
                 obj = None
+            except TembaException:
+                obj = None
+        if isinstance(obj, BaseDocument):
+            ref_cache.set(cache_key, obj)
+        metrics.inc('reference_lookups', reference=cls.__name__, result=result if obj else 'miss')
         return obj
 
     @classmethod
-    def create_from_temba_list(cls, org, temba_lists):
-        obj_list = []
-        for temba_list in temba_lists.iterfetches():
-            if len(temba_list) > 0 and hasattr(temba_list[0], 'contact'):
-                contacts = [t.contact for t in temba_list]
-                Contact.get_objects_from_uuids(org, contacts)
-            q = None
-            for temba in temba_list:
-                if hasattr(temba, 'uuid'):
-                    q = {'uuid': temba.uuid}
-                elif hasattr(temba, 'id'):
-                    q = {'id': temba.id}
-                if not q or not cls.find_one(q):
-                    obj_list.append(cls.create_from_temba(org, temba))
-        return obj_list
+    def iter_raw(cls, query, fields=None, sort=None, batch_size=None, limit=0, record=False):
+        """
+        Reads documents straight from the cursor without building humongolus documents. `fields` is a list of
+        (dotted) paths to project, _id is left out unless asked for. Yields plain dicts or, with record=True, slotted
+        records with one attribute per field.
+        """
+        projection = None
+        if fields:
+            projection = dict((f, 1) for f in cls.raw_fields(fields))
+            projection.setdefault('_id', 0)
+        elif record:
+            raise ValueError("Records need the fields to project")
+        cursor = cls._connection().find(query, as_dict=True, fields=projection, limit=limit)
+        cursor = cursor.batch_size(batch_size or settings.RAW_BATCH_SIZE)
+        if sort:
+            cursor = cursor.sort(sort)
+        docs = (cls.decode_raw(doc) for doc in cursor)
+        if not record:
+            return docs
+        record_type = record_class(cls.__name__, fields)
+        return (record_type(doc) for doc in docs)
 
     @classmethod
-    def _in_not_in(cls, uuids):
-        uuids = [u.uuid for u in uuids]
-        k = cls.fetch_key.rstrip('s')
-        objs = list(cls.find({k: {'$in': uuids}}))
-        e_uuids = [getattr(c, k) for c in objs]
-        return objs, list(set(uuids)-set(e_uuids))
+    def raw_fields(cls, fields):
+        """
+        The projection needed to read `fields`, documents stored encoded add whatever decoding them needs
+        """
+        return fields
 
     @classmethod
-    def get_objects_from_uuids(cls, org, uuids):
-        func = "get_%s" % cls._collection
-        client = org.get_temba_client()
-        fetch_all = getattr(client, func)
-        objs, not_in = cls._in_not_in(uuids)
+    def decode_raw(cls, doc):
+        return doc
 
-        def chunks(l, n):
-            for i in xrange(0, len(l), n):
-                yield l[i:i+n]
+    @classmethod
+    def find_raw(cls, query, fields=None, sort=None, batch_size=None, limit=0, record=False):
+        with profiling.span('mongo.find.%s' % cls._collection):
+            return list(cls.iter_raw(query, fields=fields, sort=sort, batch_size=batch_size, limit=limit,
+                                     record=record))
+
+    @classmethod
+    def convert_page(cls, org, temba_list):
+        refs = cls.resolve_page_references(org, temba_list)
+        return [cls.build_from_temba(org, temba, refs=refs) for temba in temba_list]
 
+    @classmethod
+    def write_page(cls, org, objs, bulk=True, ordered=False):
+        """
+        Persists a converted page. Returns the documents that were newly created and (document, previous version)
+        pairs for the ones that changed.
+        """
+        created, updated = [], []
+        if bulk:
+            summary = cls.bulk_upsert(org, objs, ordered=ordered, created=created, updated=updated)
+            logger.info("Wrote page of %d %s for Org: %s - %s", len(objs), cls._collection, org.name, summary)
+        else:
+            key = cls.fetch_key
+            writes = [obj.to_write() for obj in objs]
+            ids, previous = cls.stored_versions(org, writes)
+            coll = cls._connection()
+            for obj, (doc, defaults) in zip(objs, writes):
+                value = doc.get(key) if key else None
+                with profiling.span('mongo.save.%s' % cls._collection):
+                    if value in previous:
+                        old = previous.pop(value)
+                        obj._id = old['_id']
+                        coll.update({'_id': old['_id']}, cls.changes_from(doc, old, defaults))
+                        updated.append((obj, cls.decode_raw(old)))
+                    elif value is not None and value in ids:
+                        obj._id = ids[value]
+                    else:
+                        try:
+                            obj._id = coll.insert(doc)
+                        except DuplicateKeyError:
+                            # another writer stored it first
+                            cls.stored_ids(org, [obj])
+                            continue
+                        ids[value] = obj._id
+                        created.append(obj)
+        with profiling.span('after_write.%s' % cls._collection):
+            cls.after_write(org, created, updated)
+        return created, updated
+
+    @classmethod
+    def after_write(cls, org, created, updated=()):
+        """
+        Called with the documents a page write created and the (document, previous version) pairs it updated, for
+        state derived from synced data
+        """
+        pass
+
+    @classmethod
+    @routing.routed
+    def create_from_temba_list(cls, org, temba_lists, bulk=None, ordered=None, checkpoint=None, pipelined=False,
+                               materialize=False):
+        """
+        Syncs every page of temba_lists and returns the number of documents created. Only the pages in flight are held
+        so memory is bounded by the page size, materialize=True returns the created documents instead of their count.
+        """
+        if bulk is None:
+            bulk = settings.BULK_WRITES
+        if ordered is None:
+            ordered = settings.BULK_WRITES_ORDERED
+        obj_list = [] if materialize else None
+        totals = {'created': 0}
+        fetches = temba_lists.iterfetches(resume_cursor=checkpoint.cursor if checkpoint else None)
+        entity = cls.__name__
+
+        def pages():
+            for temba_list in fetches:
+                # the resume cursor has to be read right after each fetch, the fetcher may run pages ahead of the writer
+                cursor = fetches.get_cursor()
+                metrics.inc('pages_fetched', entity=entity)
+                yield temba_list, cursor
+
+        def convert(page):
+            temba_list, cursor = page
+            objs = cls.convert_page(org, temba_list)
+            metrics.inc('records_converted', len(objs), entity=entity)
+            return temba_list, cursor, objs
+
+        def write(converted):
+            temba_list, cursor, objs = converted
+            created, updated = cls.write_page(org, objs, bulk=bulk, ordered=ordered)
+            metrics.inc('documents_written', len(created), entity=entity)
+            metrics.inc('documents_updated', len(updated), entity=entity)
+            metrics.inc('documents_skipped', len(objs) - len(created) - len(updated), entity=entity)
+            totals['created'] += len(created)
+            if obj_list is not None:
+                obj_list.extend(created)
+            if checkpoint:
+                with profiling.span('mongo.checkpoint'):
+                    checkpoint.commit_page(cursor, temba_list)
+
+        if pipelined:
+            Pipeline(pages(), [convert, write], queue_size=settings.PIPELINE_PREFETCH_PAGES).run()
+        else:
+            for page in pages():
+                write(convert(page))
+        if checkpoint:
+            checkpoint.complete()
+        return obj_list if materialize else totals['created']
+
+    @classmethod
+    def _in_not_in(cls, org, keys):
+        k = cls.fetch_key.rstrip('s')
+        docs = cls.find_raw({'org.id': org._id, k: {'$in': keys}})
+        e_keys = [doc.get(k) for doc in docs]
+        objs = [cls(data=doc) for doc in docs]
+        return objs, list(set(keys)-set(e_keys))
+
+    @classmethod
+    @routing.routed
+    def resolve_references(cls, org, keys):
+        """
+        Resolves references to this class from the cache, then with one $in query and finally with an API fetch
+        of each key that is still unknown. Returns {key: document}; keys the API doesn't know are negatively cached.
+        """
+        resolved = {}
+        pending = []
+        missing = 0
+        for key in set(keys):
+            obj = ref_cache.get((org._id, cls.__name__, key))
+            if obj is MISSING:
+                missing += 1
+            elif obj is not None:
+                resolved[key] = obj
+            else:
+                pending.append(key)
+        metrics.inc('reference_lookups', len(resolved), reference=cls.__name__, result='cache_hit')
+        if not pending or not cls.fetch_key:
+            metrics.inc('reference_lookups', missing + len(pending), reference=cls.__name__, result='miss')
+            return resolved
+
+        objs, not_in = cls._in_not_in(org, pending)
+        db_hits = len(objs)
         if not_in:
-            for chunk in chunks(not_in, getattr(settings, 'FETCH_MAX_UUIDS', 50)):
-                objs.append(cls.create_from_temba_list(org, fetch_all(**{cls.fetch_key: chunk})))
-        return objs
+            fetch_all = getattr(org.get_temba_client(), "get_%s" % cls._collection)
+            # the API filters on a single uuid or id, so every unknown key is a request of its own
+            for key in not_in:
+                try:
+                    objs.extend(cls.create_from_temba_list(org, fetch_all(**{cls.fetch_key: key}), materialize=True))
+                except TembaNoSuchObjectError:
+                    pass
+            metrics.inc('reference_lookups', len(objs) - db_hits, reference=cls.__name__, result='api_fetch')
+            # pages written concurrently by another worker are matched rather than inserted, pick those up too
+            fetched = set(getattr(obj, cls.fetch_key) for obj in objs)
+            late = [key for key in not_in if key not in fetched]
+            if late:
+                late_objs = cls._in_not_in(org, late)[0]
+                db_hits += len(late_objs)
+                objs.extend(late_objs)
+        metrics.inc('reference_lookups', db_hits, reference=cls.__name__, result='db_hit')
+        for obj in objs:
+            key = getattr(obj, cls.fetch_key)
+            resolved[key] = obj
+            ref_cache.set((org._id, cls.__name__, key), obj)
+        for key in pending:
+            if key not in resolved:
+                missing += 1
+                ref_cache.set_missing((org._id, cls.__name__, key))
+        metrics.inc('reference_lookups', missing, reference=cls.__name__, result='miss')
+        return resolved
+
+    @classmethod
+    def iter_objects_from_uuids(cls, org, uuids):
+        """
+        Yields the documents uuids refer to, resolving FETCH_MAX_UUIDS of them at a time
+        """
+        for chunk in iter_chunks((ref_key(u) for u in uuids if u is not None), settings.FETCH_MAX_UUIDS):
+            for obj in cls.resolve_references(org, chunk).values():
+                yield obj
+
+    @classmethod
+    def get_objects_from_uuids(cls, org, uuids):
+        return list(cls.iter_objects_from_uuids(org, uuids))
 
     @classmethod
+    @routing.routed
     def fetch(cls, org, uuid):
         func = "get_%s" % cls._collection
         fetch = getattr(org.get_temba_client(), func)
         return cls.create_from_temba(org, fetch(**{cls.fetch_key: uuid}).all()[0])
 
     @classmethod
-    def fetch_objects(cls, org, af=None, **kwargs):
-        func = "get_%s" % cls._collection
-        fetch_all = getattr(org.get_temba_client(), func)
-        if af:
-            after = None
+    @routing.routed
+    def fetch_objects(cls, org, af=None, materialize=False, **kwargs):
+        """
+        Syncs the org's objects changed since the last sync, or all of them with af. Returns how many documents were
+        created, or the documents with materialize=True.
+        """
+        if isinstance(kwargs.get('flows'), (list, tuple)):
+            # runs are synced per flow, each flow keeping its own checkpoint
+            results = [cls.fetch_objects(org, af=af, materialize=materialize, flows=flow) for flow in kwargs['flows']]
+            return sum(results, []) if materialize else sum(results)
+        if not af and Backfill.in_progress(org, cls._collection, flow=kwargs.get('flows')):
+            # the stream's history is still being fetched by the backfill, which hands over to this sync once done
+            logger.info("Skipping %s for Org: %s, a backfill is in progress", cls._collection, org.name)
+            return [] if materialize else 0
+        checkpoint = LastSaved.get_for(org, cls._collection, flow=kwargs.get('flows'))
+        if checkpoint.can_resume(af):
+            after = pytz.utc.localize(checkpoint.pass_after) if checkpoint.pass_after else None
+            logger.info("Resuming %s for Org: %s from cursor %s", cls._collection, org.name, checkpoint.cursor)
         else:
-            try:
-                after = cls.find({'org.id': org._id}).sort("created_on", pymongo.DESCENDING).next().modified
-                tz = pytz.timezone(org.timezone)
-                after = tz.localize(after)
-            except StopIteration:
-                after = None
+            after = None if af else checkpoint.after
+            checkpoint.start(after)
+        return cls.create_from_temba_list(org, cls.fetch_temba_lists(org, after=after, **kwargs),
+                                          checkpoint=checkpoint, pipelined=settings.PIPELINE_SYNC,
+                                          materialize=materialize)
+
+    @classmethod
+    def fetch_temba_lists(cls, org, after=None, before=None, **kwargs):
+        """
+        The API query for the org's objects modified between after and before, for the runs of kwargs' flows
+        """
+        fetch_all = getattr(org.get_temba_client(), "get_%s" % cls._collection)
         if 'flows' in kwargs:
-            objs = cls.create_from_temba_list(org, fetch_all(after=after, flows=kwargs.get('flows')))
-        else:
-            if cls.__name__ == 'Message':
-                objs = cls.create_from_temba_list(org, fetch_all(after=after, folder='inbox'))
-            else:
-                objs = cls.create_from_temba_list(org, fetch_all(after=after))
-        return objs
+            return fetch_all(after=after, before=before, flow=kwargs.get('flows'))
+        elif cls.__name__ == 'Message':
+            return fetch_all(after=after, before=before, folder='inbox')
+        return fetch_all(after=after, before=before)
 
 
 class Group(BaseDocument):
     _collection = 'groups'
+    _indexes = BaseDocument._indexes + [index('uuid', 'org.id', unique=True)]
 
     uuid = field.Char()
     name = field.Char()
@@ -214,17 +1121,35 @@ class Urn(orm.EmbeddedDocument):
 
 class Contact(BaseDocument):
     _collection = 'contacts'
+    _indexes = BaseDocument._indexes + [index('uuid', 'org.id', unique=True)]
 
     uuid = field.Char()
     name = field.Char()
     urns = orm.List(type=Urn)
     groups = orm.List(type=Group)
     language = field.Char()
-    fields = field.Char()
+    fields = orm.Field()
+
+    @classmethod
+    def after_write(cls, org, created, updated=()):
+        moved = [obj for obj, old in updated if _contact_fields(obj.fields) != _contact_fields(old.get('fields'))]
+        ContactLocation.update_for(org, created + moved)
+
+    def load_frame(self, collection='messages', fields=None, since=None, **kwargs):
+        """
+        Loads the contact's messages or runs into a DataFrame
+        """
+        query = {'contact': self.uuid} if collection == 'runs' else {'contact.id': self._id}
+        if since:
+            query['created_on'] = {'$gte': since}
+        cls = Run if collection == 'runs' else Message
+        with routing.using(self._get('org')._value['id']):
+            return frames.load_frame(cls, query, fields=fields, **kwargs)
 
 
 class Broadcast(BaseDocument):
     _collection = 'broadcasts'
+    _indexes = BaseDocument._indexes + [index('id', 'org.id', unique=True)]
     fetch_key = 'id'
 
     id = field.Integer()
@@ -237,6 +1162,7 @@ class Broadcast(BaseDocument):
 
 class Campaign(BaseDocument):
     _collection = 'campaigns'
+    _indexes = BaseDocument._indexes + [index('uuid', 'org.id', unique=True)]
 
     uuid = field.Char()
     name = field.Char()
@@ -246,6 +1172,7 @@ class Campaign(BaseDocument):
 class Event(BaseDocument):
 
     _collection = 'events'
+    _indexes = BaseDocument._indexes + [index('uuid', 'org.id', unique=True)]
 
     uuid = field.Char()
     campaign = field.DynamicDocument()
@@ -292,6 +1219,7 @@ class Ruleset(orm.EmbeddedDocument):
 class Label(BaseDocument):
 
     _collection = 'labels'
+    _indexes = BaseDocument._indexes + [index('uuid', 'org.id', unique=True), index('name')]
     fetch_key = 'uuid'
 
     uuid = field.Char()
@@ -302,6 +1230,7 @@ class Label(BaseDocument):
 class Flow(BaseDocument):
 
     _collection = 'flows'
+    _indexes = BaseDocument._indexes + [index('uuid', 'org.id', unique=True)]
 
     uuid = field.Char()
     name = field.Char()
@@ -312,10 +1241,83 @@ class Flow(BaseDocument):
     completed_runs = field.Integer()
     rulesets = orm.List(type=Ruleset)
 
+    # fields RapidPro changes in place, refreshed whenever the flow list is synced
+    MUTABLE_FIELDS = ('name', 'archived', 'labels', 'runs', 'completed_runs')
+
+    @classmethod
+    def build_from_temba(cls, org, temba, refs=None):
+        flow = super(Flow, cls).build_from_temba(org, temba, refs=refs)
+        if isinstance(temba.archived, bool):
+            flow.archived = 'T' if temba.archived else 'F'
+        counts = getattr(temba, 'runs', None)
+        if counts is not None and not isinstance(counts, (int, long)):
+            flow.runs = counts.active + counts.completed + counts.interrupted + counts.expired
+            flow.completed_runs = counts.completed
+        return flow
+
+    @classmethod
+    @routing.routed
+    def sync_flow_list(cls, org):
+        """
+        Fetches the org's flows and upserts them, updating the fields of flows we already have
+        """
+        objs = cls.convert_page(org, org.get_temba_client().get_flows().all())
+        if not objs:
+            return objs
+        bulk = cls._connection().initialize_unordered_bulk_op()
+        for obj in objs:
+            doc = obj.to_insert()
+            changes = dict((key, doc.pop(key)) for key in cls.MUTABLE_FIELDS + ('__modified__', '_hash') if key in doc)
+            bulk.find({'org.id': org._id, 'uuid': doc['uuid']}).upsert().update_one({'$set': changes,
+                                                                                   '$setOnInsert': doc})
+        bulk.execute()
+        logger.info("Synced %d flows for Org: %s", len(objs), org.name)
+        return objs
+
+    @classmethod
+    @routing.routed
+    def due_for_run_sync(cls, org, af=None, now=None):
+        """
+        Returns the uuids of the flows whose runs should be synced now. Active flows are due every
+        RUN_SYNC_ACTIVE_INTERVAL minutes, archived ones every RUN_SYNC_ARCHIVED_INTERVAL minutes (0 syncs them only
+        once); a full sync (af) takes every flow. Intervals are measured from the start of a flow's last pass with half
+        a RUN_SYNC_MINUTES beat of slack, so a flow due every beat isn't skipped when its pass started a little later
+        than the beat. Flows whose last pass is still running are left to it.
+        """
+        try:
+            cls.sync_flow_list(org)
+        except TembaException as e:
+            logger.warning("Could not refresh the flows of Org: %s, using the ones we have - %s", org.name, str(e))
+        now = now or datetime.utcnow()
+        slack = settings.RUN_SYNC_MINUTES * 30
+        last_synced = LastSaved.last_synced(org, Run._collection)
+        running = LastSaved.running_passes(org, Run._collection)
+        due = []
+        for flow in cls.iter_raw({'org.id': org._id}, fields=['uuid', 'archived']):
+            if flow['uuid'] in running:
+                continue
+            synced = last_synced.get(flow['uuid'])
+            minutes = settings.RUN_SYNC_ARCHIVED_INTERVAL if flow.get('archived') == 'T' \
+                else settings.RUN_SYNC_ACTIVE_INTERVAL
+            if af or synced is None or (minutes and (now - synced).total_seconds() >= minutes * 60 - slack):
+                due.append(flow['uuid'])
+        return due
+
+    def load_frame(self, fields=None, since=None, **kwargs):
+        """
+        Loads the flow's runs into a DataFrame, one row per value unless explode says otherwise
+        """
+        query = {'org.id': self._get('org')._value['id'], 'flow': self.uuid}
+        if since:
+            query['created_on'] = {'$gte': since}
+        with routing.using(query['org.id']):
+            return frames.load_frame(Run, query, fields=fields, **kwargs)
+
 
 class Message(BaseDocument):
 
     _collection = 'messages'
+    _indexes = BaseDocument._indexes + [index('id', 'org.id', unique=True), index('contact.id'), index('broadcast.id')]
     fetch_key = 'id'
 
     id = field.Integer()
@@ -386,9 +1388,86 @@ class FlowStep(orm.EmbeddedDocument):
     time = field.TimeStamp()
 
 
+def _millis(value):
+    value = _as_utc(value)
+    return calendar.timegm(value.timetuple()) * 1000 + value.microsecond // 1000
+
+
+class RunDictionary(orm.Document):
+    """
+    Per flow dictionaries of the node uuids and categories that compact runs refer to by position. Entries are only
+    ever appended, so a position never changes meaning and cached copies stay valid until they miss.
+    """
+    _db = settings.DATABASE
+    _collection = 'run_dictionaries'
+    _indexes = [index('org.id', 'flow', unique=True)]
+
+    KINDS = ('nodes', 'categories')
+    _cache = {}
+    # full names of the collections whose indexes were ensured by this process
+    _indexed = set()
+
+    org = field.DynamicDocument()
+    flow = field.Char()
+    nodes = orm.Field()
+    categories = orm.Field()
+
+    @classmethod
+    def _load(cls, org_id, flow):
+        with profiling.span('mongo.find_one.%s' % cls._collection):
+            doc = cls._connection().find_one({'org.id': org_id, 'flow': flow}, as_dict=True) or {}
+        entries = {'_id': doc.get('_id')}
+        for kind in cls.KINDS:
+            values = list(doc.get(kind) or [])
+            entries[kind] = (values, dict((value, position) for position, value in enumerate(values)))
+        cls._cache[(org_id, flow)] = entries
+        return entries
+
+    @classmethod
+    def _create(cls, org_id, flow):
+        """
+        Inserts the empty dictionary of a flow and returns its id, or the id of the one another writer inserted first.
+        The unique (org.id, flow) index is built in the foreground before the first insert into a collection, a
+        background build wouldn't stop two writers inserting a dictionary each until it finishes.
+        """
+        coll = cls._connection()
+        if coll.full_name not in cls._indexed:
+            ensure_collection_indexes(cls, coll, background=False)
+            cls._indexed.add(coll.full_name)
+        try:
+            return coll.insert({'org': {'cls': '%s.%s' % (Org.__module__, Org.__name__), 'id': org_id}, 'flow': flow,
+                                'nodes': [], 'categories': []})
+        except DuplicateKeyError:
+            return cls._load(org_id, flow)['_id']
+
+    @classmethod
+    def positions(cls, org_id, flow, kind, values):
+        """
+        Returns {value: position} for values, appending the ones the flow's dictionary doesn't have yet
+        """
+        entries = cls._cache.get((org_id, flow)) or cls._load(org_id, flow)
+        missing = set(value for value in values if value is not None and value not in entries[kind][1])
+        if missing:
+            coll = cls._connection()
+            doc_id = entries['_id'] or cls._create(org_id, flow)
+            for value in missing:
+                # a no-op when another writer appended it first
+                coll.update({'_id': doc_id, kind: {'$ne': value}}, {'$push': {kind: value}})
+            entries = cls._load(org_id, flow)
+        return entries[kind][1]
+
+    @classmethod
+    def value(cls, org_id, flow, kind, position):
+        values = (cls._cache.get((org_id, flow)) or cls._load(org_id, flow))[kind][0]
+        if position >= len(values):
+            values = cls._load(org_id, flow)[kind][0]
+        return values[position]
+
+
 class Run(BaseDocument):
 
     _collection = 'runs'
+    _indexes = BaseDocument._indexes + [index('id', 'org.id', unique=True), index('flow', 'org.id'), index('contact')]
     fetch_key = 'id'
 
     id = field.Integer()
@@ -402,8 +1481,143 @@ class Run(BaseDocument):
     exit_type = field.Char()
 
     @classmethod
-    def create_from_temba(cls, org, temba):
+    def reference_fields(cls):
+        # runs keep the contact uuid rather than a reference, but the contacts of a page are still synced with it
+        return [('contact', Contact, False)]
+
+    # compact encoding, (field, short name) of the steps and values stored under 's' and 'v'
+    STEP_FIELDS = (('node', 'n'), ('text', 'x'), ('value', 'v'), ('type', 'y'), ('arrived_on', 'a'), ('left_on', 'l'),
+                   ('time', 't'))
+    VALUE_FIELDS = (('node', 'n'), ('category', 'c'), ('text', 'x'), ('rule_value', 'r'), ('label', 'b'),
+                    ('value', 'v'), ('time', 't'))
+    COMPACT_VERSION = 1
+
+    @classmethod
+    def _encode_items(cls, items, fields, created_on, nodes, categories):
+        encoded = []
+        for item in items:
+            short = {}
+            for name, key in fields:
+                value = item.get(name)
+                if value is None:
+                    continue
+                if name == 'node':
+                    value = nodes[value]
+                elif name == 'category':
+                    value = categories[value]
+                elif isinstance(value, datetime) and created_on is not None:
+                    value = _millis(value) - _millis(created_on)
+                short[key] = value
+            encoded.append(short)
+        return encoded
+
+    @classmethod
+    def _decode_items(cls, items, fields, org_id, flow, created_on):
+        decoded = []
+        for short in items:
+            item = {}
+            for name, key in fields:
+                value = short.get(key)
+                if value is not None:
+                    if name == 'node':
+                        value = RunDictionary.value(org_id, flow, 'nodes', value)
+                    elif name == 'category':
+                        value = RunDictionary.value(org_id, flow, 'categories', value)
+                    elif name in ('time', 'arrived_on', 'left_on') and not isinstance(value, datetime):
+                        value = created_on + timedelta(milliseconds=value)
+                item[name] = value
+            decoded.append(item)
+        return decoded
+
+    @classmethod
+    def encode_raw(cls, doc):
+        """
+        Turns a run document into its compact form: node and category dictionary positions, times as milliseconds
+        after created_on and short field names
+        """
+        if doc.get('z'):
+            return doc
+        doc = dict(doc)
+        org_id, flow, created_on = doc['org']['id'], doc.get('flow'), doc.get('created_on')
+        steps = doc.pop('steps', None) or []
+        values = doc.pop('values', None) or []
+        nodes = RunDictionary.positions(org_id, flow, 'nodes', [item.get('node') for item in steps + values])
+        categories = RunDictionary.positions(org_id, flow, 'categories', [item.get('category') for item in values])
+        if created_on is not None:
+            created_on = created_on.replace(microsecond=created_on.microsecond // 1000 * 1000)
+            doc['created_on'] = created_on
+        doc['s'] = cls._encode_items(steps, cls.STEP_FIELDS, created_on, nodes, categories)
+        doc['v'] = cls._encode_items(values, cls.VALUE_FIELDS, created_on, nodes, categories)
+        doc['z'] = cls.COMPACT_VERSION
+        return doc
+
+    @classmethod
+    def decode_raw(cls, doc):
+        if not doc.get('z'):
+            return doc
+        doc = dict(doc)
+        doc.pop('z')
+        org_id, flow, created_on = doc['org']['id'], doc.get('flow'), _as_utc(doc.get('created_on'))
+        doc['steps'] = cls._decode_items(doc.pop('s', None) or [], cls.STEP_FIELDS, org_id, flow, created_on)
+        doc['values'] = cls._decode_items(doc.pop('v', None) or [], cls.VALUE_FIELDS, org_id, flow, created_on)
+        return doc
+
+    @classmethod
+    def raw_fields(cls, fields):
+        fields = list(fields)
+        if set(f.split('.')[0] for f in fields) & set(['steps', 'values']):
+            fields.extend(f for f in ('z', 's', 'v', 'org.id', 'flow', 'created_on') if f not in fields)
+        return fields
+
+    def _map(self, vals, *args, **kwargs):
+        return super(Run, self)._map(self.decode_raw(vals), *args, **kwargs)
+
+    def to_write(self):
+        doc, defaults = super(Run, self).to_write()
+        return (self.encode_raw(doc) if settings.COMPACT_RUNS else doc), defaults
+
+    def save(self):
+        if not settings.COMPACT_RUNS:
+            return super(Run, self).save()
+        self._route()
+        doc = self.to_insert()
+        if self._id:
+            doc.pop('__created__')
+            self._coll.update({'_id': self._id}, {'$set': doc, '$unset': {'steps': '', 'values': ''}}, safe=True)
+        else:
+            self._id = self._coll.insert(doc, safe=True)
+        return self._id
+
+    @classmethod
+    @routing.routed
+    def migrate_encoding(cls, org, compact=True, batch_size=None):
+        """
+        Rewrites an org's runs to the compact encoding, or back with compact=False, one _id ordered batch at a time
+        """
+        coll = cls._connection()
+        batch_size = batch_size or settings.RAW_BATCH_SIZE
+        query = {'org.id': org._id, 'z': {'$exists': not compact}}
+        converted = 0
+        last = None
+        while True:
+            if last:
+                query['_id'] = {'$gt': last}
+            docs = list(coll.find(query, as_dict=True).sort('_id', pymongo.ASCENDING).limit(batch_size))
+            if not docs:
+                break
+            bulk = coll.initialize_unordered_bulk_op()
+            for doc in docs:
+                bulk.find({'_id': doc['_id']}).replace_one(cls.encode_raw(doc) if compact else cls.decode_raw(doc))
+            bulk.execute()
+            converted += len(docs)
+            last = docs[-1]['_id']
+            logger.info("Converted %d runs for Org: %s", converted, org.name)
+        return converted
+
+    @classmethod
+    def build_from_temba(cls, org, temba, refs=None):
         run = cls()
+        run.org = org
         run.id = temba.id
         run.flow = temba.flow.uuid
         run.contact = temba.contact.uuid
@@ -412,12 +1626,14 @@ class Run(BaseDocument):
         run.exited_on = temba.exited_on
         run.exit_type = temba.exit_type
 
-        run.steps = FlowStep.create_from_temba_list(temba.path)
-        run.values = RunValueSet.create_from_temba_list(temba.values.values())
-
-        run.save()
-
+        run.steps.extend(FlowStep.create_from_temba_list(temba.path))
+        run.values.extend(RunValueSet.create_from_temba_list(temba.values.values()))
+        return run
 
+    @classmethod
+    def after_write(cls, org, created, updated=()):
+        if settings.AGGREGATE_RESPONSES:
+            ResponseCount.apply(org, created + [obj for obj, old in updated], old_runs=[old for obj, old in updated])
 
 
 class CategoryStats(orm.EmbeddedDocument):
@@ -451,6 +1667,158 @@ class Result(BaseDocument):
     label = field.Char()
     categories = orm.List(type=CategoryStats)
 
+    @classmethod
+    @routing.routed
+    def from_counts(cls, org, flow, node, group=None):
+        """
+        Builds an unsaved result for one ruleset node from the maintained response counts
+        """
+        result = cls()
+        result.org = org
+        result.label = node
+        result.set = 0
+        counts = ResponseCount.iter_raw({'org.id': org._id, 'flow': flow, 'node': node, 'group': group, 'day': None},
+                                        fields=['category', 'count'], sort=[('count', pymongo.DESCENDING)])
+        for count in counts:
+            stats = CategoryStats()
+            stats.label = count['category']
+            stats.count = count['count']
+            result.categories.append(stats)
+            result.set += count['count']
+        return result
+
+
+class ResponseCount(BaseDocument):
+    """
+    Response totals per (org, flow, ruleset node, category), with optional breakdowns by contact group and by day
+    stored as separate counters (group or day set, the other None). Run sync applies deltas for the runs each page
+    creates; rebuild recomputes an org's counters from the runs collection.
+    """
+    _collection = 'response_counts'
+    _indexes = [index('org.id', 'flow', 'node', 'category', 'group', 'day', unique=True)]
+    fetch_key = None
+
+    KEY_FIELDS = ('flow', 'node', 'category', 'group', 'day')
+
+    flow = field.Char()
+    node = field.Char()
+    category = field.Char()
+    group = field.Char()
+    day = field.Char()
+    count = field.Integer()
+
+    @classmethod
+    def deltas(cls, org, runs, sign=1, deltas=None):
+        """
+        Tallies the values of runs (documents or raw dicts) into {key: delta}
+        """
+        deltas = {} if deltas is None else deltas
+        docs = [run._json() if isinstance(run, orm.Document) else Run.decode_raw(run) for run in runs]
+        groups = {}
+        contacts = list(set(doc.get('contact') for doc in docs if doc.get('contact')))
+        if settings.AGGREGATE_BY_GROUP and contacts:
+            query = {'org.id': org._id, 'uuid': {'$in': contacts}}
+            for contact in Contact.iter_raw(query, fields=['uuid', 'groups.uuid']):
+                groups[contact['uuid']] = [group.get('uuid') for group in contact.get('groups') or []]
+        for doc in docs:
+            for value in doc.get('values') or []:
+                base = (doc.get('flow'), value.get('node'), value.get('category'))
+                keys = [base + (None, None)]
+                time = value.get('time') or doc.get('created_on')
+                if settings.AGGREGATE_BY_DAY and time:
+                    keys.append(base + (None, time.strftime('%Y-%m-%d')))
+                keys.extend(base + (group, None) for group in groups.get(doc.get('contact'), []))
+                for key in keys:
+                    deltas[key] = deltas.get(key, 0) + sign
+        return deltas
+
+    @classmethod
+    def apply(cls, org, runs, old_runs=None):
+        """
+        Increments the counters for runs, and decrements them for the previous versions of modified runs
+        """
+        deltas = cls.deltas(org, runs)
+        if old_runs:
+            cls.deltas(org, old_runs, sign=-1, deltas=deltas)
+        changes = [(key, delta) for key, delta in deltas.items() if delta]
+        if not changes:
+            return 0
+        now = datetime.utcnow()
+        bulk = cls._connection().initialize_unordered_bulk_op()
+        for key, delta in changes:
+            query = dict(zip(cls.KEY_FIELDS, key))
+            query['org.id'] = org._id
+            bulk.find(query).upsert().update_one({
+                '$inc': {'count': delta},
+                '$set': {'__modified__': now},
+                '$setOnInsert': {'org.cls': '%s.%s' % (Org.__module__, Org.__name__), '__created__': now,
+                                 '__active__': True}})
+        bulk.execute()
+        return len(changes)
+
+    @classmethod
+    def _rebuild_pipelines(cls, org, match, compact=False):
+        if compact:
+            values, node, category = 'v', '$v.n', '$v.c'
+            time = {'$add': ['$created_on', {'$ifNull': ['$v.t', 0]}]}
+        else:
+            values, node, category = 'values', '$values.node', '$values.category'
+            time = {'$ifNull': ['$values.time', '$created_on']}
+        match = dict(match, z={'$exists': compact})
+        unwind = {'$unwind': '$%s' % values}
+        key = {'flow': '$flow', 'node': node, 'category': category, 'group': None, 'day': None}
+        count = {'$sum': 1}
+        pipelines = [[{'$match': match}, unwind, {'$group': {'_id': key, 'count': count}}]]
+        if settings.AGGREGATE_BY_DAY:
+            day = {'$dateToString': {'format': '%Y-%m-%d', 'date': time}}
+            pipelines.append([{'$match': match}, unwind, {'$group': {'_id': dict(key, day=day), 'count': count}}])
+        if settings.AGGREGATE_BY_GROUP:
+            # the org's runs and contacts share a database in every storage layout, $lookup can't reach another one
+            contacts = Contact._connection()
+            if contacts.database.name != Run._connection().database.name:
+                raise ValueError("Contacts of Org %s are not in the database of its runs" % org.name)
+            pipelines.append([{'$match': match}, unwind,
+                              {'$lookup': {'from': contacts.name, 'localField': 'contact', 'foreignField': 'uuid',
+                                           'as': 'contact'}},
+                              {'$unwind': '$contact'}, {'$match': {'contact.org.id': org._id}},
+                              {'$unwind': '$contact.groups'},
+                              {'$group': {'_id': dict(key, group='$contact.groups.uuid'), 'count': count}}])
+        return pipelines
+
+    @classmethod
+    @routing.routed
+    def rebuild(cls, org, flow=None):
+        """
+        Recomputes the org's counters (or one flow's) from the runs with the aggregation pipeline. Deltas applied by
+        a sync running at the same time are lost, so pause the org's run sync while rebuilding.
+        """
+        match = {'org.id': org._id}
+        if flow:
+            match['flow'] = flow
+        counts = {}
+        for compact in (False, True):
+            for pipeline in cls._rebuild_pipelines(org, match, compact=compact):
+                for row in Run._connection().aggregate(pipeline, cursor={}, allowDiskUse=True):
+                    key = row['_id']
+                    if compact:
+                        for name, kind in (('node', 'nodes'), ('category', 'categories')):
+                            if key[name] is not None:
+                                key[name] = RunDictionary.value(org._id, key['flow'], kind, key[name])
+                    key = tuple(key[name] for name in cls.KEY_FIELDS)
+                    counts[key] = counts.get(key, 0) + row['count']
+        now = datetime.utcnow()
+        docs = []
+        for key, count in counts.items():
+            doc = dict(zip(cls.KEY_FIELDS, key), count=count, __created__=now, __modified__=now, __active__=True)
+            doc['org'] = {'cls': '%s.%s' % (Org.__module__, Org.__name__), 'id': org._id}
+            docs.append(doc)
+        coll = cls._connection()
+        coll.remove(match)
+        for chunk in chunks(docs, 1000):
+            coll.insert(chunk)
+        logger.info("Rebuilt %d response counts for Org: %s", len(docs), org.name)
+        return len(docs)
+
 
 class Geometry(orm.EmbeddedDocument):
     @classmethod
@@ -468,38 +1836,334 @@ class Geometry(orm.EmbeddedDocument):
         return obj_list
 
     type = field.Char()
-    coordinates = field.Char()
+    coordinates = orm.Field()
 
 
 class Boundary(BaseDocument):
+    """
+    Administrative boundary keyed by its osm id. shape is the GeoJSON (Multi)Polygon behind a 2dsphere index,
+    simplified holds lighter copies per zoom level for maps and path the osm ids from the country down.
+    """
     @classmethod
+    @routing.routed
     def fetch(cls, org, uuid):
         return None
 
     _collection = 'boundaries'
+    _indexes = [index('org.id', 'boundary'), index('org.id', 'parent'), index(('shape', '2dsphere'))]
     fetch_key = None
 
     boundary = field.Char()
     name = field.Char()
+    aliases = orm.Field()
     level = field.Char()
     parent = field.Char()
-    geometry = orm.List(type=Geometry)
-
-
-Org.boundaries = orm.Lazy(type=Boundary, key='org.id')
-Org.results = orm.Lazy(type=Result, key='org.id')
-Org.runs = orm.Lazy(type=Run, key='org.id')
-Org.messages = orm.Lazy(type=Message, key='org.id')
-Org.flows = orm.Lazy(type=Flow, key='org.id')
-Org.labels = orm.Lazy(type=Label, key='org.id')
-Org.events = orm.Lazy(type=Event, key='org.id')
-Org.campaigns = orm.Lazy(type=Campaign, key='org.id')
-Org.broadcasts = orm.Lazy(type=Broadcast, key='org.id')
-Org.contacts = orm.Lazy(type=Contact, key='org.id')
-Org.groups = orm.Lazy(type=Group, key='org.id')
-Contact.messages = orm.Lazy(type=Message, key='contact.id')
-Broadcast.messages = orm.Lazy(type=Message, key='broadcast.id')
-Flow.flow_runs = orm.Lazy(type=Run, key='flow.id')
+    path = orm.Field()
+    shape = orm.Field()
+    simplified = orm.Field()
+
+    @classmethod
+    def build_from_temba(cls, org, temba, refs=None):
+        geometry = getattr(temba, 'geometry', None)
+        geometries = geometry if isinstance(geometry, list) else [geometry] if geometry is not None else []
+        parent = getattr(temba, 'parent', None)
+        boundary = cls()
+        boundary.org = org
+        boundary.boundary = getattr(temba, 'osm_id', None) or getattr(temba, 'boundary', None)
+        boundary.name = temba.name
+        boundary.aliases = getattr(temba, 'aliases', None)
+        boundary.level = temba.level
+        boundary.parent = getattr(parent, 'osm_id', parent)
+        shape = geo.to_shape(geometries)
+        if shape:
+            boundary.shape = shape
+            boundary.simplified = dict((str(zoom), geo.simplify(shape, tolerance))
+                                       for zoom, tolerance in settings.BOUNDARY_ZOOM_TOLERANCES.items())
+        return boundary
+
+    @property
+    def geometry(self):
+        """
+        The shape as a list of Geometry, how boundaries kept their coordinates before shape
+        """
+        if not self.shape:
+            return []
+        geometry = Geometry()
+        geometry.type = self.shape['type']
+        geometry.coordinates = self.shape['coordinates']
+        return [geometry]
+
+    def shape_for_zoom(self, zoom):
+        """
+        The lightest geometry drawn well enough at `zoom`, the full shape past the most detailed simplification
+        """
+        zooms = sorted(int(z) for z in self.simplified or {} if int(z) >= zoom)
+        return self.simplified[str(zooms[0])] if zooms else self.shape
+
+    @classmethod
+    @routing.routed
+    def sync_boundaries(cls, org):
+        """
+        Fetches the org's boundaries with their geometry, replaces the stored ones, deletes the ones RapidPro no longer
+        has and remaps the org's contacts
+        """
+        temba_boundaries = org.get_temba_client().get_boundaries(geometry=True).all()
+        objs = [cls.build_from_temba(org, temba) for temba in temba_boundaries]
+        by_id = dict((obj.boundary, obj) for obj in objs)
+        for obj in objs:
+            path, parent = [obj.boundary], obj.parent
+            while parent in by_id and parent not in path:
+                path.insert(0, parent)
+                parent = by_id[parent].parent
+            obj.path = path
+        if objs:
+            bulk = cls._connection().initialize_unordered_bulk_op()
+            for obj in objs:
+                doc = obj.to_insert()
+                created = {'__created__': doc.pop('__created__')}
+                # boundaries synced before shape also kept their coordinates in a geometry list
+                bulk.find({'org.id': org._id, 'boundary': obj.boundary}).upsert().update_one({
+                    '$set': doc, '$setOnInsert': created, '$unset': {'geometry': ''}})
+            try:
+                bulk.execute()
+            except BulkWriteError as e:
+                for error in e.details.get('writeErrors', []):
+                    logger.error("Could not save boundary %s for Org: %s - %s", objs[error['index']].boundary,
+                                 org.name, error.get('errmsg'))
+        removed = cls._connection().remove({'org.id': org._id, 'boundary': {'$nin': list(by_id)}})
+        logger.info("Synced %d boundaries for Org: %s, deleted %d", len(objs), org.name, (removed or {}).get('n', 0))
+        ContactLocation.rebuild(org)
+        return objs
+
+    @classmethod
+    @routing.routed
+    def containing(cls, org, longitude, latitude):
+        """
+        The boundaries, at every level, that contain a point
+        """
+        point = {'type': 'Point', 'coordinates': [longitude, latitude]}
+        return cls.find_raw({'org.id': org._id, 'shape': {'$geoIntersects': {'$geometry': point}}},
+                            fields=['boundary', 'name', 'level', 'path'])
+
+
+def _contact_fields(value):
+    # contact fields used to be stored as the text of the dict
+    if isinstance(value, basestring):
+        try:
+            value = ast.literal_eval(value)
+        except (ValueError, SyntaxError):
+            return {}
+    return value if isinstance(value, dict) else {}
+
+
+class ContactLocation(BaseDocument):
+    """
+    The boundary path (country, state, district, ...) of a contact, matched from the contact's location fields
+    (CONTACT_LOCATION_FIELDS, from the top level down) against the names of the org's boundaries. Maintained as
+    contacts are synced and rebuilt after the boundaries are, so regional breakdowns are indexed lookups on path.
+    """
+    _collection = 'contact_locations'
+    _indexes = [index('org.id', 'contact', unique=True), index('org.id', 'path')]
+    fetch_key = None
+    # org id: (time read, boundary_names)
+    _boundaries = {}
+
+    contact = field.Char()
+    path = orm.Field()
+    names = orm.Field()
+
+    @classmethod
+    @routing.routed
+    def boundary_names(cls, org):
+        """
+        Returns the org's country and {(parent, lowercase name or alias): (osm id, name)}
+        """
+        names = {}
+        country = None
+        for boundary in Boundary.iter_raw({'org.id': org._id}, fields=['boundary', 'name', 'aliases', 'parent']):
+            if not boundary.get('parent'):
+                country = (boundary['boundary'], boundary.get('name'))
+            aliases = boundary.get('aliases') or []
+            for name in [boundary.get('name')] + (aliases if isinstance(aliases, list) else []):
+                if name:
+                    names[(boundary.get('parent'), name.strip().lower())] = (boundary['boundary'], boundary.get('name'))
+        return country, names
+
+    @classmethod
+    def cached_boundary_names(cls, org, refresh=False):
+        """
+        boundary_names of an org, read again once BOUNDARY_NAMES_TTL seconds old or when refreshing
+        """
+        cached = cls._boundaries.get(org._id)
+        now = datetime.utcnow()
+        if refresh or cached is None or (now - cached[0]).total_seconds() > settings.BOUNDARY_NAMES_TTL:
+            cached = cls._boundaries[org._id] = (now, cls.boundary_names(org))
+        return cached[1]
+
+    @classmethod
+    def locate(cls, fields, country, names):
+        path, matched = [country[0]], [country[1]]
+        for key in settings.CONTACT_LOCATION_FIELDS:
+            value = fields.get(key)
+            if not isinstance(value, basestring) or not value.strip():
+                break
+            found = names.get((path[-1], value.split('>')[-1].strip().lower()))
+            if not found:
+                break
+            path.append(found[0])
+            matched.append(found[1])
+        return path, matched
+
+    @classmethod
+    def update_for(cls, org, contacts, boundaries=None):
+        """
+        Recomputes the location of contacts (documents or raw dicts), boundaries is boundary_names when known
+        """
+        docs = [contact._json() if isinstance(contact, orm.Document) else contact for contact in contacts]
+        if not docs:
+            return 0
+        country, names = boundaries or cls.cached_boundary_names(org)
+        if not country:
+            return 0
+        now = datetime.utcnow()
+        bulk = cls._connection().initialize_unordered_bulk_op()
+        for doc in docs:
+            path, matched = cls.locate(_contact_fields(doc.get('fields')), country, names)
+            bulk.find({'org.id': org._id, 'contact': doc['uuid']}).upsert().update_one({
+                '$set': {'path': path, 'names': matched, '__modified__': now},
+                '$setOnInsert': {'org.cls': '%s.%s' % (Org.__module__, Org.__name__), '__created__': now,
+                                 '__active__': True}})
+        bulk.execute()
+        return len(docs)
+
+    @classmethod
+    @routing.routed
+    def rebuild(cls, org):
+        boundaries = cls.cached_boundary_names(org, refresh=True)
+        located = 0
+        batch = []
+        for contact in Contact.iter_raw({'org.id': org._id}, fields=['uuid', 'fields']):
+            batch.append(contact)
+            if len(batch) >= settings.RAW_BATCH_SIZE:
+                located += cls.update_for(org, batch, boundaries=boundaries)
+                batch = []
+        located += cls.update_for(org, batch, boundaries=boundaries)
+        logger.info("Located %d contacts for Org: %s", located, org.name)
+        return located
+
+    @classmethod
+    @routing.routed
+    def contacts_in(cls, org, boundary):
+        """
+        The uuids of the contacts located in a boundary or anywhere below it
+        """
+        return [doc['contact'] for doc in cls.iter_raw({'org.id': org._id, 'path': boundary}, fields=['contact'])]
+
+
+def _normalize_key(key):
+    return [(k, int(d) if isinstance(d, (int, float)) else d) for k, d in key]
+
+
+class RoutedLazy(orm.Lazy):
+    """
+    Lazy relation looked up in the storage of the org it hangs off, or of the org of the document it hangs off
+    """
+    def __call__(self, **kwargs):
+        org = self._base if isinstance(self._base, Org) else self._base._get('org')._value['id']
+        with routing.using(org):
+            return super(RoutedLazy, self).__call__(**kwargs)
+
+
+def indexed_classes():
+    return [Org, LastSaved, Backfill, RunDictionary] + BaseDocument.__subclasses__()
+
+
+def indexed_collections(classes=None, orgs=None):
+    """
+    Yields (class, collection) for the shared collections and for the collections of every org with a storage of its
+    own, or only for the collections of `orgs`
+    """
+    classes = classes or indexed_classes()
+    if orgs is None:
+        for cls in classes:
+            yield cls, cls._connection()
+        orgs = Org.find({'storage': {'$in': [routing.COLLECTION, routing.DATABASE]}})
+    routed = [cls for cls in classes if issubclass(cls, BaseDocument)]
+    for org in orgs if routed else []:
+        with routing.using(org):
+            for cls in routed:
+                yield cls, cls._connection()
+
+
+def ensure_indexes(classes=None, orgs=None):
+    """
+    Creates any declared index that is missing. Safe to call on every worker start, builds run in the background.
+    """
+    for cls, coll in indexed_collections(classes, orgs=orgs):
+        ensure_collection_indexes(cls, coll)
+
+
+def ensure_collection_indexes(cls, coll, background=None):
+    existing = dict((tuple(_normalize_key(info['key'])), info) for info in coll.index_information().values())
+    for idx in cls._indexes:
+        info = existing.get(tuple(_normalize_key(idx._key)))
+        if info is not None:
+            if idx._unique and not info.get('unique'):
+                logger.warning("Index %s on %s is not unique, drop it once duplicates are removed to have it rebuilt",
+                               idx._name, coll.full_name)
+            continue
+        logger.info("Creating index %s on %s", idx._name, coll.full_name)
+        options = dict(name=idx._name, background=idx._background if background is None else background)
+        if idx._unique:
+            options['unique'] = True
+        if idx._sparse:
+            options['sparse'] = True
+        coll.create_index(idx._key, **options)
+
+
+def _index_usage(coll):
+    try:
+        stats = coll.aggregate([{'$indexStats': {}}], cursor={})
+        return dict((stat['name'], stat['accesses']['ops']) for stat in stats)
+    except OperationFailure:
+        return {}
+
+
+def index_report(classes=None):
+    """
+    Compares declared indexes with the ones in the database. Returns {collection: {'missing': [...], 'extra': [...],
+    'unused': [...]}}, unused is only filled on servers that support $indexStats. Collections of orgs with a storage
+    of their own are reported under their full name.
+    """
+    report = {}
+    for cls, coll in indexed_collections(classes):
+        declared = dict((idx._name, _normalize_key(idx._key)) for idx in cls._indexes)
+        existing = dict((name, _normalize_key(info['key'])) for name, info in coll.index_information().items()
+                        if name != '_id_')
+        usage = _index_usage(coll)
+        shared = (coll.database.name, coll.name) == (cls._db, cls._collection)
+        report[cls._collection if shared else coll.full_name] = {
+            'missing': sorted(name for name, key in declared.items() if key not in existing.values()),
+            'extra': sorted(name for name, key in existing.items() if key not in declared.values()),
+            'unused': sorted(name for name in existing if usage.get(name) == 0),
+        }
+    return report
+
+
+Org.boundaries = RoutedLazy(type=Boundary, key='org.id')
+Org.results = RoutedLazy(type=Result, key='org.id')
+Org.runs = RoutedLazy(type=Run, key='org.id')
+Org.messages = RoutedLazy(type=Message, key='org.id')
+Org.flows = RoutedLazy(type=Flow, key='org.id')
+Org.labels = RoutedLazy(type=Label, key='org.id')
+Org.events = RoutedLazy(type=Event, key='org.id')
+Org.campaigns = RoutedLazy(type=Campaign, key='org.id')
+Org.broadcasts = RoutedLazy(type=Broadcast, key='org.id')
+Org.contacts = RoutedLazy(type=Contact, key='org.id')
+Org.groups = RoutedLazy(type=Group, key='org.id')
+Contact.messages = RoutedLazy(type=Message, key='contact.id')
+Broadcast.messages = RoutedLazy(type=Message, key='broadcast.id')
+Flow.flow_runs = RoutedLazy(type=Run, key='flow.id')
 Value = RunValueSet
 Step = FlowStep
 Categorie = CategoryStats
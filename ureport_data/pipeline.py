@@ -0,0 +1,102 @@
+import logging
+import sys
+import threading
+from Queue import Queue, Empty, Full
+
+import metrics
+import profiling
+import routing
+import settings
+
+logging.basicConfig(format=settings.FORMAT)
+logger = logging.getLogger("pipeline")
+
+__author__ = 'kenneth'
+
+DONE = object()
+
+
+class Pipeline(object):
+    """
+    Runs a source iterator and a chain of stages in their own threads, connected by bounded queues. Every stage but
+    the last maps an item to the next stage's input, the last one only consumes. A full queue blocks the stage
+    feeding it so a slow writer throttles fetching; the first error stops all stages and is re-raised by run().
+    Stage threads record their metrics and profiles for the task of the thread that created the pipeline, and read
+    and write the documents of its org.
+    """
+    def __init__(self, source, stages, queue_size=2, poll=0.5):
+        self.source = source
+        self.stages = stages
+        self.queues = [Queue(maxsize=queue_size) for _ in stages]
+        self.poll = poll
+        self.stopped = threading.Event()
+        self.error = None
+        self.scope = metrics.current()
+        self.org = routing.current()
+
+    def _put(self, queue, item):
+        while not self.stopped.is_set():
+            try:
+                queue.put(item, timeout=self.poll)
+                return True
+            except Full:
+                continue
+        return False
+
+    def _get(self, queue):
+        while not self.stopped.is_set():
+            try:
+                return queue.get(timeout=self.poll)
+            except Empty:
+                continue
+        return DONE
+
+    def _fail(self):
+        if self.error is None:
+            self.error = sys.exc_info()
+        self.stopped.set()
+
+    def _thread(self, target, *args):
+        metrics.activate(self.scope)
+        routing.activate(self.org)
+        with profiling.follow(self.scope):
+            target(*args)
+
+    def _fetch(self):
+        try:
+            for item in self.source:
+                if not self._put(self.queues[0], item):
+                    return
+            self._put(self.queues[0], DONE)
+        except Exception:
+            self._fail()
+
+    def _stage(self, position):
+        inbox = self.queues[position]
+        outbox = self.queues[position + 1] if position + 1 < len(self.queues) else None
+        try:
+            while True:
+                item = self._get(inbox)
+                if item is DONE:
+                    break
+                result = self.stages[position](item)
+                if outbox is not None and not self._put(outbox, result):
+                    return
+            if outbox is not None:
+                self._put(outbox, DONE)
+        except Exception:
+            self._fail()
+
+    def run(self):
+        threads = [threading.Thread(target=self._thread, args=(self._fetch,), name='pipeline-fetch')]
+        threads.extend(threading.Thread(target=self._thread, args=(self._stage, position),
+                                        name='pipeline-stage-%d' % position) for position in range(len(self.stages)))
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(self.poll)
+        if self.error is not None:
+            logger.error("Pipeline stopped: %s", self.error[1])
+            raise self.error[0], self.error[1], self.error[2]
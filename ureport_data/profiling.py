@@ -0,0 +1,234 @@
+import cProfile
+import json
+import logging
+import os
+import pstats
+import re
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from fnmatch import fnmatch
+
+import metrics
+import settings
+
+logging.basicConfig(format=settings.FORMAT)
+logger = logging.getLogger("profiling")
+
+__author__ = 'kenneth'
+
+MODES = ('sample', 'cprofile')
+
+
+class Sampler(object):
+    """
+    Statistical profiler that snapshots the stacks of the registered threads every `interval` seconds from a
+    thread of its own and counts them as collapsed stacks, the input format of flamegraph.pl and speedscope
+    """
+    def __init__(self, interval):
+        self.interval = interval
+        self.threads = set()
+        self.stacks = {}
+        self.samples = 0
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name='profiling-sampler')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def _run(self):
+        while not self.stopped.wait(self.interval):
+            frames = sys._current_frames()
+            for ident in list(self.threads):
+                frame = frames.get(ident)
+                if frame is None:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append('%s (%s:%d)' % (code.co_name, os.path.basename(code.co_filename),
+                                                 code.co_firstlineno))
+                    frame = frame.f_back
+                key = ';'.join(reversed(stack))
+                self.stacks[key] = self.stacks.get(key, 0) + 1
+                self.samples += 1
+
+    def write(self, path):
+        with open(path, 'w') as f:
+            for stack, count in sorted(self.stacks.items()):
+                f.write('%s %d\n' % (stack, count))
+
+
+class Profile(object):
+    """
+    Profile of one task: cProfile or sampled stacks of every thread working for it, and the time spent in Mongo and
+    HTTP spans
+    """
+    def __init__(self, name, mode, directory=None, interval=None):
+        if mode not in MODES:
+            raise ValueError("Unknown profiling mode %s, use one of %s" % (mode, ', '.join(MODES)))
+        self.name = name
+        self.mode = mode
+        self.directory = directory or settings.PROFILE_DIR
+        self.lock = threading.Lock()
+        self.spans = {}
+        self.profilers = []
+        self.sampler = None
+        if mode == 'sample':
+            self.sampler = Sampler(interval or settings.PROFILE_SAMPLE_INTERVAL)
+            self.sampler.start()
+
+    def enter_thread(self):
+        if self.sampler is not None:
+            self.sampler.threads.add(threading.current_thread().ident)
+            return None
+        profiler = cProfile.Profile()
+        profiler.enable()
+        return profiler
+
+    def exit_thread(self, profiler):
+        if self.sampler is not None:
+            self.sampler.threads.discard(threading.current_thread().ident)
+            return
+        profiler.disable()
+        with self.lock:
+            self.profilers.append(profiler)
+
+    def add_span(self, name, seconds):
+        with self.lock:
+            span = self.spans.setdefault(name, [0, 0.0])
+            span[0] += 1
+            span[1] += seconds
+
+    def span_report(self):
+        with self.lock:
+            return dict((name, {'calls': calls, 'seconds': round(seconds, 6)})
+                        for name, (calls, seconds) in self.spans.items())
+
+    def write(self):
+        """
+        Writes <name>.pstats or <name>.collapsed and <name>.spans.json, returns their paths
+        """
+        if self.sampler is not None:
+            self.sampler.stop()
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        base = os.path.join(self.directory, self.name)
+        paths = []
+        if self.sampler is not None:
+            paths.append(base + '.collapsed')
+            self.sampler.write(paths[-1])
+        elif self.profilers:
+            stats = pstats.Stats(self.profilers[0])
+            for profiler in self.profilers[1:]:
+                stats.add(profiler)
+            paths.append(base + '.pstats')
+            stats.dump_stats(paths[-1])
+        paths.append(base + '.spans.json')
+        with open(paths[-1], 'w') as f:
+            json.dump(self.span_report(), f, indent=2, sort_keys=True)
+        return paths
+
+
+def selected(org, entity):
+    """
+    Whether PROFILE_TASKS asks for this org's entity to be profiled. Entries are org:entity patterns, shell style
+    wildcards allowed; an entry without an entity matches all of the org's entities.
+    """
+    for pattern in settings.PROFILE_TASKS:
+        org_pattern, _, entity_pattern = pattern.partition(':')
+        if fnmatch(org or '', org_pattern.strip() or '*') and fnmatch(entity, entity_pattern.strip() or '*'):
+            return True
+    return False
+
+
+def _profile_of(scope):
+    return getattr(scope, 'profile', None)
+
+
+def _file_name(org, entity, flow=None):
+    """
+    Base name of a profile's files, unique across the syncs of one org's entity running at once in a process, like
+    the flows of a runs sync or the windows of a backfill
+    """
+    parts = [org or 'none', entity] + ([','.join(flow) if isinstance(flow, (list, tuple)) else flow] if flow else [])
+    parts = [re.sub(r'[^\w-]+', '_', part)[:40] for part in parts]
+    return '%s-%d-%d-%s-%s' % ('-'.join(parts), os.getpid(), threading.current_thread().ident,
+                               time.strftime('%Y%m%d%H%M%S'), uuid.uuid4().hex[:8])
+
+
+@contextmanager
+def profiled(org, entity, force=None, flow=None):
+    """
+    Profiles the block when PROFILE_TASKS selects (org, entity) or when forced. force is True for PROFILE_MODE, a mode
+    name, or False to never profile. Threads following the current metrics task, like a sync's pipeline stages, are
+    profiled along with the calling one.
+    """
+    if force is False or not (force or selected(org, entity)):
+        yield None
+        return
+    mode = force if force in MODES else settings.PROFILE_MODE
+    name = _file_name(org, entity, flow)
+    scope = metrics.current()
+    profile = Profile(name, mode)
+    previous = _profile_of(scope)
+    if scope is not None:
+        scope.profile = profile
+    profiler = profile.enter_thread()
+    started = time.time()
+    try:
+        yield profile
+    finally:
+        profile.exit_thread(profiler)
+        if scope is not None:
+            scope.profile = previous
+        paths = profile.write()
+        logger.info("Profiled %s for Org: %s in %.1f seconds - %s, spans %s", entity, org, time.time() - started,
+                    ', '.join(paths), json.dumps(profile.span_report(), sort_keys=True))
+
+
+@contextmanager
+def follow(scope):
+    """
+    Profiles the calling thread as part of `scope`'s task while it is being profiled
+    """
+    profile = _profile_of(scope)
+    if profile is None:
+        yield
+        return
+    profiler = profile.enter_thread()
+    try:
+        yield
+    finally:
+        profile.exit_thread(profiler)
+
+
+def add_span(name, seconds):
+    profile = _profile_of(metrics.current())
+    if profile is not None:
+        profile.add_span(name, seconds)
+
+
+@contextmanager
+def span(name):
+    """
+    Times a Mongo or HTTP call site for the profile of the current task, costs one lookup when nothing is profiled
+    """
+    profile = _profile_of(metrics.current())
+    if profile is None:
+        yield
+        return
+    started = time.time()
+    try:
+        yield
+    finally:
+        profile.add_span(name, time.time() - started)
@@ -0,0 +1,49 @@
+__author__ = 'kenneth'
+
+_record_classes = {}
+
+
+def lookup(doc, path):
+    """
+    Reads a dotted path out of a raw document, lists along the way yield a list of the values in their items
+    """
+    value = doc
+    for part in path.split('.'):
+        if isinstance(value, list):
+            value = [item.get(part) if isinstance(item, dict) else None for item in value]
+        elif isinstance(value, dict):
+            value = value.get(part)
+        else:
+            return None
+    return value
+
+
+class Record(object):
+    """
+    Read-only view of a raw document holding just the projected fields. Subclasses are generated per projection by
+    record_class so instances carry __slots__ instead of a __dict__.
+    """
+    __slots__ = ()
+    _paths = ()
+
+    def __init__(self, doc):
+        for slot, path in zip(self.__slots__, self._paths):
+            setattr(self, slot, lookup(doc, path))
+
+    def as_dict(self):
+        return dict((slot, getattr(self, slot)) for slot in self.__slots__)
+
+    def __repr__(self):
+        return '%s(%s)' % (self.__class__.__name__,
+                           ', '.join('%s=%r' % (slot, getattr(self, slot)) for slot in self.__slots__))
+
+
+def record_class(name, fields):
+    """
+    Returns the Record subclass for a projection, dotted paths become attributes with '_' so org.id reads as org_id
+    """
+    key = (name, tuple(fields))
+    if key not in _record_classes:
+        slots = tuple(str(f.replace('.', '_')) for f in fields)
+        _record_classes[key] = type('%sRecord' % name, (Record,), {'__slots__': slots, '_paths': tuple(fields)})
+    return _record_classes[key]
@@ -0,0 +1,25 @@
+import argparse
+import logging
+
+from ureport_data import routing
+from ureport_data.models import Org
+import settings
+
+logging.basicConfig(format=settings.FORMAT)
+
+__author__ = 'kenneth'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Move orgs' synced documents to another storage layout")
+    parser.add_argument('api_key', nargs='+', help="API keys of the orgs to move")
+    parser.add_argument('--storage', required=True, choices=routing.LAYOUTS,
+                        help="shared collections, collections of the org's own or a database of its own")
+    parser.add_argument('--namespace', help="Prefix of the org's collections or suffix of its database, "
+                                            "org_<org id> by default")
+    parser.add_argument('--batch-size', type=int, default=settings.RELOCATE_BATCH_SIZE,
+                        help="Documents copied per batch")
+    args = parser.parse_args()
+
+    for org in [Org.find_one({'api_token': api_key}) for api_key in args.api_key]:
+        print org.name, org.relocate(args.storage, namespace=args.namespace, batch_size=args.batch_size)
@@ -0,0 +1,120 @@
+import threading
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+from humongolus import mongo
+
+import settings
+
+__author__ = 'kenneth'
+
+# where an org's synced documents live: the shared collections, collections of its own in the main database
+# (<namespace>.<collection>) or a database of its own (<database>_<namespace>)
+SHARED, COLLECTION, DATABASE = LAYOUTS = ('shared', 'collection', 'database')
+
+_local = threading.local()
+_lock = threading.Lock()
+# org id: (storage, namespace, time read)
+_layouts = {}
+
+
+def default_namespace(org_id):
+    return 'org_%s' % org_id
+
+
+def register(org):
+    """
+    Caches the storage layout of an org document, returns the org's id
+    """
+    storage = getattr(org, 'storage', None) or SHARED
+    if storage not in LAYOUTS:
+        raise ValueError("Unknown storage %s for Org %s, use one of %s" % (storage, org._id, ', '.join(LAYOUTS)))
+    with _lock:
+        _layouts[org._id] = (storage, getattr(org, 'namespace', None) or default_namespace(org._id), time.time())
+    return org._id
+
+
+def layout(org_id):
+    """
+    (storage, namespace) of an org, read from the orgs collection when it is not cached or the cached one is older
+    than ROUTING_CACHE_TTL
+    """
+    cached = _layouts.get(org_id)
+    if cached is None or time.time() - cached[2] > settings.ROUTING_CACHE_TTL:
+        doc = settings.CONNECTION[settings.DATABASE]['orgs'].find_one({'_id': org_id},
+                                                                       fields={'storage': 1, 'namespace': 1}) or {}
+        cached = (doc.get('storage') or SHARED, doc.get('namespace') or default_namespace(org_id), time.time())
+        with _lock:
+            _layouts[org_id] = cached
+    return cached[:2]
+
+
+def locate(database, collection, org_id=None, storage=None, namespace=None):
+    """
+    (database, collection) of an org's documents of `collection`, in its own layout or in the one given
+    """
+    if org_id is None:
+        return database, collection
+    if storage is None:
+        storage, namespace = layout(org_id)
+    namespace = namespace or default_namespace(org_id)
+    if storage == COLLECTION:
+        return database, '%s.%s' % (namespace, collection)
+    if storage == DATABASE:
+        return '%s_%s' % (database, namespace), collection
+    return database, collection
+
+
+def collection(cls, org_id=None, storage=None, namespace=None):
+    """
+    The collection of `cls` holding the documents of an org, the current one by default
+    """
+    if org_id is None:
+        org_id = current()
+    key = (cls,) + locate(cls._db, cls._collection, org_id, storage=storage, namespace=namespace)
+    # humongolus collections keep the as_dict flag of their last find on themselves, so each thread reuses its own
+    # rather than sharing one, and rather than building one for every document
+    collections = getattr(_local, 'collections', None)
+    if collections is None:
+        collections = _local.collections = {}
+    coll = collections.get(key)
+    if coll is None:
+        coll = collections[key] = mongo.Collection(cls, database=settings.CONNECTION[key[1]], name=key[2])
+    return coll
+
+
+def current():
+    return getattr(_local, 'org_id', None)
+
+
+def activate(org_id):
+    """
+    Makes the calling thread read and write the documents of an org, used by threads working for another's org
+    """
+    _local.org_id = org_id
+
+
+@contextmanager
+def using(org):
+    """
+    Routes the documents read and written by the calling thread to an org's storage, `org` being an org document or
+    id
+    """
+    previous = current()
+    activate(org if org is None or not hasattr(org, '_id') else register(org))
+    try:
+        yield org
+    finally:
+        activate(previous)
+
+
+def routed(method):
+    """
+    Runs a method whose first argument after cls or self is the org in that org's storage
+    """
+    @wraps(method)
+    def wrapper(owner, org, *args, **kwargs):
+        with using(org):
+            return method(owner, org, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,106 @@
+import argparse
+import logging
+import time
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from temba_client.exceptions import TembaException
+
+from ureport_data import clients, metrics, profiling
+from ureport_data.models import Org, Message, Run, Contact, Flow, ref_cache
+import settings
+
+logging.basicConfig(format=settings.FORMAT)
+logger = logging.getLogger("runner")
+
+__author__ = 'kenneth'
+
+ENTITIES = {'Message': Message, 'Run': Run, 'Contact': Contact}
+
+
+def sync(org, entity, af=None, profile=None):
+    flows = entity.get('flows', None)
+    cls = ENTITIES[entity['name']] if type(entity['name']) in [str, unicode] else entity['name']
+    start = time.time()
+    with metrics.task(cls.__name__, org=org.name, flow=flows) as scope:
+        try:
+            logger.info("Fetching Object of type: %s for Org: %s", cls.__name__, org.name)
+            with profiling.profiled(org.name, cls.__name__, force=profile, flow=flows):
+                if flows:
+                    cls.fetch_objects(org, af=af, flows=flows)
+                else:
+                    cls.fetch_objects(org, af=af)
+            status = 'ok'
+        except TembaException as e:
+            logger.error("Temba is misbehaving for Org %s: %s", org.name, str(e))
+            status = 'failed'
+        except Exception:
+            logger.error("Things are dead for Org %s: %s", org.name, traceback.format_exc())
+            status = 'failed'
+        scope.status = status
+    return {'org': org.name, 'entity': cls.__name__, 'flows': flows, 'status': status, 'seconds': time.time() - start}
+
+
+def run(entities=None, orgs=None, af=None, concurrency=None, requests=None, profile=None):
+    """
+    Syncs every (org, entity) stream from a single process. Streams run on a pool of `concurrency` threads and the
+    number of API requests in flight is capped at `requests` through the shared client pool.
+    """
+    if not entities:
+        entities = [{'name': Message}, {'name': Run}, {'name': Contact}]
+    if not orgs:
+        orgs = list(Org.find({"is_active": True}))
+    else:
+        orgs = [Org.find_one({'api_token': api_key}) for api_key in orgs]
+    jobs = []
+    for org in orgs:
+        for entity in entities:
+            flows = entity.get('flows', None)
+            if flows is None and ENTITIES.get(entity['name'], entity['name']) is Run:
+                flows = Flow.due_for_run_sync(org, af=af)
+            if isinstance(flows, (list, tuple)):
+                jobs.extend((org, dict(entity, flows=flow)) for flow in flows)
+            else:
+                jobs.append((org, entity))
+    if not jobs:
+        return []
+
+    clients.registry.limit_requests(settings.RUNNER_MAX_REQUESTS if requests is None else requests)
+    started = time.time()
+    pool = ThreadPool(concurrency or settings.RUNNER_CONCURRENCY)
+    try:
+        results = pool.map(lambda job: sync(job[0], job[1], af=af, profile=profile), jobs)
+    finally:
+        pool.close()
+        pool.join()
+    failed = [r for r in results if r['status'] != 'ok']
+    logger.info("Sync of %d org entities finished in %.1f seconds, %d failed", len(results), time.time() - started,
+                len(failed))
+    logger.info("Reference cache: %s, clients: %s", ref_cache.stats(), clients.registry.stats())
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Sync orgs from one process without Celery")
+    parser.add_argument('orgs', nargs='*', help="API keys of the orgs to sync, all active orgs by default")
+    parser.add_argument('--entity', action='append', choices=sorted(ENTITIES.keys()), help="Entities to sync")
+    parser.add_argument('--flow', action='append', help="Only sync the runs of these flows")
+    parser.add_argument('--concurrency', type=int, default=settings.RUNNER_CONCURRENCY,
+                        help="Number of streams synced at the same time")
+    parser.add_argument('--requests', type=int, default=settings.RUNNER_MAX_REQUESTS,
+                        help="Maximum API requests in flight, 0 for no limit")
+    parser.add_argument('--all', action='store_true', help="Refetch everything instead of syncing incrementally")
+    parser.add_argument('--metrics-port', type=int, default=settings.METRICS_PORT,
+                        help="Serve Prometheus metrics on this port while syncing, 0 to not serve them")
+    parser.add_argument('--profile', choices=profiling.MODES,
+                        help="Profile every stream, by default only the ones PROFILE_TASKS selects")
+    args = parser.parse_args()
+
+    if args.metrics_port:
+        metrics.start_server(args.metrics_port)
+
+    entities = [{'name': name} for name in args.entity] if args.entity else None
+    if args.flow:
+        entities = [{'name': 'Run', 'flows': args.flow}]
+    run(entities=entities, orgs=args.orgs, af=args.all or None, concurrency=args.concurrency, requests=args.requests,
+        profile=args.profile)
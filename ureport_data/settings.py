@@ -2,22 +2,130 @@ import datetime
 import os
 from pymongo import Connection
 
-DATABASE = "rapidpro"
+DATABASE = os.environ.get("DATABASE", "rapidpro")
 CONNECTION = Connection()
 FORMAT = '%(asctime)-15s %(message)s'
 SITE_API_HOST = 'https://app.rapidpro.io/api/v2'
-API_ENDPOINT = 'https://app.rapidpro.io'
+API_ENDPOINT = os.environ.get('API_ENDPOINT', 'https://app.rapidpro.io')
 BROKER_URL = 'redis://'
+RESULT_BACKEND = os.environ.get('RESULT_BACKEND', BROKER_URL)
 
 cron_minutes = int(os.environ.get('FETCH_SLEEP', 60*24*2))
+# minutes between the beats that sync runs
+RUN_SYNC_MINUTES = int(os.environ.get('RUN_SYNC_MINUTES', 5))
+# seconds a sync pass that hasn't saved a page counts as running, a running pass's flow isn't synced again
+SYNC_PASS_STALE_SECONDS = int(os.environ.get('SYNC_PASS_STALE_SECONDS', 30*60))
 
 CELERYBEAT_SCHEDULE = {
     'sync-contacts': {
         'task': 'ureport_data.tasks.fetch_all',
         'schedule': datetime.timedelta(minutes=cron_minutes),
         'args': ()
+    },
+    'sync-runs': {
+        'task': 'ureport_data.tasks.fetch_all',
+        'schedule': datetime.timedelta(minutes=RUN_SYNC_MINUTES),
+        'kwargs': {'entities': [{'name': 'Run'}]}
+    },
+    'retry-backfill': {
+        'task': 'ureport_data.tasks.retry_backfill',
+        'schedule': datetime.timedelta(minutes=int(os.environ.get('BACKFILL_RETRY_MINUTES', 60))),
+        'args': ()
+    },
+    'sync-boundaries': {
+        'task': 'ureport_data.tasks.sync_boundaries',
+        'schedule': datetime.timedelta(days=int(os.environ.get('BOUNDARY_SYNC_DAYS', 7))),
+        'args': ()
     }
 }
 
+# minutes between run syncs of a flow, 0 syncs archived flows only once
+RUN_SYNC_ACTIVE_INTERVAL = int(os.environ.get('RUN_SYNC_ACTIVE_INTERVAL', 5))
+RUN_SYNC_ARCHIVED_INTERVAL = int(os.environ.get('RUN_SYNC_ARCHIVED_INTERVAL', 0))
+
 RETRY_MAX_ATTEMPTS = int(os.environ.get('RETRY_MAX_ATTEMPTS', 10))
-RETRY_WAIT_FIXED = int(os.environ.get('RETRY_WAIT_FIXED', 15*60*1000))
+RETRY_BACKOFF_BASE = int(os.environ.get('RETRY_BACKOFF_BASE', 60))
+RETRY_BACKOFF_MAX = int(os.environ.get('RETRY_BACKOFF_MAX', 60*60))
+RETRY_JITTER = int(os.environ.get('RETRY_JITTER', 30))
+
+BULK_WRITES = os.environ.get('BULK_WRITES', 'true').lower() == 'true'
+BULK_WRITES_ORDERED = os.environ.get('BULK_WRITES_ORDERED', 'false').lower() == 'true'
+
+ENSURE_INDEXES = os.environ.get('ENSURE_INDEXES', 'true').lower() == 'true'
+
+API_POOL_CONNECTIONS = int(os.environ.get('API_POOL_CONNECTIONS', 4))
+API_POOL_MAXSIZE = int(os.environ.get('API_POOL_MAXSIZE', 10))
+API_CONNECT_TIMEOUT = float(os.environ.get('API_CONNECT_TIMEOUT', 10))
+API_READ_TIMEOUT = float(os.environ.get('API_READ_TIMEOUT', 120))
+
+SYNC_GLOBAL_CONCURRENCY = int(os.environ.get('SYNC_GLOBAL_CONCURRENCY', 0))
+SYNC_ORG_CONCURRENCY = int(os.environ.get('SYNC_ORG_CONCURRENCY', 2))
+SYNC_SLOT_WAIT = int(os.environ.get('SYNC_SLOT_WAIT', 30))
+SYNC_SLOT_TTL = int(os.environ.get('SYNC_SLOT_TTL', 6*60*60))
+SYNC_SLOT_MAX_WAITS = int(os.environ.get('SYNC_SLOT_MAX_WAITS', 240))
+
+REF_CACHE_MAX_ENTRIES = int(os.environ.get('REF_CACHE_MAX_ENTRIES', 50000))
+REF_CACHE_MAX_BYTES = int(os.environ.get('REF_CACHE_MAX_BYTES', 64*1024*1024))
+REF_CACHE_TTL = int(os.environ.get('REF_CACHE_TTL', 60*60))
+REF_CACHE_NEGATIVE_TTL = int(os.environ.get('REF_CACHE_NEGATIVE_TTL', 10*60))
+
+PIPELINE_SYNC = os.environ.get('PIPELINE_SYNC', 'true').lower() == 'true'
+PIPELINE_PREFETCH_PAGES = int(os.environ.get('PIPELINE_PREFETCH_PAGES', 2))
+
+RUNNER_CONCURRENCY = int(os.environ.get('RUNNER_CONCURRENCY', 8))
+RUNNER_MAX_REQUESTS = int(os.environ.get('RUNNER_MAX_REQUESTS', 8))
+
+EXPORT_ROOT = os.environ.get('EXPORT_ROOT', 'export')
+EXPORT_BATCH_SIZE = int(os.environ.get('EXPORT_BATCH_SIZE', 1000))
+EXPORT_ROWS_PER_FILE = int(os.environ.get('EXPORT_ROWS_PER_FILE', 100000))
+
+RAW_BATCH_SIZE = int(os.environ.get('RAW_BATCH_SIZE', 1000))
+
+FRAME_CHUNKSIZE = int(os.environ.get('FRAME_CHUNKSIZE', 10000))
+FRAME_MAX_BYTES = int(os.environ.get('FRAME_MAX_BYTES', 1024*1024*1024))
+
+AGGREGATE_RESPONSES = os.environ.get('AGGREGATE_RESPONSES', 'true').lower() == 'true'
+AGGREGATE_BY_GROUP = os.environ.get('AGGREGATE_BY_GROUP', 'true').lower() == 'true'
+AGGREGATE_BY_DAY = os.environ.get('AGGREGATE_BY_DAY', 'true').lower() == 'true'
+
+# store new runs with dictionary encoded nodes/categories and relative times, see ureport_data.compact
+COMPACT_RUNS = os.environ.get('COMPACT_RUNS', 'false').lower() == 'true'
+
+# degrees of simplification tolerance per map zoom level
+BOUNDARY_ZOOM_TOLERANCES = {4: 0.05, 8: 0.005, 12: 0.0005}
+# contact fields holding a contact's location, from the top level boundary down
+CONTACT_LOCATION_FIELDS = [f for f in os.environ.get('CONTACT_LOCATION_FIELDS', 'state,district,ward').split(',') if f]
+# seconds a worker reuses an org's boundary names to locate synced contacts, a boundary sync refreshes them at once
+BOUNDARY_NAMES_TTL = int(os.environ.get('BOUNDARY_NAMES_TTL', 10*60))
+
+# port of the Prometheus /metrics endpoint, 0 disables it. Celery workers merge the dumps their pool processes
+# write to METRICS_DIR after every task, so both have to be set there.
+METRICS_PORT = int(os.environ.get('METRICS_PORT', 0))
+METRICS_DIR = os.environ.get('METRICS_DIR', '')
+METRICS_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 900]
+
+# org:entity patterns of the syncs to profile, e.g. "Uganda:Run,*:Contact"; fetch_all/fetch_org_entity also take
+# profile=True|'sample'|'cprofile' to profile a single dispatch
+PROFILE_TASKS = [p for p in os.environ.get('PROFILE_TASKS', '').split(',') if p]
+PROFILE_MODE = os.environ.get('PROFILE_MODE', 'sample')
+PROFILE_DIR = os.environ.get('PROFILE_DIR', 'profiles')
+PROFILE_SAMPLE_INTERVAL = float(os.environ.get('PROFILE_SAMPLE_INTERVAL', 0.005))
+
+# references resolved per $in query, the API is asked for them one at a time
+FETCH_MAX_UUIDS = int(os.environ.get('FETCH_MAX_UUIDS', 50))
+
+# full refetches (af) sync each stream's history as windows of BACKFILL_WINDOW_DAYS days in parallel tasks, from
+# BACKFILL_START (a flow's creation for its runs) on, the oldest window taking everything before it too
+BACKFILL_FULL_SYNCS = os.environ.get('BACKFILL_FULL_SYNCS', 'true').lower() == 'true'
+BACKFILL_START = os.environ.get('BACKFILL_START', '2014-01-01')
+BACKFILL_WINDOW_DAYS = int(os.environ.get('BACKFILL_WINDOW_DAYS', 30))
+# pending or running windows not saved for this long are dispatched again by retry_backfill, which runs every
+# BACKFILL_RETRY_MINUTES, and no longer hold up incremental syncs of their stream
+BACKFILL_STALE_SECONDS = int(os.environ.get('BACKFILL_STALE_SECONDS', 6*60*60))
+
+# storage layout of new orgs: shared, collection (collections of their own) or database (a database of their own),
+# see ureport_data.routing and ureport_data.relocate to move an org
+ORG_STORAGE = os.environ.get('ORG_STORAGE', 'shared')
+# seconds an org's layout is cached for before it is read again
+ROUTING_CACHE_TTL = int(os.environ.get('ROUTING_CACHE_TTL', 5*60))
+RELOCATE_BATCH_SIZE = int(os.environ.get('RELOCATE_BATCH_SIZE', 1000))
@@ -0,0 +1,262 @@
+import argparse
+import BaseHTTPServer
+import json
+import SocketServer
+import threading
+import time
+import urllib
+from datetime import datetime, timedelta
+from urlparse import urlparse, parse_qs
+
+__author__ = 'kenneth'
+
+BASE_TIME = datetime(2017, 1, 1)
+
+# prefix of the synthetic uuids of each endpoint, the item's index is the last group of the uuid
+ENDPOINTS = {
+    'groups': 1,
+    'labels': 2,
+    'contacts': 3,
+    'flows': 4,
+    'broadcasts': 5,
+    'messages': 6,
+    'runs': 7,
+}
+
+DEFAULT_VOLUMES = {
+    'groups': 20,
+    'labels': 10,
+    'contacts': 5000,
+    'flows': 10,
+    'broadcasts': 50,
+    'messages': 20000,
+    'runs': 20000,
+}
+
+CATEGORIES = ['Yes', 'No', 'Other']
+NODES_PER_FLOW = 3
+# prefix of the uuids of flow nodes
+NODES = 8
+
+
+def uuid_for(endpoint, index):
+    return '%08x-0000-4000-8000-%012x' % (ENDPOINTS.get(endpoint, endpoint), index)
+
+
+def index_of(uuid):
+    return int(uuid.split('-')[-1], 16)
+
+
+def timestamp(index):
+    return (BASE_TIME + timedelta(seconds=index)).strftime('%Y-%m-%dT%H:%M:%S.%fZ')
+
+
+def parse_time(value):
+    value = value.rstrip('Z')
+    seconds, _, fraction = value.partition('.')
+    parsed = datetime.strptime(seconds, '%Y-%m-%dT%H:%M:%S')
+    return parsed.replace(microsecond=int((fraction + '000000')[:6])) if fraction else parsed
+
+
+class SyntheticData(object):
+    """
+    Deterministic RapidPro v2 objects generated from their index, item i of an endpoint is created and modified
+    i seconds after BASE_TIME so `after`/`before` filters and cursors are plain index arithmetic
+    """
+    def __init__(self, volumes=None):
+        self.volumes = dict(DEFAULT_VOLUMES)
+        self.volumes.update(volumes or {})
+
+    def grow(self, endpoint, count):
+        """
+        Adds `count` new items to an endpoint, newer than every existing one
+        """
+        self.volumes[endpoint] += count
+
+    def ref(self, endpoint, index):
+        return {'uuid': uuid_for(endpoint, index), 'name': '%s %d' % (endpoint.rstrip('s').capitalize(), index)}
+
+    def groups(self, i):
+        return dict(self.ref('groups', i), query=None, count=self.volumes['contacts'] // self.volumes['groups'])
+
+    def labels(self, i):
+        return dict(self.ref('labels', i), count=self.volumes['messages'] // self.volumes['labels'])
+
+    def contacts(self, i):
+        return dict(self.ref('contacts', i), language='eng', urns=['tel:+2567%08d' % i],
+                    groups=[self.ref('groups', i % self.volumes['groups'])],
+                    fields={'state': 'State %d' % (i % 10), 'district': 'District %d' % (i % 50)},
+                    blocked=False, stopped=False, created_on=timestamp(i), modified_on=timestamp(i))
+
+    def flows(self, i):
+        runs = self.volumes['runs'] // self.volumes['flows']
+        return dict(self.ref('flows', i), archived=i % 5 == 4, labels=[], expires=720, created_on=timestamp(i),
+                    runs={'active': 0, 'completed': runs, 'interrupted': 0, 'expired': 0})
+
+    def broadcasts(self, i):
+        return {'id': i + 1, 'urns': [], 'contacts': [], 'groups': [self.ref('groups', i % self.volumes['groups'])],
+                'text': 'Broadcast %d' % i, 'created_on': timestamp(i)}
+
+    def messages(self, i):
+        incoming = i % 2 == 0
+        return {'id': i + 1, 'broadcast': None if incoming else i % self.volumes['broadcasts'] + 1,
+                'contact': self.ref('contacts', i % self.volumes['contacts']), 'urn': 'tel:+2567%08d' % i,
+                'channel': None, 'direction': 'in' if incoming else 'out', 'type': 'inbox' if incoming else 'flow',
+                'status': 'handled' if incoming else 'sent', 'visibility': 'visible', 'text': 'Message %d' % i,
+                'labels': [self.ref('labels', i % self.volumes['labels'])] if i % 3 == 0 else [],
+                'created_on': timestamp(i), 'sent_on': timestamp(i), 'modified_on': timestamp(i)}
+
+    def runs(self, i):
+        flow = i % self.volumes['flows']
+        nodes = [uuid_for(NODES, flow * NODES_PER_FLOW + n) for n in range(NODES_PER_FLOW)]
+        values = dict(('result_%d' % n, {'value': 'answer %d' % (i % 7), 'category': CATEGORIES[(i + n) % 3],
+                                         'node': node, 'time': timestamp(i)}) for n, node in enumerate(nodes))
+        return {'id': i + 1, 'flow': self.ref('flows', flow),
+                'contact': self.ref('contacts', i % self.volumes['contacts']), 'start': None, 'responded': True,
+                'path': [{'node': node, 'time': timestamp(i)} for node in nodes], 'values': values,
+                'created_on': timestamp(i), 'modified_on': timestamp(i), 'exited_on': timestamp(i),
+                'exit_type': 'completed'}
+
+    def select(self, endpoint, params):
+        """
+        The indexes matching a request's filters, as a list or an xrange
+        """
+        start, stop, step = 0, self.volumes[endpoint], 1
+        # like the API, a single uuid or id filters, the last one when a request repeats the parameter
+        if params.get('uuid'):
+            return [i for i in [index_of(params['uuid'][-1])] if 0 <= i < stop]
+        if params.get('id'):
+            return [i for i in [int(params['id'][-1]) - 1] if 0 <= i < stop]
+        if endpoint == 'runs' and params.get('flow'):
+            start, step = index_of(params['flow'][0]), self.volumes['flows']
+        if params.get('after'):
+            after = parse_time(params['after'][0]) - BASE_TIME
+            first = int(after.total_seconds()) + (1 if after.microseconds else 0)
+            start += max(0, (first - start + step - 1) // step) * step
+        if params.get('before'):
+            before = parse_time(params['before'][0]) - BASE_TIME
+            stop = min(stop, int(before.total_seconds()) + 1)
+        return xrange(start, max(start, stop), step)
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        standin = self.server.standin
+        url = urlparse(self.path)
+        endpoint = url.path.rstrip('/').split('/')[-1].replace('.json', '')
+        params = parse_qs(url.query)
+        if endpoint not in ENDPOINTS:
+            return self.respond(404, {'detail': 'Not found'})
+        if not standin.admit(self.headers.get('Authorization')):
+            return self.respond(429, {'detail': 'Request was throttled'}, headers={'Retry-After': '1'})
+        if standin.latency:
+            time.sleep(standin.latency)
+
+        selected = standin.data.select(endpoint, params)
+        offset = int(params.pop('cursor', ['0'])[0])
+        page = [selected[i] for i in xrange(offset, min(offset + standin.page_size, len(selected)))]
+        next_url = None
+        if offset + standin.page_size < len(selected):
+            query = [(key, value) for key, values in params.items() for value in values]
+            query.append(('cursor', offset + standin.page_size))
+            next_url = 'http://%s:%d%s?%s' % (self.server.server_address + (url.path, urllib.urlencode(query)))
+        generate = getattr(standin.data, endpoint)
+        standin.record(endpoint, len(page))
+        self.respond(200, {'next': next_url, 'previous': None, 'results': [generate(i) for i in page]})
+
+    def respond(self, status, body, headers=None):
+        content = json.dumps(body)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, *args):
+        pass
+
+
+class Server(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+
+class StandIn(object):
+    """
+    Local stand-in for the RapidPro v2 API serving synthetic data with cursor pagination, a fixed latency per request
+    and an optional per token rate limit (requests per second, answered with 429 and Retry-After past it)
+    """
+    def __init__(self, volumes=None, page_size=250, latency=0.0, rate_limit=0, host='127.0.0.1', port=0):
+        self.data = SyntheticData(volumes)
+        self.page_size = page_size
+        self.latency = latency
+        self.rate_limit = rate_limit
+        self.lock = threading.Lock()
+        self.windows = {}
+        self.requests = {}
+        self.items = {}
+        self.throttled = 0
+        self.server = Server((host, port), Handler)
+        self.server.standin = self
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%d' % self.server.server_address
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, name='standin')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def admit(self, token):
+        if not self.rate_limit:
+            return True
+        second = int(time.time())
+        with self.lock:
+            window, count = self.windows.get(token, (second, 0))
+            if window != second:
+                window, count = second, 0
+            if count >= self.rate_limit:
+                self.throttled += 1
+                return False
+            self.windows[token] = (window, count + 1)
+            return True
+
+    def record(self, endpoint, items):
+        with self.lock:
+            self.requests[endpoint] = self.requests.get(endpoint, 0) + 1
+            self.items[endpoint] = self.items.get(endpoint, 0) + items
+
+    def stats(self):
+        with self.lock:
+            return {'requests': dict(self.requests), 'items': dict(self.items), 'throttled': self.throttled,
+                    'total_requests': sum(self.requests.values()) + self.throttled}
+
+    def reset_stats(self):
+        with self.lock:
+            self.requests, self.items, self.throttled = {}, {}, 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Serve synthetic data through a local RapidPro v2 API stand-in")
+    parser.add_argument('--port', type=int, default=8000)
+    parser.add_argument('--page-size', type=int, default=250)
+    parser.add_argument('--latency', type=float, default=0.0, help="Seconds added to every request")
+    parser.add_argument('--rate-limit', type=int, default=0, help="Requests per second per token, 0 for no limit")
+    for endpoint in sorted(ENDPOINTS):
+        parser.add_argument('--%s' % endpoint, type=int, default=DEFAULT_VOLUMES[endpoint])
+    args = parser.parse_args()
+
+    standin = StandIn(volumes=dict((endpoint, getattr(args, endpoint)) for endpoint in ENDPOINTS),
+                      page_size=args.page_size, latency=args.latency, rate_limit=args.rate_limit, port=args.port)
+    print "Serving the RapidPro API stand-in on %s" % standin.url
+    standin.server.serve_forever()
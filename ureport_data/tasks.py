@@ -1,11 +1,19 @@
 import logging
+import random
+import time
 import traceback
-from celery import Celery
+from uuid import uuid4
+from bson import ObjectId
+from celery import Celery, chord
+from celery.signals import worker_init
+import redis
 import requests
-from retrying import retry
-from temba_client.exceptions import TembaException, TembaConnectionError
+from temba_client.exceptions import TembaException, TembaConnectionError, TembaHttpError, TembaRateExceededError, \
+    TembaBadRequestError, TembaTokenError, TembaNoSuchObjectError
 
-from ureport_data.models import Org, BaseDocument, Message, Run, Contact
+from ureport_data import metrics, profiling
+from ureport_data.models import Org, Backfill, BaseDocument, Message, Run, Contact, Flow, Boundary, ensure_indexes, \
+    ref_cache
 import settings
 
 logging.basicConfig(format=settings.FORMAT)
@@ -17,35 +25,218 @@ app = Celery('ureport_data.tasks', broker=settings.BROKER_URL)
 
 app.conf.update(
     CELERY_TASK_RESULT_EXPIRES=3600,
+    CELERY_RESULT_BACKEND=settings.RESULT_BACKEND,
     CELERYBEAT_SCHEDULE=settings.CELERYBEAT_SCHEDULE
 )
 
 
+@worker_init.connect
+def ensure_indexes_on_startup(**kwargs):
+    if settings.ENSURE_INDEXES:
+        ensure_indexes()
+    if settings.METRICS_PORT:
+        metrics.start_server(settings.METRICS_PORT, directory=settings.METRICS_DIR)
+
+
+_redis = None
+GLOBAL_SLOTS_KEY = 'ureport_data:slot_holders:global'
+ORG_SLOTS_KEY = 'ureport_data:slot_holders:org:%s'
+
+
+def get_redis():
+    global _redis
+    if _redis is None:
+        _redis = redis.StrictRedis.from_url(settings.BROKER_URL)
+    return _redis
+
+
+def acquire_slot(key, limit, holder):
+    """
+    Takes one of `limit` slots for `holder`. Every holder's slot expires SYNC_SLOT_TTL seconds after it was taken, so
+    slots of workers that died holding them free up; a failed attempt leaves the other holders' expiries alone.
+    """
+    if not limit:
+        return True
+    now = time.time()
+    conn = get_redis()
+    conn.zremrangebyscore(key, '-inf', now)
+    conn.execute_command('ZADD', key, now + settings.SYNC_SLOT_TTL, holder)
+    if conn.zcard(key) > limit:
+        conn.zrem(key, holder)
+        return False
+    conn.expire(key, settings.SYNC_SLOT_TTL)
+    return True
+
+
+def release_slot(key, limit, holder):
+    if limit:
+        get_redis().zrem(key, holder)
+
+
+def wait_for_slot(task, kwargs, entity, api_key):
+    """
+    Sends the task back to the broker until a slot frees up, or gives up after SYNC_SLOT_MAX_WAITS tries
+    """
+    if (task.request.retries or 0) >= settings.SYNC_SLOT_MAX_WAITS:
+        logger.warning("No sync slot for %s of Org %s after %d tries - Giving up", entity, api_key,
+                       task.request.retries)
+        return 'skipped'
+    raise task.retry(kwargs=kwargs, countdown=settings.SYNC_SLOT_WAIT, max_retries=None)
+
+
+def _response(exception):
+    caused_by = getattr(exception, 'caused_by', None)
+    return caused_by.response if isinstance(caused_by, requests.HTTPError) else None
+
+
 def retry_if_temba_api_or_connection_error(exception):
-    if isinstance(exception, TembaException) and isinstance(exception.caused_by,
-                                                            requests.HTTPError
-                                                            ) and 399 < exception.caused_by.response.status_code < 500:
+    if isinstance(exception, TembaRateExceededError):
+        return True
+    if isinstance(exception, (TembaBadRequestError, TembaTokenError, TembaNoSuchObjectError)):
+        return False
+    response = _response(exception)
+    if response is not None and 399 < response.status_code < 500 and response.status_code != 429:
         return False
-    logger.warning("Raised an exception: %s - Retrying in %s minutes", str(exception),
-                   str(settings.RETRY_WAIT_FIXED / 60000))
     return isinstance(exception, TembaException) or isinstance(exception, TembaConnectionError)
 
 
-@retry(retry_on_exception=retry_if_temba_api_or_connection_error, stop_max_attempt_number=settings.RETRY_MAX_ATTEMPTS,
-       wait_fixed=settings.RETRY_WAIT_FIXED)
-def fetch_entity(entity, org, af=None):
+def retry_countdown(exception, attempt):
+    """
+    Seconds to wait before the next attempt: RapidPro's Retry-After when it sent one, otherwise exponential backoff
+    with jitter, capped at RETRY_BACKOFF_MAX
+    """
+    retry_after = getattr(exception, 'retry_after', None)
+    response = _response(exception)
+    if not retry_after and response is not None and response.headers.get('retry-after', '').isdigit():
+        retry_after = int(response.headers['retry-after'])
+    if retry_after:
+        return retry_after + random.randint(0, settings.RETRY_JITTER)
+    backoff = min(settings.RETRY_BACKOFF_MAX, settings.RETRY_BACKOFF_BASE * 2 ** attempt)
+    return int(random.uniform(backoff / 2.0, backoff))
+
+
+def fetch_entity(entity, org, af=None, profile=None):
     flows = entity.get('flows', None)
     entity = eval(entity.get('name')) if type(entity.get('name')) in [str, unicode] else entity.get('name')
     logger.info("Fetching Object of type: %s for Org: %s on Page", str(entity), org.name)
-    if flows:
-        logger.info("Fetching Runs for flows %s", str(flows))
-        entity.fetch_objects(org, af=af, **{'flows': flows})
-    else:
-        entity.fetch_objects(org, af=af)
+    with profiling.profiled(org.name, entity.__name__, force=profile, flow=flows):
+        if flows:
+            logger.info("Fetching Runs for flows %s", str(flows))
+            entity.fetch_objects(org, af=af, **{'flows': flows})
+        else:
+            entity.fetch_objects(org, af=af)
+
+
+def entity_name(entity):
+    name = entity.get('name')
+    return name if type(name) in [str, unicode] else name.__name__
+
+
+def entity_flows(org, entity, af=None):
+    """
+    The flows an entity is synced for, one stream each. Runs without explicit flows are synced for the flows due.
+    """
+    flows = entity.get('flows', None)
+    if isinstance(flows, (list, tuple)):
+        return list(flows)
+    if flows is None and entity_name(entity) == Run.__name__:
+        return Flow.due_for_run_sync(org, af=af)
+    return [flows]
+
+
+def run_sync(task, api_key, entity, sync, kwargs, attempt=0, **labels):
+    """
+    Runs sync(org) holding a global and a per org slot. Failures worth retrying are sent back to the broker with a
+    countdown instead of sleeping in the worker, with `kwargs` and the next attempt, and so are tasks waiting for a
+    slot. Returns the sync's status.
+    """
+    org_key = ORG_SLOTS_KEY % api_key
+    holder = uuid4().hex
+    if not acquire_slot(GLOBAL_SLOTS_KEY, settings.SYNC_GLOBAL_CONCURRENCY, holder):
+        return wait_for_slot(task, kwargs, entity, api_key)
+    if not acquire_slot(org_key, settings.SYNC_ORG_CONCURRENCY, holder):
+        release_slot(GLOBAL_SLOTS_KEY, settings.SYNC_GLOBAL_CONCURRENCY, holder)
+        return wait_for_slot(task, kwargs, entity, api_key)
+
+    status = 'ok'
+    retry_in = None
+    with metrics.task(entity, attempt=attempt, **labels) as scope:
+        try:
+            org = Org.find_one({'api_token': api_key})
+            scope.label(org=org.name)
+            sync(org)
+        except Exception as e:
+            if retry_if_temba_api_or_connection_error(e) and attempt + 1 < settings.RETRY_MAX_ATTEMPTS:
+                retry_in = retry_countdown(e, attempt)
+                logger.warning("Raised an exception: %s - Retrying in %s seconds", str(e), retry_in)
+                metrics.inc('retries', kind='task')
+            elif isinstance(e, TembaException):
+                logger.error("Temba is misbehaving: %s - No retry", str(e))
+            else:
+                logger.error("Things are dead: %s - No retry", str(traceback.format_exc()))
+            status = 'failed'
+        finally:
+            release_slot(org_key, settings.SYNC_ORG_CONCURRENCY, holder)
+            release_slot(GLOBAL_SLOTS_KEY, settings.SYNC_GLOBAL_CONCURRENCY, holder)
+        scope.status = 'retried' if retry_in is not None else status
+    logger.info("Reference cache: %s", ref_cache.stats())
+    if retry_in is not None:
+        raise task.retry(kwargs=dict(kwargs, attempt=attempt + 1), countdown=retry_in, max_retries=None)
+    return status
+
+
+@app.task(bind=True)
+def fetch_org_entity(self, api_key, entity, af=None, attempt=0, profile=None):
+    """
+    Syncs one (org, entity) stream, the next attempt after a failure resumes from the stream's last committed page.
+    profile forces or prevents profiling the sync, see profiling.profiled.
+    """
+    def sync(org):
+        logger.info('Entity %s' % entity)
+        fetch_entity(entity, org, af=af, profile=profile)
+
+    start = time.time()
+    status = run_sync(self, api_key, entity_name(entity), sync, {'af': af, 'attempt': attempt, 'profile': profile},
+                      attempt=attempt, flow=entity.get('flows'))
+    return {'org': api_key, 'entity': entity, 'status': status, 'seconds': time.time() - start}
+
+
+@app.task(bind=True)
+def backfill_window(self, api_key, window_id, attempt=0, profile=None):
+    """
+    Syncs one window of a backfill, retried like fetch_org_entity. A window failing for good is left failed with its
+    cursor for retry_backfill to send again.
+    """
+    window = Backfill.find_one({'_id': ObjectId(window_id)})
+    entity = {'name': window.entity, 'flows': window.flow, 'window': window.label}
+    if window.status == Backfill.DONE:
+        return {'org': api_key, 'entity': entity, 'status': 'ok', 'seconds': 0}
+
+    def sync(org):
+        with profiling.profiled(org.name, window.entity, force=profile, flow=window.flow):
+            window.sync(org)
+
+    start = time.time()
+    status = run_sync(self, api_key, window.entity, sync, {'attempt': attempt, 'profile': profile}, attempt=attempt,
+                      flow=window.flow, window=window.label)
+    return {'org': api_key, 'entity': entity, 'status': status, 'seconds': time.time() - start}
+
+
+@app.task
+def sync_finished(results, started):
+    failed = [r for r in results if r['status'] != 'ok']
+    logger.info("Sync of %d org entities finished in %.1f seconds, %d failed", len(results), time.time() - started,
+                len(failed))
+    for result in failed:
+        logger.warning("Failed to sync %s for Org %s", result['entity'], result['org'])
 
 
 @app.task
-def fetch_all(entities=None, orgs=None, af=None):
+def fetch_all(entities=None, orgs=None, af=None, profile=None, backfill=None):
+    """
+    Syncs the entities of the orgs, every active org by default, as one task per stream. Full refetches (af) are
+    backfilled as one task per date window of each stream unless backfill is False, BACKFILL_FULL_SYNCS by default.
+    """
     logging.info("Started Here")
     logging.info("Only Fetch Runs, Messages, and Contacts for now")
     if not entities:
@@ -54,14 +245,51 @@ def fetch_all(entities=None, orgs=None, af=None):
         orgs = Org.find({"is_active": True})
     else:
         orgs = [Org.find_one({'api_token': api_key}) for api_key in orgs]
+    if backfill is None:
+        backfill = settings.BACKFILL_FULL_SYNCS
     assert iter(entities)
+    subtasks = []
     for org in orgs:
         for entity in entities:
-            try:
-                logger.info('Entity %s' % entity)
-                fetch_entity(entity, org, af=af)
-            except TembaException as e:
-                logger.error("Temba is misbehaving: %s - No retry", str(e))
-                continue
-            except Exception as e:
-                logger.error("Things are dead: %s - No retry", str(traceback.format_exc()))
+            name = entity_name(entity)
+            for flow in entity_flows(org, entity, af=af):
+                if af and backfill:
+                    subtasks.extend(backfill_window.s(org.api_token, str(window._id), profile=profile)
+                                    for window in Backfill.plan(org, name, flow=flow))
+                else:
+                    subtasks.append(fetch_org_entity.s(org.api_token, {'name': name, 'flows': flow}, af=af,
+                                                       profile=profile))
+    if not subtasks:
+        return
+    logger.info("Dispatching %d sync tasks", len(subtasks))
+    chord(subtasks)(sync_finished.s(time.time()))
+
+
+@app.task
+def retry_backfill(orgs=None, profile=None):
+    """
+    Sends the failed and stalled windows of the orgs' backfills again, every active org's by default
+    """
+    if not orgs:
+        orgs = Org.find({"is_active": True})
+    else:
+        orgs = [Org.find_one({'api_token': api_key}) for api_key in orgs]
+    subtasks = [backfill_window.s(org.api_token, str(window._id), profile=profile)
+                for org in orgs for window in Backfill.unfinished(org)]
+    if not subtasks:
+        return
+    logger.info("Dispatching %d backfill windows again", len(subtasks))
+    chord(subtasks)(sync_finished.s(time.time()))
+
+
+@app.task
+def sync_boundaries(orgs=None):
+    if not orgs:
+        orgs = Org.find({"is_active": True})
+    else:
+        orgs = [Org.find_one({'api_token': api_key}) for api_key in orgs]
+    for org in orgs:
+        try:
+            Boundary.sync_boundaries(org)
+        except TembaException as e:
+            logger.error("Could not sync boundaries for Org %s: %s", org.name, str(e))
@@ -1,7 +1,20 @@
+import itertools
+import os
+import tempfile
+import threading
+import time
 import unittest
 from datetime import datetime
+from uuid import uuid4
 
-from ureport_data.models import Org, Urn, Contact, Group, Broadcast, Campaign, Event, Flow, Label, Message, Run, Boundary, Result
+import requests
+from temba_client.exceptions import TembaBadRequestError, TembaConnectionError, TembaHttpError, \
+    TembaNoSuchObjectError, TembaRateExceededError, TembaTokenError
+
+from ureport_data import clients, frames, metrics, profiling, routing, runner, settings, tasks
+from ureport_data.models import LastSaved, Org, Urn, Contact, Group, Broadcast, Campaign, Event, Flow, Label, Message, Run, Boundary, Result, \
+    ResponseCount, ContactLocation, Backfill, RunDictionary, ensure_indexes, index_report, ref_cache
+from ureport_data.pipeline import Pipeline
 
 __author__ = 'kenneth'
 
@@ -15,6 +28,20 @@ class FakeTemba(object):
             setattr(self, k, v)
 
 
+class FakeTembaPages(object):
+    def __init__(self, pages):
+        self.pages = pages
+
+    def iterfetches(self, resume_cursor=None):
+        return self
+
+    def __iter__(self):
+        return iter(self.pages)
+
+    def get_cursor(self):
+        return None
+
+
 class TestModels(unittest.TestCase):
     def setUp(self):
         org = Org.create(name='Test GIC', api_token='97ce9920f956cfd6aa8ddd64329c5d236572a2c5')
@@ -47,7 +74,8 @@ class TestModels(unittest.TestCase):
         self.temba_run = FakeTemba(id=43, flow=self.temba_flow.uuid, contact=self.temba_contact.uuid,
                                    steps=[self.temba_flow_step], values=[self.temba_run_value_set],
                                    create_on=datetime.now(), completed='y')
-        self.temba_geometry = FakeTemba(type='some geo type', coordinates='gulu lango')
+        self.temba_geometry = FakeTemba(type='Polygon',
+                                        coordinates=[[[32.2, 2.7], [32.3, 2.7], [32.3, 2.8], [32.2, 2.7]]])
         self.temba_boundary = FakeTemba(boundary='some boundary', name='test_boundary', level='U', parent='b',
                                         geometry=[self.temba_geometry])
         self.temba_category_stats = FakeTemba(count=10, label='stats')
@@ -90,8 +118,473 @@ class TestModels(unittest.TestCase):
         boundary_count = Boundary.find().count()
         boundary = Boundary.create_from_temba(self.org, self.temba_boundary)
         self.assertEqual(boundary_count+1, Boundary.find().count())
-        self.assertEqual(boundary.geometry[0].coordinates, self.temba_geometry.coordinates)
+        self.assertEqual(boundary.shape['coordinates'], self.temba_geometry.coordinates)
+        self.assertNotIn('geometry', Boundary.find_raw({'_id': boundary._id})[0])
         result_count = Result.find().count()
         result = Result.create_from_temba(self.org, self.temba_result)
         self.assertEqual(result_count+1, Result.find().count())
         self.assertEqual(result.categories[0].label, self.temba_category_stats.label)
+
+    def test_bulk_upsert(self):
+        temba_groups = [FakeTemba(uuid=uuid4().hex, name='bulk_group', size=i) for i in range(3)]
+        group_count = Group.find().count()
+        groups = [Group.build_from_temba(self.org, temba) for temba in temba_groups]
+        summary = Group.bulk_upsert(self.org, groups)
+        self.assertEqual(summary['inserted'], 3)
+        self.assertEqual(group_count+3, Group.find().count())
+        self.assertTrue(all(group._id for group in groups))
+        groups = [Group.build_from_temba(self.org, temba) for temba in temba_groups]
+        summary = Group.bulk_upsert(self.org, groups, ordered=True)
+        self.assertEqual((summary['inserted'], summary['skipped']), (0, 3))
+        self.assertEqual(group_count+3, Group.find().count())
+        self.assertTrue(all(group._id for group in groups))
+        # a writer that didn't see the stored groups trips the unique index and leaves them be
+        ensure_indexes([Group], orgs=[self.org])
+        Group.stored_versions = classmethod(lambda cls, org, writes: ({}, {}))
+        try:
+            groups = [Group.build_from_temba(self.org, temba) for temba in temba_groups]
+            self.assertEqual(Group.write_page(self.org, groups, bulk=False), ([], []))
+        finally:
+            del Group.stored_versions
+        self.assertEqual(group_count+3, Group.find().count())
+        self.assertTrue(all(group._id for group in groups))
+
+    def test_change_detection(self):
+        temba_group = FakeTemba(uuid=uuid4().hex, name='changing_group', size=1)
+        created, updated = Group.write_page(self.org, [Group.build_from_temba(self.org, temba_group)])
+        self.assertEqual((len(created), updated), (1, []))
+        for bulk, size in ((True, 2), (False, 3)):
+            temba_group.size = size
+            group = Group.build_from_temba(self.org, temba_group)
+            created, updated = Group.write_page(self.org, [group], bulk=bulk)
+            self.assertEqual((created, [(obj, old['size']) for obj, old in updated]), ([], [(group, size - 1)]))
+        stored = Group.find_raw({'org.id': self.org._id, 'uuid': temba_group.uuid})
+        self.assertEqual([doc['size'] for doc in stored], [3])
+        summary = Group.bulk_upsert(self.org, [Group.build_from_temba(self.org, temba_group)])
+        self.assertEqual((summary['skipped'], summary['updated']), (1, 0))
+
+    def test_ensure_indexes(self):
+        ensure_indexes([Message, Run])
+        ensure_indexes([Message, Run])
+        report = index_report([Message, Run])
+        self.assertEqual(report['messages']['missing'], [])
+        self.assertEqual(report['runs']['missing'], [])
+
+    def test_sync_checkpoint(self):
+        flow = uuid4().hex
+        checkpoint = LastSaved.get_for(self.org, 'runs', flow=flow)
+        checkpoint.start(None)
+        checkpoint.commit_page('cursor-1', [FakeTemba(id=1, modified_on=datetime(2016, 1, 2))])
+        checkpoint = LastSaved.get_for(self.org, 'runs', flow=flow)
+        self.assertTrue(checkpoint.can_resume(af=True))
+        self.assertEqual(checkpoint.cursor, 'cursor-1')
+        checkpoint.commit_page(None, [FakeTemba(id=2, modified_on=datetime(2016, 1, 1))])
+        checkpoint.complete()
+        checkpoint = LastSaved.get_for(self.org, 'runs', flow=flow)
+        self.assertFalse(checkpoint.can_resume())
+        self.assertEqual(checkpoint.modified_on, datetime(2016, 1, 2))
+
+    def test_get_or_fetch_cache(self):
+        group = Group.create_from_temba(self.org, FakeTemba(uuid=uuid4().hex, name='cached_group', size=1))
+        hits = ref_cache.stats()['hits']
+        self.assertEqual(Group.get_or_fetch(self.org, group.uuid)._id, group._id)
+        self.assertTrue(Group.get_or_fetch(self.org, group.uuid) is Group.get_or_fetch(self.org, group.uuid))
+        self.assertEqual(ref_cache.stats()['hits'], hits+2)
+
+    def test_resolve_page_references(self):
+        self.assertEqual(sorted(key for key, cls, many in Message.reference_fields()), ['broadcast', 'contact', 'labels'])
+        group = Group.create_from_temba(self.org, FakeTemba(uuid=uuid4().hex, name='page_group', size=2))
+        temba_contacts = [FakeTemba(uuid=uuid4().hex, name='contact_%d' % i, urns=self.urns, groups=[group.uuid],
+                                    language='en') for i in range(2)]
+        refs = Contact.resolve_page_references(self.org, temba_contacts)
+        self.assertEqual(refs[Group].keys(), [group.uuid])
+        contact = Contact.build_from_temba(self.org, temba_contacts[0], refs=refs)
+        self.assertEqual(contact.groups[0].uuid, group.uuid)
+
+    def test_resolve_references(self):
+        known, unknown = [uuid4().hex for _ in range(2)], uuid4().hex
+        requested = []
+
+        def get_groups(uuid):
+            requested.append(uuid)
+            return FakeTembaPages([[FakeTemba(uuid=uuid, name='api_group', size=1)]] if uuid in known else [])
+
+        self.org.get_temba_client = lambda: FakeTemba(get_groups=get_groups)
+        self.assertEqual(sorted(Group.resolve_references(self.org, known + [unknown])), sorted(known))
+        self.assertEqual(sorted(requested), sorted(known + [unknown]))
+
+    def test_find_raw(self):
+        group = Group.create_from_temba(self.org, FakeTemba(uuid=uuid4().hex, name='raw_group', size=3))
+        docs = Group.find_raw({'org.id': self.org._id, 'uuid': group.uuid}, fields=['uuid', 'org.id'])
+        self.assertEqual(docs, [{'uuid': group.uuid, 'org': {'id': self.org._id}}])
+        record = Group.find_raw({'uuid': group.uuid}, fields=['name', 'org.id'], record=True)[0]
+        self.assertEqual((record.name, record.org_id), ('raw_group', self.org._id))
+        self.assertFalse(hasattr(record, '__dict__'))
+
+    def test_flow_from_api(self):
+        counts = FakeTemba(active=1, completed=2, interrupted=0, expired=1)
+        flow = Flow.build_from_temba(self.org, FakeTemba(uuid=uuid4().hex, name='api_flow', archived=True, labels=[],
+                                                         expires=720, runs=counts, created_on=datetime.now()))
+        self.assertEqual((flow.archived, flow.runs, flow.completed_runs), ('T', 4, 2))
+        checkpoint = LastSaved.get_for(self.org, 'runs', flow=flow.uuid)
+        checkpoint.start(None)
+        started = checkpoint.pass_started
+        checkpoint.commit_page(None, [])
+        self.assertEqual(LastSaved.last_synced(self.org, 'runs')[flow.uuid], started)
+        self.assertIn(flow.uuid, LastSaved.running_passes(self.org, 'runs'))
+        self.assertNotIn(flow.uuid, LastSaved.running_passes(self.org, 'runs', stale=-1))
+        checkpoint.complete()
+        self.assertNotIn(flow.uuid, LastSaved.running_passes(self.org, 'runs'))
+
+    def test_response_counts(self):
+        flow = uuid4().hex
+        values = {'q': FakeTemba(node='node1', category='Yes', value='yes', time=datetime(2016, 1, 1))}
+        runs = [Run.build_from_temba(self.org, FakeTemba(id=i, flow=FakeTemba(uuid=flow), contact=FakeTemba(uuid='c'),
+                                                         created_on=datetime.now(), modified_on=None, exited_on=None,
+                                                         exit_type=None, path=[], values=values)) for i in range(3)]
+        ResponseCount.apply(self.org, runs)
+        ResponseCount.apply(self.org, runs[:1], old_runs=runs[1:])
+        result = Result.from_counts(self.org, flow, 'node1')
+        self.assertEqual(result.set, 2)
+        self.assertEqual([(c.label, c.count) for c in result.categories], [('Yes', 2)])
+
+    def test_compact_runs(self):
+        created_on = datetime(2016, 1, 1, 10)
+        values = {'q': FakeTemba(node='node1', category='Yes', value='yes', time=datetime(2016, 1, 1, 10, 5))}
+        temba_run = FakeTemba(id=1, flow=FakeTemba(uuid=uuid4().hex), contact=FakeTemba(uuid='c'),
+                              created_on=created_on, modified_on=None, exited_on=None, exit_type=None,
+                              path=[FakeTemba(node='node1', time=created_on)], values=values)
+        run = Run.build_from_temba(self.org, temba_run)
+        compact = Run.encode_raw(run.to_insert())
+        self.assertEqual(compact['v'], [{'n': 0, 'c': 0, 'v': 'yes', 't': 5*60*1000}])
+        self.assertEqual(compact['s'], [{'n': 0, 't': 0}])
+        decoded = Run(data=compact)
+        self.assertEqual((decoded.values[0].category, decoded.values[0].time), ('Yes', datetime(2016, 1, 1, 10, 5)))
+        self.assertEqual(decoded.steps[0].node, 'node1')
+        RunDictionary._cache.clear()
+        self.assertEqual(RunDictionary.positions(self.org._id, temba_run.flow.uuid, 'nodes', ['node2', 'node1']),
+                         {'node1': 0, 'node2': 1})
+        dictionaries = RunDictionary._connection().find({'org.id': self.org._id, 'flow': temba_run.flow.uuid})
+        self.assertEqual(dictionaries.count(), 1)
+
+    def test_boundary_shapes(self):
+        ring = [[0, 0], [1, 0.001], [2, 0], [2, 2], [0, 2], [0, 0]]
+        geometry = FakeTemba(type='Polygon', coordinates=[ring])
+        boundary = Boundary.build_from_temba(self.org, FakeTemba(osm_id='R2', name='Gulu', aliases=[], level=1,
+                                                                 parent=FakeTemba(osm_id='R1', name='Uganda'),
+                                                                 geometry=geometry))
+        self.assertEqual(boundary.shape, {'type': 'Polygon', 'coordinates': [ring]})
+        self.assertEqual(boundary.shape_for_zoom(4)['coordinates'], [[[0, 0], [2, 0], [2, 2], [0, 2], [0, 0]]])
+        self.assertEqual(boundary.shape_for_zoom(20), boundary.shape)
+        names = {('R1', 'gulu'): ('R2', 'Gulu')}
+        self.assertEqual(ContactLocation.locate({'state': 'Uganda > Gulu', 'district': 'Omoro'}, ('R1', 'Uganda'),
+                                                names), (['R1', 'R2'], ['Uganda', 'Gulu']))
+
+    def test_sync_boundaries(self):
+        ring = [[0, 0], [1, 0], [1, 1], [0, 0]]
+        fetched = []
+        client = FakeTemba(get_boundaries=lambda geometry: FakeTemba(all=lambda: fetched))
+        self.org.get_temba_client = lambda: client
+        for osm_ids in [['R1', 'R2'], ['R1']]:
+            fetched[:] = [FakeTemba(osm_id=osm_id, name=osm_id, aliases=[], level=0, parent=None,
+                                    geometry=FakeTemba(type='Polygon', coordinates=[ring])) for osm_id in osm_ids]
+            Boundary.sync_boundaries(self.org)
+        self.assertEqual([doc['boundary'] for doc in Boundary.find_raw({'org.id': self.org._id})], ['R1'])
+        self.assertEqual(ContactLocation.cached_boundary_names(self.org)[1], {(None, 'r1'): ('R1', 'R1')})
+
+    def test_streaming_sync(self):
+        pages = [[FakeTemba(uuid=uuid4().hex, name='stream_group', size=1)] for _ in range(3)]
+        self.assertEqual(Group.create_from_temba_list(self.org, FakeTembaPages(pages)), 3)
+        self.assertEqual(Group.create_from_temba_list(self.org, FakeTembaPages(pages)), 0)
+        new = FakeTembaPages([[FakeTemba(uuid=uuid4().hex, name='stream_group', size=1)]])
+        self.assertEqual([g.name for g in Group.create_from_temba_list(self.org, new, materialize=True)],
+                         ['stream_group'])
+        uuids = iter(page[0].uuid for page in pages)
+        self.assertEqual(len(list(Group.iter_objects_from_uuids(self.org, uuids))), 3)
+
+    def test_conversion_plan(self):
+        plan = Message.conversion_plan()
+        self.assertIs(plan, Message.conversion_plan())
+        self.assertEqual([(key, plan[key][1]) for key in ('contact', 'labels', 'urn')],
+                         [('contact', Contact), ('labels', Label), ('urn', Urn)])
+        self.assertEqual(Message.reference_fields(),
+                         [('broadcast', Broadcast, False), ('contact', Contact, False), ('labels', Label, True)])
+        label = Label.create_from_temba(self.org, FakeTemba(uuid=uuid4().hex, name='plan_label', count=1))
+        message = Message.build_from_temba(self.org, FakeTemba(id=1, text='plan', labels=[label.uuid], unknown=1),
+                                           refs={Label: {label.uuid: label}})
+        self.assertEqual((message.text, [l.name for l in message.labels]), ('plan', ['plan_label']))
+
+    def test_backfill(self):
+        until = datetime(2017, 3, 15)
+        windows = Backfill.plan(self.org, 'Message', start=datetime(2017, 1, 1), until=until, days=30)
+        self.assertEqual([w.after for w in windows], [datetime(2017, 2, 13), datetime(2017, 1, 14), None])
+        self.assertEqual(Backfill.plan(self.org, 'Message'), [])
+        self.assertEqual(Message.fetch_objects(self.org), 0)
+        self.assertFalse(Backfill.in_progress(self.org, 'messages', stale=-1))
+        windows[0].complete()
+        self.assertFalse(windows[0].finish_backfill(self.org))
+        report = Backfill.progress(self.org)[0]
+        self.assertEqual((report['done'], report['pending'], report['percent']), (1, 2, 33.3))
+        for window in windows[1:]:
+            window.complete()
+        self.assertTrue(windows[-1].finish_backfill(self.org))
+        self.assertEqual(LastSaved.get_for(self.org, 'messages').modified_on, until)
+        self.assertEqual(Backfill.progress(self.org)[0]['eta_seconds'], 0)
+
+    def test_routing(self):
+        org = Org.create(name='Routed Org', api_token=uuid4().hex, storage=routing.COLLECTION)
+        group = Group.create_from_temba(org, FakeTemba(uuid=uuid4().hex, name='routed_group', size=1))
+        shared = routing.collection(Group, org._id, storage=routing.SHARED)
+        self.assertEqual(shared.find({'org.id': org._id}).count(), 0)
+        self.assertEqual([g.uuid for g in org.groups()], [group.uuid])
+        self.assertIn('%s.org_%s.groups' % (settings.DATABASE, org._id), index_report([Group]))
+        values = {'q': FakeTemba(node='node1', category='Yes', value='yes', time=datetime(2016, 1, 1))}
+        run = Run.build_from_temba(org, FakeTemba(id=1, flow=FakeTemba(uuid='routed_flow'), contact=FakeTemba(uuid='c'),
+                                                  created_on=datetime.now(), modified_on=None, exited_on=None,
+                                                  exit_type=None, path=[], values=values))
+        with routing.using(org):
+            ResponseCount.apply(org, [run])
+        self.assertEqual(Result.from_counts(org, 'routed_flow', 'node1').set, 1)
+        self.assertEqual(org.relocate(routing.SHARED)['groups'], 1)
+        self.assertEqual(shared.find({'org.id': org._id}).count(), 1)
+        self.assertEqual([g.uuid for g in Org.find_one({'_id': org._id}).groups()], [group.uuid])
+
+    def test_metrics(self):
+        with metrics.task('Run', org='metrics_org', flow='metrics_flow') as scope:
+            metrics.inc('pages_fetched', 2)
+            metrics.inc('reference_lookups', 3, reference='Contact', result='db_hit')
+            metrics.observe('api_request_seconds', 0.2, endpoint='runs')
+        self.assertEqual((scope.totals['pages_fetched'], scope.totals['reference_lookups_db_hit']), (2, 3))
+        text = metrics.exposition(metrics.collect())
+        self.assertIn('ureport_pages_fetched_total{entity="Run",org="metrics_org"} 2', text)
+        self.assertIn('ureport_api_request_seconds_bucket{endpoint="runs",entity="Run",org="metrics_org",le="0.25"} 1',
+                      text)
+
+    def test_profiling(self):
+        profile_dir = settings.PROFILE_DIR
+        settings.PROFILE_DIR = tempfile.mkdtemp()
+        try:
+            with metrics.task('Group', org=self.org.name):
+                with profiling.profiled(self.org.name, 'Group', force='cprofile') as profile:
+                    with profiling.span('groups'):
+                        Group.find_raw({'org.id': self.org._id})
+            spans = profile.span_report()
+            self.assertEqual([spans[name]['calls'] for name in ('groups', 'mongo.find.groups')], [1, 1])
+            self.assertEqual(sorted(f.split('.', 1)[1] for f in os.listdir(settings.PROFILE_DIR)),
+                             ['pstats', 'spans.json'])
+            with profiling.profiled(self.org.name, 'Group', force='cprofile', flow=['f1', 'f2']):
+                pass
+            self.assertEqual(len(os.listdir(settings.PROFILE_DIR)), 4)
+            with profiling.profiled(self.org.name, 'Group') as profile:
+                self.assertIsNone(profile)
+        finally:
+            settings.PROFILE_DIR = profile_dir
+
+    @unittest.skipIf(frames.pd is None, "pandas is not installed")
+    def test_load_frame(self):
+        contact = Contact.create_from_temba(self.org, FakeTemba(uuid=uuid4().hex, name='frame_contact', urns=self.urns,
+                                                                groups=[], language='en'))
+        frame = self.org.load_frame('contacts', fields=['uuid', 'name', 'created_on'])
+        self.assertEqual(len(frame[frame.uuid == contact.uuid]), len(self.urns))
+        chunks = list(self.org.load_frame('contacts', fields=['uuid'], explode=False, iterator=True, chunksize=1))
+        self.assertTrue(all(len(chunk) == 1 for chunk in chunks))
+        self.assertRaises(frames.FrameTooLarge, self.org.load_frame, 'contacts', max_bytes=1)
+
+
+class TestRetries(unittest.TestCase):
+    def http_error(self, status_code, headers=None):
+        response = requests.Response()
+        response.status_code = status_code
+        response.headers.update(headers or {})
+        return TembaHttpError(requests.HTTPError(response=response))
+
+    def test_retry_countdown(self):
+        for attempt in range(12):
+            backoff = min(settings.RETRY_BACKOFF_MAX, settings.RETRY_BACKOFF_BASE * 2 ** attempt)
+            countdown = tasks.retry_countdown(TembaConnectionError(), attempt)
+            self.assertTrue(backoff / 2 <= countdown <= backoff)
+        for error in [TembaRateExceededError(90), self.http_error(429, {'Retry-After': '90'})]:
+            countdown = tasks.retry_countdown(error, 5)
+            self.assertTrue(90 <= countdown <= 90 + settings.RETRY_JITTER)
+
+    def test_retry_if_temba_api_or_connection_error(self):
+        retried = [TembaRateExceededError(90), TembaConnectionError(), self.http_error(429), self.http_error(502)]
+        self.assertTrue(all(tasks.retry_if_temba_api_or_connection_error(error) for error in retried))
+        given_up = [TembaBadRequestError({'detail': 'bad'}), TembaTokenError(), TembaNoSuchObjectError(),
+                    self.http_error(400), self.http_error(403), self.http_error(404), ValueError()]
+        self.assertFalse(any(tasks.retry_if_temba_api_or_connection_error(error) for error in given_up))
+
+
+class FakeSession(object):
+    """
+    Answers every request with the next of `responses`, (status code, body, headers) or an exception to raise
+    """
+    def __init__(self, *responses):
+        self.responses = list(responses)
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url, kwargs))
+        answer = self.responses.pop(0)
+        if isinstance(answer, Exception):
+            raise answer
+        response = requests.Response()
+        response.status_code, response._content = answer[0], answer[1]
+        response.headers.update(answer[2] if len(answer) > 2 else {})
+        return response
+
+
+class TestClients(unittest.TestCase):
+    def request(self, *responses):
+        client = clients.PooledTembaClient('http://rapidpro.test', 'token', FakeSession(*responses))
+        return client._request('get', 'http://rapidpro.test/api/v2/contacts.json', params={'uuid': 'c'})
+
+    def test_error_mapping(self):
+        self.assertEqual(self.request((200, '{"results": []}')), {'results': []})
+        try:
+            self.request((400, '{"uuid": ["Not a uuid"]}'))
+            self.fail("400 not raised")
+        except TembaBadRequestError as e:
+            self.assertEqual(e.errors, {'uuid': ['Not a uuid']})
+        self.assertRaises(TembaTokenError, self.request, (403, ''))
+        self.assertRaises(TembaNoSuchObjectError, self.request, (404, ''))
+        try:
+            self.request((429, '', {'Retry-After': '7'}))
+            self.fail("429 not raised")
+        except TembaRateExceededError as e:
+            self.assertEqual(e.retry_after, 7)
+        self.assertRaises(TembaHttpError, self.request, (502, ''))
+        self.assertRaises(TembaConnectionError, self.request, requests.exceptions.ConnectionError())
+        self.assertRaises(TembaConnectionError, self.request, requests.exceptions.Timeout())
+
+    def test_registry(self):
+        registry = clients.ClientRegistry()
+        client = registry.get('token')
+        self.assertIs(registry.get('token'), client)
+        self.assertIsNot(registry.get('other'), client)
+        self.assertEqual(registry.stats(), {'hits': 1, 'misses': 2, 'clients': 2})
+        self.assertIs(registry.get('other').session, client.session)
+        registry.limit_requests(2)
+        self.assertIs(client.slots, registry.slots)
+        # a forked child gets clients and a session of its own
+        registry.pid = -1
+        forked = registry.get('token')
+        self.assertIsNot(forked, client)
+        self.assertIsNot(forked.session, client.session)
+        self.assertEqual(registry.stats()['clients'], 1)
+        registry.close()
+        self.assertEqual(registry.stats()['clients'], 0)
+
+
+class FakeRedis(object):
+    """
+    The sorted set commands sync slots use
+    """
+    def __init__(self):
+        self.sets = {}
+
+    def zremrangebyscore(self, key, low, high):
+        members = self.sets.get(key, {})
+        for member, score in members.items():
+            if score <= float(high):
+                del members[member]
+
+    def execute_command(self, command, key, score, member):
+        self.sets.setdefault(key, {})[member] = float(score)
+
+    def zcard(self, key):
+        return len(self.sets.get(key, {}))
+
+    def zrem(self, key, member):
+        self.sets.get(key, {}).pop(member, None)
+
+    def expire(self, key, seconds):
+        pass
+
+
+class TestSlots(unittest.TestCase):
+    def setUp(self):
+        tasks._redis = FakeRedis()
+        self.key = tasks.ORG_SLOTS_KEY % 'slots'
+
+    def tearDown(self):
+        tasks._redis = None
+
+    def test_limit(self):
+        self.assertTrue(all(tasks.acquire_slot(self.key, 2, holder) for holder in ['a', 'b']))
+        self.assertFalse(tasks.acquire_slot(self.key, 2, 'c'))
+        tasks.release_slot(self.key, 2, 'a')
+        self.assertTrue(tasks.acquire_slot(self.key, 2, 'c'))
+        self.assertTrue(tasks.acquire_slot(self.key, 0, 'd'))
+
+    def test_leaked_slot_expires(self):
+        ttl = settings.SYNC_SLOT_TTL
+        settings.SYNC_SLOT_TTL = -1
+        try:
+            self.assertTrue(tasks.acquire_slot(self.key, 1, 'dead'))
+        finally:
+            settings.SYNC_SLOT_TTL = ttl
+        self.assertTrue(tasks.acquire_slot(self.key, 1, 'alive'))
+        deadline = tasks._redis.sets[self.key]['alive']
+        self.assertFalse(tasks.acquire_slot(self.key, 1, 'waiting'))
+        self.assertEqual(tasks._redis.sets[self.key], {'alive': deadline})
+
+
+class TestPipeline(unittest.TestCase):
+    def test_run(self):
+        written = []
+        Pipeline(iter(range(5)), [lambda page: page * 2, written.append], poll=0.01).run()
+        self.assertEqual(written, [0, 2, 4, 6, 8])
+
+    def test_stage_error(self):
+        fetched, written = [], []
+
+        def pages():
+            for page in itertools.count():
+                fetched.append(page)
+                yield page
+
+        def convert(page):
+            if page == 3:
+                raise ValueError("bad page")
+            return page
+
+        pipeline = Pipeline(pages(), [convert, written.append], queue_size=2, poll=0.01)
+        self.assertRaisesRegexp(ValueError, "bad page", pipeline.run)
+        self.assertEqual(written, [0, 1, 2])
+        # the endless source stopped once its queue filled up after the error
+        self.assertTrue(len(fetched) <= 3 + 2 * 2 + 2)
+
+
+class FakeStream(object):
+    """
+    Entity whose syncs take a while, counting how many run at once; the org named 'broken' fails
+    """
+    lock = threading.Lock()
+    running = peak = 0
+
+    @classmethod
+    def fetch_objects(cls, org, af=None):
+        with cls.lock:
+            cls.running += 1
+            cls.peak = max(cls.peak, cls.running)
+        time.sleep(0.02)
+        with cls.lock:
+            cls.running -= 1
+        if org.name == 'broken':
+            raise ValueError("broken stream")
+
+
+class TestRunner(unittest.TestCase):
+    def test_run(self):
+        orgs = runner.Org
+        runner.Org = FakeTemba(find_one=lambda query: FakeTemba(name=query['api_token']))
+        try:
+            results = runner.run(entities=[{'name': FakeStream}], orgs=['org_%d' % i for i in range(6)] + ['broken'],
+                                 concurrency=2, requests=0)
+        finally:
+            runner.Org = orgs
+        self.assertEqual(FakeStream.peak, 2)
+        self.assertEqual(sorted((r['org'], r['status']) for r in results if r['status'] != 'ok'),
+                         [('broken', 'failed')])
+        self.assertEqual(len(results), 7)